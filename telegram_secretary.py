@@ -6,13 +6,24 @@ Telegram AI Secretary — 远程遥控 Claude Code
 支持图片/文件：发截图或文件 → 保存本地 → 交给 Claude 处理
 """
 
+import array
+import codecs
+import csv
+import gzip
 import hashlib
+import heapq
+import importlib.util
+import inspect
+import io
 import json
+import math
 import os
 import queue
 import re
 import shutil
 import ssl
+import statistics
+import struct
 import subprocess
 import sys
 import tempfile
@@ -20,8 +31,13 @@ import threading
 import time
 import traceback
 import urllib.request
+import urllib.error
 import urllib.parse
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                TimeoutError as FuturesTimeout, wait)
+from datetime import datetime, timedelta
+from itertools import accumulate, islice
 from pathlib import Path
 
 # Fix Windows console encoding for Chinese characters
@@ -40,6 +56,7 @@ if os.path.isdir(_FFMPEG_DIR):
 try:
     import speech_recognition as sr
     from pydub import AudioSegment
+    from pydub.silence import detect_leading_silence
     VOICE_ENABLED = True
 except ImportError:
     VOICE_ENABLED = False
@@ -51,6 +68,44 @@ try:
 except ImportError:
     GROQ_ENABLED = False
 
+# NumPy (向量化统计，可选 — 没装就用纯 Python 计算)
+try:
+    import numpy as np
+    NUMPY_ENABLED = True
+except ImportError:
+    NUMPY_ENABLED = False
+
+# requests (连接池 HTTP session，给供应商价格同步用，可选)
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    REQUESTS_ENABLED = True
+except ImportError:
+    REQUESTS_ENABLED = False
+
+# Pillow (图片缩放/压缩，可选 — 没装就直接用原图)
+try:
+    from PIL import Image
+    PIL_ENABLED = True
+except ImportError:
+    PIL_ENABLED = False
+
+# Tesseract OCR (图片文字预提取，可选 — 需要 pytesseract + tesseract 程序)
+try:
+    import pytesseract
+    if os.environ.get("TESSERACT_CMD"):
+        pytesseract.pytesseract.tesseract_cmd = os.environ["TESSERACT_CMD"]
+    OCR_ENABLED = True
+except ImportError:
+    OCR_ENABLED = False
+
+# openpyxl (xlsx 表格预览，可选 — 没装就只预览 CSV/JSON)
+try:
+    import openpyxl
+    XLSX_ENABLED = True
+except ImportError:
+    XLSX_ENABLED = False
+
 # SSL: use certifi CA bundle for proper certificate verification
 import certifi
 SSL_CTX = ssl.create_default_context(cafile=certifi.where())
@@ -99,16 +154,12 @@ RECEIVED_DIR.mkdir(exist_ok=True)
 
 
 def _clean_received_files(max_age_days=7):
-    """Delete files in received_files/ older than max_age_days. Called on startup."""
+    """Evict received files older than max_age_days or beyond the size cap (see ReceivedStore.gc).
+    Runs on startup, every 30 minutes from the scheduler, and aggressively on resource errors."""
     try:
-        cutoff = time.time() - (max_age_days * 86400)
-        count = 0
-        for f in RECEIVED_DIR.iterdir():
-            if f.is_file() and f.stat().st_mtime < cutoff:
-                f.unlink()
-                count += 1
+        count, freed = received_store.gc(max_age_days)
         if count:
-            log(f"🧹 Cleaned {count} old file(s) from received_files/")
+            log(f"🧹 Cleaned {count} file(s) ({freed / 1024 / 1024:.1f}MB) from received_files/")
     except Exception as e:
         log(f"Clean received_files error (non-critical): {e}")
 
@@ -132,6 +183,9 @@ LDS_PASS = os.environ.get("LDS_PASS", "")
 BOOKING_URL = "https://script.google.com/macros/s/AKfycbyq1uhgRek_xCtOeAeWnS6mKxoYI4FMSiezAHlGHB-GXkJNGIZNTaotIT76CmKNvoY_/exec?page=admin"
 BOOKING_USER = os.environ.get("BOOKING_USER", "")
 BOOKING_PASS = os.environ.get("BOOKING_PASS", "")
+# JSON endpoints behind the admin pages (shared by reports, health checks and the data cache)
+LDS_API_URL = "https://script.google.com/macros/s/AKfycbzTxymBxmmliLWpOdg-lh-Ev6tDKyjEf91wgTaDAtxx0gtEsZZrsL9rL9AFv7-XaySlew/exec?page=api&key=zchhp2024"
+BOOKING_API_URL = "https://script.google.com/macros/s/AKfycbyq1uhgRek_xCtOeAeWnS6mKxoYI4FMSiezAHlGHB-GXkJNGIZNTaotIT76CmKNvoY_/exec?page=api&key=zchhp2024"
 SS_PATH = str(SCRIPT_DIR / "desktop_now.png")
 SS_SCRIPT = r"C:\Users\Admin23\AppData\Local\Temp\ss.ps1"
 
@@ -152,6 +206,7 @@ _current_proc_lock = threading.Lock()
 _worker_thread = None            # Reference for watchdog
 _last_auth_warn_ts = 0           # Cooldown for auth-error Telegram messages
 _last_network_warn_ts = 0        # Cooldown for network-outage Telegram messages
+_run_info = threading.local()    # Per-thread details of the last run_claude call (model, reason)
 
 
 def _next_task_code():
@@ -164,6 +219,39 @@ def _next_task_code():
     return chr(ord('A') + (n % 26)) + str(n // 26 + 1)
 
 
+def _enqueue_task(text, chat_id, **extra):
+    """Acknowledge a message and queue it for the worker. Returns the task code."""
+    code = _next_task_code()
+    q_size = _task_queue.qsize()
+    queue_note = f"（前面还有 {q_size} 个任务排队）" if q_size > 0 else ""
+    send_msg(f"[{code}] 收到，处理中...{queue_note}", chat_id=chat_id)
+    files = received_store.pin(text)   # released by task_worker when the task is done
+    _task_queue.put({'code': code, 'text': text, 'chat_id': chat_id, 'queued_at': time.time(),
+                     'files': files, **extra})
+    log(f"[{code}] Queued (pos={q_size+1}): {text[:60]}")
+    return code
+
+
+ENRICH_WAIT_SEC = 20   # how long the worker waits for OCR text / table previews
+
+
+def collect_enrichments(extras):
+    """Text produced in the background for a task's attachments, appended to its prompt.
+    extras: (future, wait_sec, fallback) — each future gets up to wait_sec from now; one that
+    fails, times out or comes back empty contributes its fallback text instead."""
+    start = time.time()
+    parts = []
+    for fut, wait, fallback in extras or ():
+        try:
+            extra = fut.result(timeout=max(0, start + wait - time.time()))
+        except Exception as e:
+            log(f"Attachment extra skipped: {str(e)[:80] or type(e).__name__}")
+            extra = ""
+        if extra or fallback:
+            parts.append(extra or fallback)
+    return "".join("\n" + p for p in parts)
+
+
 # ─── Telegram API ────────────────────────────────────────────────
 def tg_api(method, params=None, retries=2):
     """Call Telegram Bot API with retry on network errors."""
@@ -260,9 +348,13 @@ def send_photo(file_path, caption=""):
     if not os.path.isfile(file_path):
         log(f"send_photo: file not found: {file_path}")
         return False
+    original_path = file_path
+    file_path = prepare_image(file_path, IMAGE_SEND_PX, IMAGE_SEND_MAX_BYTES)
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
     boundary = "----SecretaryPhotoBoundary"
-    file_name = os.path.basename(file_path)
+    file_name = os.path.basename(original_path)
+    if file_path != original_path:
+        file_name = os.path.splitext(file_name)[0] + ".jpg"
     try:
         with open(file_path, "rb") as f:
             file_data = f.read()
@@ -286,7 +378,7 @@ def send_photo(file_path, caption=""):
                 return True
             else:
                 log(f"send_photo failed: {resp}")
-                return send_file(file_path, caption)  # fallback to document
+                return send_file(original_path, caption)  # fallback to document
     except Exception as e:
         log(f"send_photo error: {e}")
         return False
@@ -384,9 +476,186 @@ class TypingIndicator:
             self._thread = None
 
 
+# ─── Received Files Store ───────────────────────────────────────
+# Downloads are content-addressed: received_files/store/<sha256 prefix><ext>, so a re-sent
+# document is stored once and same-second uploads can't overwrite each other. index.json maps
+# original names to blobs and tracks last use; gc() enforces an age limit and a total-size cap
+# (least recently used first). Loose files directly in received_files/ (prepared images,
+# older downloads) and table previews in received_files/tables/ count toward the cap too.
+RECEIVED_STORE_DIR = RECEIVED_DIR / "store"
+RECEIVED_INDEX_FILE = RECEIVED_DIR / "index.json"
+RECEIVED_TABLES_DIR = RECEIVED_DIR / "tables"
+RECEIVED_MAX_BYTES = int(os.environ.get("RECEIVED_MAX_MB", "500")) * 1024 * 1024
+RECEIVED_MAX_AGE_DAYS = 7
+
+
+class ReceivedStore:
+    """Content-addressed, size-bounded store for files received from Telegram."""
+
+    def __init__(self, store_dir, index_file, max_bytes=RECEIVED_MAX_BYTES, tables_dir=None):
+        self.store_dir = store_dir
+        self.index_file = index_file
+        self.max_bytes = max_bytes
+        self.tables_dir = tables_dir   # table previews: <key>.json summary + <key>.csv copy
+        self._lock = threading.Lock()
+        self._index = None   # {"blobs": {hash: {"file", "size", "used", "names"}}, "names": {name: hash}}
+        self._pins = {}      # path -> number of queued/running tasks whose prompt names it
+
+    def _load(self):
+        if self._index is None:
+            try:
+                self._index = json.loads(self.index_file.read_text(encoding="utf-8"))
+            except Exception:
+                self._index = {}
+            self._index.setdefault("blobs", {})
+            self._index.setdefault("names", {})
+        return self._index
+
+    def _save(self):
+        tmp = self.index_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._index, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(self.index_file)
+
+    def lookup(self, name):
+        """Path of the blob last stored under `name`, or None. Counts as a use (LRU)."""
+        with self._lock:
+            idx = self._load()
+            digest = idx["names"].get(name)
+            blob = idx["blobs"].get(digest)
+            if not blob or not (self.store_dir / blob["file"]).exists():
+                return None
+            blob["used"] = time.time()
+            self._save()
+            return str(self.store_dir / blob["file"])
+
+    def pin(self, text):
+        """Keep the received files a task's text refers to out of gc until unpin().
+        Returns the pinned paths (to hand back to unpin)."""
+        paths = re.findall(re.escape(str(RECEIVED_DIR)) + r"[\\/][^\s\]。，]+", text)
+        with self._lock:
+            for p in paths:
+                self._pins[p] = self._pins.get(p, 0) + 1
+        return paths
+
+    def unpin(self, paths):
+        """Release pin()'s paths once the task is done; they count as used now (LRU)."""
+        if not paths:
+            return
+        with self._lock:
+            for p in paths:
+                if self._pins.get(p, 0) > 1:
+                    self._pins[p] -= 1
+                else:
+                    self._pins.pop(p, None)
+            names = {Path(p).name for p in paths}
+            now = time.time()
+            for blob in self._load()["blobs"].values():
+                if blob["file"] in names:
+                    blob["used"] = now
+            try:
+                self._save()
+            except OSError as e:
+                log(f"Received index save error (non-critical): {e}")
+
+    def put_stream(self, src, name, ext=""):
+        """Copy a readable stream into the store, hashing as it goes. Returns the blob path;
+        identical content already stored is reused and the temp copy dropped."""
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.store_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = src.read(256 * 1024)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = h.hexdigest()
+            blob_name = f"{digest[:20]}{ext.lower()}"
+            with self._lock:
+                idx = self._load()
+                blob = idx["blobs"].get(digest)
+                if blob and (self.store_dir / blob["file"]).exists():
+                    os.unlink(tmp)
+                    log(f"Received file deduplicated: {name} = {blob['file']}")
+                else:
+                    os.replace(tmp, self.store_dir / blob_name)
+                    blob = idx["blobs"][digest] = {"file": blob_name, "size": size, "names": []}
+                blob["used"] = time.time()
+                if name not in blob["names"]:
+                    blob["names"].append(name)
+                idx["names"][name] = digest
+                self._save()
+                return str(self.store_dir / blob["file"])
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def gc(self, max_age_days=RECEIVED_MAX_AGE_DAYS):
+        """Drop files unused for max_age_days, then least recently used ones until the total is
+        under max_bytes. Files pinned by queued or running tasks (and their table previews)
+        are kept but still count towards the total. Returns (files removed, bytes freed)."""
+        cutoff = time.time() - max_age_days * 86400
+        removed = freed = 0
+        with self._lock:
+            idx = self._load()
+            pinned_stems = {Path(p).stem for p in self._pins}
+            items = []   # (last used, size, blob hash or loose Path or preview pair, pinned)
+            for digest, blob in list(idx["blobs"].items()):
+                path = self.store_dir / blob["file"]
+                if path.exists():
+                    items.append((blob.get("used", 0), blob["size"], digest, str(path) in self._pins))
+                else:
+                    del idx["blobs"][digest]
+            for f in RECEIVED_DIR.iterdir():
+                if f.is_file() and f != self.index_file:
+                    st = f.stat()
+                    items.append((st.st_mtime, st.st_size, f, str(f) in self._pins))
+            if self.tables_dir and self.tables_dir.exists():
+                for f in self.tables_dir.iterdir():
+                    if f.suffix == ".json":   # summary + CSV go together; the summary's mtime is last use
+                        pair = [p for p in (f, f.with_suffix(".csv")) if p.exists()]
+                        items.append((f.stat().st_mtime, sum(p.stat().st_size for p in pair), pair,
+                                      f.stem in pinned_stems))
+                    elif not f.with_suffix(".json").exists():
+                        st = f.stat()
+                        items.append((st.st_mtime, st.st_size, f, f.stem in pinned_stems))
+            items.sort(key=lambda it: it[0])
+            total = sum(it[1] for it in items)
+            for used, size, item, pinned in items:
+                if used >= cutoff and total <= self.max_bytes:
+                    break
+                if pinned:
+                    continue
+                try:
+                    if isinstance(item, Path):
+                        item.unlink()
+                    elif isinstance(item, list):
+                        for p in item:
+                            p.unlink()
+                    else:
+                        (self.store_dir / idx["blobs"].pop(item)["file"]).unlink()
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+                freed += size
+            idx["names"] = {n: d for n, d in idx["names"].items() if d in idx["blobs"]}
+            self._save()
+        return removed, freed
+
+
+received_store = ReceivedStore(RECEIVED_STORE_DIR, RECEIVED_INDEX_FILE, tables_dir=RECEIVED_TABLES_DIR)
+
+
 # ─── File Download from Telegram ──────────────────────────────────
 def download_telegram_file(file_id, suffix=None, filename=None):
-    """Download any file from Telegram by file_id. Returns local path or None."""
+    """Download any file from Telegram by file_id into the received-files store.
+    Returns local path or None."""
     resp = tg_api("getFile", {"file_id": file_id})
     if not resp.get("ok"):
         return None
@@ -394,88 +663,716 @@ def download_telegram_file(file_id, suffix=None, filename=None):
     url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{tg_file_path}"
 
     if filename:
-        local_path = str(RECEIVED_DIR / filename)
-    elif suffix:
-        ts = time.strftime("%Y%m%d_%H%M%S")
-        local_path = str(RECEIVED_DIR / f"file_{ts}{suffix}")
+        name, ext = filename, os.path.splitext(filename)[1]
     else:
-        ext = os.path.splitext(tg_file_path)[1] or ".bin"
-        ts = time.strftime("%Y%m%d_%H%M%S")
-        local_path = str(RECEIVED_DIR / f"file_{ts}{ext}")
+        ext = suffix or os.path.splitext(tg_file_path)[1] or ".bin"
+        name = f"file_{time.strftime('%Y%m%d_%H%M%S')}{ext}"
 
     try:
         req = urllib.request.Request(url)
         with urllib.request.urlopen(req, timeout=60, context=SSL_CTX) as r:
-            with open(local_path, "wb") as f:
-                f.write(r.read())
-        log(f"Downloaded file: {local_path}")
+            local_path = received_store.put_stream(r, name, ext)
+        log(f"Downloaded file: {name} → {local_path}")
         return local_path
     except Exception as e:
         log(f"File download error: {e}")
         return None
 
 
+# ─── Image Preparation ──────────────────────────────────────────
+# Claude downsizes anything beyond ~1568px on the long edge anyway, so larger images only
+# cost upload and processing time. Incoming photos use the smallest Telegram size that reaches
+# IMAGE_PROMPT_PX; with Pillow, oversized images are downscaled and re-encoded locally.
+# Prepared files live in received_files/ under deterministic names, so repeats are cache hits
+# (and are evicted by the received-files store's gc like everything else there).
+IMAGE_PROMPT_PX = 1568        # long edge for images handed to Claude
+IMAGE_SEND_PX = 2560          # long edge for outgoing photos (Telegram recompresses above this)
+IMAGE_SEND_MAX_BYTES = 1_500_000
+IMAGE_JPEG_QUALITY = 85
+
+
+def pick_photo_size(sizes, target_px=IMAGE_PROMPT_PX):
+    """Smallest Telegram PhotoSize whose long edge reaches target_px (else the largest)."""
+    ordered = sorted(sizes, key=lambda p: p.get("width", 0) * p.get("height", 0))
+    for p in ordered:
+        if max(p.get("width", 0), p.get("height", 0)) >= target_px:
+            return p
+    return ordered[-1]
+
+
+def prepare_image(path, max_px, max_bytes=None):
+    """Return a path to a version of the image no larger than max_px on the long edge
+    (and, if given, max_bytes), re-encoded as JPEG. The original path is returned when it
+    already fits, Pillow is missing or conversion fails. Results are cached by source
+    path + mtime + size."""
+    path = str(path)
+    if not PIL_ENABLED:
+        return path
+    try:
+        st = os.stat(path)
+        key = hashlib.md5(f"{os.path.abspath(path)}|{st.st_mtime}|{st.st_size}|{max_px}".encode()).hexdigest()[:16]
+        out = RECEIVED_DIR / f"prep_{key}.jpg"
+        if out.exists():
+            return str(out)
+        with Image.open(path) as img:
+            too_big = max(img.size) > max_px or (max_bytes and st.st_size > max_bytes)
+            if not too_big:
+                return path
+            img = img.convert("RGB") if img.mode not in ("RGB", "L") else img
+            img.thumbnail((max_px, max_px), Image.LANCZOS)
+            img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        log(f"Image prepared: {os.path.basename(path)} {st.st_size // 1024}KB → {out.stat().st_size // 1024}KB")
+        return str(out)
+    except Exception as e:
+        log(f"Image preparation failed, using original: {e}")
+        return path
+
+
+def prepare_incoming_photo(sizes):
+    """Download (or reuse) the right-sized version of a Telegram photo for Claude. Returns path or None."""
+    p = pick_photo_size(sizes)
+    name = f"photo_{p.get('file_unique_id') or p['file_id'][-16:]}.jpg"
+    local = received_store.lookup(name) or download_telegram_file(p["file_id"], filename=name)
+    if not local:
+        return None
+    return prepare_image(local, IMAGE_PROMPT_PX)
+
+
+# ─── OCR ─────────────────────────────────────────────────────────
+# Optional local text extraction for images (attendance screenshots, booking tables, error
+# dialogs). Runs on its own pool while the task waits in the queue; the worker appends the
+# text next to the image path so Claude often needn't spend turns reading the image.
+OCR_LANGS = os.environ.get("OCR_LANGS", "chi_sim+eng")
+OCR_MIN_CHARS = 8           # less than this is treated as "no text"
+OCR_MAX_CHARS = 3000        # per image, in the prompt
+OCR_CACHE_FILE = SCRIPT_DIR / "ocr_cache.json"
+OCR_CACHE_MAX = 300
+OCR_IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+_ocr_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ocr")
+_ocr_cache = [None]         # OrderedDict content hash -> text, LRU first
+_ocr_lock = threading.Lock()
+_ocr_available = [None]     # tesseract binary check, done once
+
+
+def _ocr_ready():
+    if not (OCR_ENABLED and PIL_ENABLED):
+        return False
+    if _ocr_available[0] is None:
+        try:
+            pytesseract.get_tesseract_version()
+            _ocr_available[0] = True
+        except Exception as e:
+            log(f"OCR disabled — tesseract not usable: {e}")
+            _ocr_available[0] = False
+    return _ocr_available[0]
+
+
+def _ocr_cache_get(digest):
+    with _ocr_lock:
+        if _ocr_cache[0] is None:
+            try:
+                _ocr_cache[0] = OrderedDict(json.loads(OCR_CACHE_FILE.read_text(encoding="utf-8")))
+            except Exception:
+                _ocr_cache[0] = OrderedDict()
+        if digest in _ocr_cache[0]:
+            _ocr_cache[0].move_to_end(digest)
+            return _ocr_cache[0][digest]
+    return None
+
+
+def _ocr_cache_put(digest, text):
+    with _ocr_lock:
+        cache = _ocr_cache[0]
+        cache[digest] = text
+        while len(cache) > OCR_CACHE_MAX:
+            cache.popitem(last=False)
+        try:
+            tmp = OCR_CACHE_FILE.with_suffix(".tmp")
+            tmp.write_text(json.dumps(list(cache.items()), ensure_ascii=False), encoding="utf-8")
+            tmp.replace(OCR_CACHE_FILE)
+        except Exception as e:
+            log(f"OCR cache save error: {e}")
+
+
+def ocr_image(path):
+    """Text in an image (cached by content hash). Empty string if there's none."""
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:24]
+    cached = _ocr_cache_get(digest)
+    if cached is not None:
+        return cached
+    t0 = time.time()
+    with Image.open(path) as img:
+        raw = pytesseract.image_to_string(img, lang=OCR_LANGS)
+    lines = [re.sub(r"[ \t]+", " ", l).strip() for l in raw.splitlines()]
+    text = "\n".join(l for l in lines if l)
+    text = text if len(text) >= OCR_MIN_CHARS else ""
+    log(f"OCR {os.path.basename(path)}: {len(text)} chars in {time.time() - t0:.1f}s")
+    _ocr_cache_put(digest, text)
+    return text
+
+
+def image_read_note(paths):
+    """The instruction to look at images with the Read tool (used when there's no OCR text)."""
+    if len(paths) == 1:
+        return f"[图片已保存在: {paths[0]}。请务必用 Read 工具读取这个图片文件，看清楚图片内容后再回答。]"
+    return ("[请务必用 Read 工具逐一读取这些图片文件，看清楚内容后再回答:\n"
+            + "\n".join(paths) + "]")
+
+
+def _ocr_context(paths, photos):
+    blocks, blank = [], []
+    for path in paths:
+        try:
+            text = ocr_image(path)
+        except Exception as e:
+            log(f"OCR error ({os.path.basename(path)}): {e}")
+            text = ""
+        if text:
+            clipped = text[:OCR_MAX_CHARS] + ("…" if len(text) > OCR_MAX_CHARS else "")
+            blocks.append(f"[图片文字（本地 OCR 预提取，可能有识别错误）: {path}]\n{clipped}")
+        else:
+            blank.append(path)
+    if photos:
+        if blocks:
+            blocks.append("[以上是图片里识别出的文字，够用就直接回答；需要看版面、表格结构或照片本身时，"
+                          "再用 Read 工具读取对应图片。]")
+        if blank:
+            blocks.append(image_read_note(blank))
+    return "\n".join(blocks)
+
+
+def submit_ocr(paths, photos=False):
+    """Start OCR for the image paths in the background. Returns an (future, wait, fallback)
+    entry for the task's 'enrich' list, or None if OCR isn't available or nothing is an image.
+    photos=True: the user sent these to be looked at — the prompt then carries the OCR text
+    with "Read only if needed", and falls back to the mandatory Read note without it."""
+    paths = [p for p in paths if p and str(p).lower().endswith(OCR_IMAGE_EXTS)]
+    if not paths or not _ocr_ready():
+        return None
+    fallback = image_read_note(paths) if photos else ""
+    return _ocr_pool.submit(_ocr_context, paths, photos), ENRICH_WAIT_SEC, fallback
+
+
+# ─── Table Preview ──────────────────────────────────────────────
+# Spreadsheet/CSV/JSON attachments (HRMS attendance exports, supplier price lists) are read
+# in row windows on a background pool while the task is queued. The worker appends a compact
+# summary — schema, row count, per-column stats, sample rows — so Claude doesn't start by
+# writing parsing code. The full table is also saved as a plain UTF-8 CSV under
+# received_files/tables/ for follow-up questions; both are keyed by file content.
+PREVIEW_EXTS = (".csv", ".tsv", ".xlsx", ".xlsm", ".json", ".jsonl")
+PREVIEW_DIR = RECEIVED_TABLES_DIR     # evicted with the received files (ReceivedStore.gc)
+PREVIEW_WINDOW = 2000            # rows per window
+PREVIEW_SAMPLE_ROWS = 5
+PREVIEW_MAX_COLS = 40            # columns listed in the summary
+PREVIEW_DISTINCT_CAP = 200       # distinct values tracked per column
+PREVIEW_MAX_SEC = 120            # stop scanning (and say so) past this
+PREVIEW_JSON_MAX_BYTES = 30 * 1024 * 1024   # .json has to be parsed whole
+PREVIEW_MAX_CHARS = 5000
+_PREVIEW_NUM_RE = re.compile(r"^[-+]?(RM\s?)?\d[\d,]*(\.\d+)?%?$|^[-+]?\.\d+$", re.I)
+_PREVIEW_DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d %H:%M:%S",
+                         "%Y-%m-%d %H:%M", "%d/%m/%Y %H:%M", "%Y-%m-%dT%H:%M:%S")
+_preview_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="preview")
+
+
+def _preview_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    s = str(value).strip()
+    if not _PREVIEW_NUM_RE.match(s):
+        return None
+    try:
+        return float(re.sub(r"(?i)^([-+]?)RM\s?", r"\1", s).replace(",", "").rstrip("%"))
+    except ValueError:
+        return None
+
+
+def _preview_date(value):
+    if isinstance(value, datetime):
+        return value
+    s = str(value).strip()
+    if not 8 <= len(s) <= 19 or not s[:1].isdigit():
+        return None
+    for fmt in _PREVIEW_DATE_FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def _preview_cell(value):
+    """Cell as text for the CSV copy and samples."""
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S" if (value.hour or value.minute) else "%Y-%m-%d")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value).strip()
+
+
+class ColumnStats:
+    """Running stats for one column, updated a window at a time."""
+
+    def __init__(self, name):
+        self.name = name
+        self.filled = 0
+        self.numbers = 0
+        self.num_min = self.num_max = None
+        self.num_sum = 0.0
+        self.dates = 0
+        self.date_min = self.date_max = None
+        self.counts = {}          # value -> count, up to PREVIEW_DISTINCT_CAP values
+        self.overflow = False
+
+    def add(self, raw, text):
+        if text == "":
+            return
+        self.filled += 1
+        num = _preview_number(raw)
+        if num is not None:
+            self.numbers += 1
+            self.num_sum += num
+            self.num_min = num if self.num_min is None else min(self.num_min, num)
+            self.num_max = num if self.num_max is None else max(self.num_max, num)
+        else:
+            d = _preview_date(raw)
+            if d is not None:
+                self.dates += 1
+                self.date_min = d if self.date_min is None else min(self.date_min, d)
+                self.date_max = d if self.date_max is None else max(self.date_max, d)
+        if text in self.counts:
+            self.counts[text] += 1
+        elif len(self.counts) < PREVIEW_DISTINCT_CAP:
+            self.counts[text] = 1
+        else:
+            self.overflow = True
+
+    def describe(self, rows):
+        empty = rows - self.filled
+        parts = []
+        if self.filled and self.numbers >= 0.9 * self.filled:
+            mean = self.num_sum / self.numbers
+            parts.append(f"数字, {self.num_min:g} ~ {self.num_max:g}, 平均 {mean:.6g}")
+        elif self.filled and self.dates >= 0.9 * self.filled:
+            fmt = "%Y-%m-%d %H:%M" if any(d.hour or d.minute for d in (self.date_min, self.date_max)) else "%Y-%m-%d"
+            parts.append(f"日期, {self.date_min.strftime(fmt)} ~ {self.date_max.strftime(fmt)}")
+        else:
+            parts.append("文本")
+        distinct = f"{PREVIEW_DISTINCT_CAP}+" if self.overflow else str(len(self.counts))
+        parts.append(f"{distinct} 种值")
+        if empty:
+            parts.append(f"空 {empty}")
+        line = f"- {self.name} ({', '.join(parts)})"
+        if self.counts and not self.overflow and len(self.counts) <= 20 and parts[0] == "文本":
+            top = sorted(self.counts.items(), key=lambda kv: -kv[1])[:4]
+            line += " 常见: " + ", ".join(f"{v[:20]}×{c}" for v, c in top)
+        return line
+
+
+def _sniff_text_file(path, ext):
+    """(encoding, delimiter) for a delimited text file, from its first 256KB."""
+    with open(path, "rb") as f:
+        head = f.read(256 * 1024)
+    encoding = "latin-1"
+    for enc in ("utf-8-sig", "gb18030"):
+        try:
+            codecs.getincrementaldecoder(enc)().decode(head, final=False)
+            encoding = enc
+            break
+        except UnicodeDecodeError:
+            continue
+    sample = head.decode(encoding, errors="ignore")[:64 * 1024]
+    try:
+        delimiter = csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        delimiter = "\t" if ext == ".tsv" else ","
+    return encoding, delimiter
+
+
+def _open_table(path):
+    """(rows iterator, note) for a supported file, or (None, reason)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".csv", ".tsv"):
+        encoding, delimiter = _sniff_text_file(path, ext)
+        f = open(path, encoding=encoding, errors="replace", newline="")
+        note = f"编码 {encoding.replace('-sig', '')}, 分隔符 {delimiter!r}"
+        return _closing_rows(csv.reader(f, delimiter=delimiter), f), note
+    if ext in (".xlsx", ".xlsm"):
+        if not XLSX_ENABLED:
+            return None, "未安装 openpyxl"
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        ws = wb.active
+        others = [name for name in wb.sheetnames if name != ws.title]
+        note = f"工作表 {ws.title}" + (f"（另有: {', '.join(others)}）" if others else "")
+        return _closing_rows(ws.iter_rows(values_only=True), wb), note
+    if ext == ".jsonl":
+        f = open(path, encoding="utf-8", errors="replace")
+        return _closing_rows(_json_records(json.loads(l) for l in f if l.strip()), f), "JSON Lines"
+    if ext == ".json":
+        if os.path.getsize(path) > PREVIEW_JSON_MAX_BYTES:
+            return None, "JSON 文件太大"
+        with open(path, encoding="utf-8", errors="replace") as f:
+            data = json.load(f)
+        if isinstance(data, dict):   # {"data": [...]} style: take the largest list of objects
+            lists = [(k, v) for k, v in data.items() if isinstance(v, list) and v and isinstance(v[0], dict)]
+            if not lists:
+                return None, "JSON 里没有记录列表"
+            key, data = max(lists, key=lambda kv: len(kv[1]))
+            return _json_records(data), f"JSON 字段 {key}"
+        if isinstance(data, list) and data and isinstance(data[0], dict):
+            return _json_records(data), "JSON 数组"
+        return None, "JSON 不是记录列表"
+    return None, "不支持的格式"
+
+
+def _closing_rows(rows, handle):
+    try:
+        yield from rows
+    finally:
+        handle.close()
+
+
+def _json_records(records):
+    """JSON objects → header row then value rows. Columns come from the first window;
+    keys that only show up later are left out."""
+    records = iter(records)
+    first = [r for r in islice(records, PREVIEW_WINDOW) if isinstance(r, dict)]
+    columns = list(dict.fromkeys(k for r in first for k in r))
+    yield columns
+    for r in first:
+        yield [r.get(k) for k in columns]
+    for r in records:
+        if isinstance(r, dict):
+            yield [r.get(k) for k in columns]
+
+
+def _find_header(head_rows):
+    """Index of the header among the first rows: exports often start with a title line or two,
+    so take the first row about as wide as the widest one."""
+    widths = [sum(1 for v in row if _preview_cell(v)) for row in head_rows]
+    widest = max(widths, default=0)
+    for i, w in enumerate(widths):
+        if w and w >= max(2, widest // 2):
+            return i
+    return 0
+
+
+def _header_names(row):
+    names, seen = [], {}
+    for i, v in enumerate(row, 1):
+        name = _preview_cell(v) or f"列{i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}_{seen[name]}"
+        else:
+            seen[name] = 1
+        names.append(name)
+    return names
+
+
+def scan_table(path, csv_out):
+    """Read a table in windows of PREVIEW_WINDOW rows, writing it to csv_out as UTF-8 CSV.
+    Returns the summary text (without the file-name line), or None if unsupported."""
+    rows, note = _open_table(path)
+    if rows is None:
+        log(f"Table preview skipped ({os.path.basename(path)}): {note}")
+        return None
+    t0 = time.time()
+    samples, count, truncated = [], 0, False
+    tmp = csv_out.with_suffix(".part")
+    try:
+        head = list(islice(rows, 10))
+        h = _find_header(head)
+        columns = _header_names(head[h]) if head else []
+        width = max((len(r) for r in head), default=0)
+        columns += [f"列{i + 1}" for i in range(len(columns), width)]
+        stats = [ColumnStats(c) for c in columns]
+        with open(tmp, "w", encoding="utf-8", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            pending = head[h + 1:]
+            while pending:
+                for row in pending:
+                    cells = [_preview_cell(v) for v in row]
+                    if not any(cells):
+                        continue
+                    count += 1
+                    for st, raw, text in zip(stats, row, cells):
+                        st.add(raw, text)
+                    if len(samples) < PREVIEW_SAMPLE_ROWS:
+                        samples.append(cells)
+                    writer.writerow(cells)
+                if time.time() - t0 > PREVIEW_MAX_SEC:
+                    truncated = True
+                    break
+                pending = list(islice(rows, PREVIEW_WINDOW))
+        tmp.replace(csv_out)
+    finally:
+        rows.close()
+        if tmp.exists():
+            tmp.unlink()
+    log(f"Table preview {os.path.basename(path)}: {count} rows × {len(columns)} cols "
+        f"in {time.time() - t0:.1f}s{' (truncated)' if truncated else ''}")
+
+    lines = [f"{note}；{'至少 ' if truncated else '共 '}{count} 行 × {len(columns)} 列"
+             + ("（读取超时，只统计了前面部分）" if truncated else ""),
+             f"完整表格已转为 UTF-8 CSV（表头在第一行）: {csv_out}",
+             "列:"]
+    lines += [st.describe(count) for st in stats[:PREVIEW_MAX_COLS]]
+    if len(stats) > PREVIEW_MAX_COLS:
+        lines.append(f"- …另有 {len(stats) - PREVIEW_MAX_COLS} 列")
+    if samples:
+        lines.append(f"前 {len(samples)} 行:")
+        lines.append(" | ".join(columns[:PREVIEW_MAX_COLS]))
+        lines += [" | ".join(c[:30] for c in row[:PREVIEW_MAX_COLS]) for row in samples]
+    summary = "\n".join(lines)
+    return summary[:PREVIEW_MAX_CHARS] + ("…" if len(summary) > PREVIEW_MAX_CHARS else "")
+
+
+def _preview_key(path):
+    """Content key for a table's preview files: the store blob name already is one
+    (sha256[:20]), anything else is hashed."""
+    p = Path(path)
+    if p.parent == RECEIVED_STORE_DIR and re.fullmatch(r"[0-9a-f]{20}", p.stem):
+        return p.stem
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()[:20]
+
+
+def table_preview(path, name=None, key=None):
+    """Prompt block for a table attachment, from cache when the same content was seen before."""
+    key = key or _preview_key(path)
+    PREVIEW_DIR.mkdir(parents=True, exist_ok=True)
+    summary_file = PREVIEW_DIR / f"{key}.json"
+    csv_out = PREVIEW_DIR / f"{key}.csv"
+    try:
+        summary = json.loads(summary_file.read_text(encoding="utf-8"))["summary"]
+        if not csv_out.exists():
+            raise FileNotFoundError(csv_out)
+        os.utime(summary_file)
+        log(f"Table preview cache hit: {name or os.path.basename(path)}")
+    except Exception:
+        summary = scan_table(path, csv_out)
+        if summary is None:
+            return ""
+        tmp = summary_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"summary": summary, "source": name or os.path.basename(path)},
+                                  ensure_ascii=False), encoding="utf-8")
+        tmp.replace(summary_file)
+    return f"[表格预览（本地解析）: {name or os.path.basename(path)}]\n{summary}"
+
+
+def _table_preview_safe(path, name, key):
+    try:
+        return table_preview(path, name, key)
+    except Exception as e:
+        log(f"Table preview error ({name}): {e}")
+        return ""
+
+
+def submit_table_preview(path, name=None):
+    """Start a table preview in the background. Returns an (future, wait, fallback) entry for
+    the task's 'enrich' list, or None if the file isn't a table. The worker only waits the
+    usual ENRICH_WAIT_SEC; a large export keeps converting and Claude is pointed at the CSV."""
+    if not path or not str(name or path).lower().endswith(PREVIEW_EXTS):
+        return None
+    try:
+        key = _preview_key(path)
+    except OSError as e:
+        log(f"Table preview error ({name}): {e}")
+        return None
+    csv_out = PREVIEW_DIR / f"{key}.csv"
+    fallback = (f"[表格 {name or os.path.basename(path)} 正在后台转为 UTF-8 CSV（表头在第一行）: {csv_out}"
+                f"——文件出现即转换完成；若不存在，请直接读取原文件]")
+    return _preview_pool.submit(_table_preview_safe, path, name, key), ENRICH_WAIT_SEC, fallback
+
+
+# ─── Albums (Media Groups) ──────────────────────────────────────
+# Telegram delivers an album as separate updates sharing a media_group_id, with the caption
+# on only one of them. Items are buffered until ALBUM_WINDOW_SEC passes without a new one,
+# then downloaded in parallel and queued as a single task.
+ALBUM_WINDOW_SEC = 1.5
+_albums = {}   # media_group_id -> {"chat_id", "caption", "items": [(kind, payload)], "timer"}
+_albums_lock = threading.Lock()
+
+
+def buffer_album_item(msg, chat_id):
+    """Add a photo/document update to its album buffer. False if the update isn't one."""
+    if msg.get("photo"):
+        item = ("photo", msg["photo"])
+    elif msg.get("document"):
+        item = ("document", msg["document"])
+    else:
+        return False
+    group_id = msg["media_group_id"]
+    with _albums_lock:
+        album = _albums.setdefault(group_id, {"chat_id": chat_id, "caption": "", "items": [], "timer": None})
+        album["items"].append(item)
+        album["caption"] = album["caption"] or (msg.get("caption") or "").strip()
+        if album["timer"]:
+            album["timer"].cancel()
+        album["timer"] = threading.Timer(ALBUM_WINDOW_SEC, _flush_album, (group_id,))
+        album["timer"].daemon = True
+        album["timer"].start()
+    return True
+
+
+def _download_album_item(item):
+    kind, payload = item
+    if kind == "photo":
+        return kind, None, prepare_incoming_photo(payload)
+    name = payload.get("file_name", "file")
+    return kind, name, download_telegram_file(payload["file_id"], filename=name)
+
+
+def _flush_album(group_id):
+    with _albums_lock:
+        album = _albums.pop(group_id, None)
+    if not album:
+        return
+    try:
+        results = list(_fetch_pool.map(_download_album_item, album["items"]))
+        photos = [path for kind, _, path in results if kind == "photo" and path]
+        docs = [(name, path) for kind, name, path in results if kind == "document" and path]
+        failed = sum(1 for *_, path in results if not path)
+        log(f"Album {group_id}: {len(photos)} photo(s), {len(docs)} file(s), {failed} failed")
+        if not photos and not docs:
+            send_msg("相册下载失败了，请重新发送", chat_id=album["chat_id"])
+            return
+        parts = [album["caption"]] if album["caption"] else []
+        # With OCR the Read instruction comes with its result (see _ocr_context)
+        photo_ocr = submit_ocr(photos, photos=True)
+        if photos:
+            listing = "\n".join(f"{i}. {p}" for i, p in enumerate(photos, 1))
+            read_note = "" if photo_ocr else "\n请务必用 Read 工具逐一读取这些图片文件，看清楚内容后再回答。"
+            parts.append(f"[用户一次发了 {len(photos)} 张图片（同一相册），已保存在:\n{listing}{read_note}]")
+        for name, path in docs:
+            parts.append(f"[用户发了文件 {name}，已保存在: {path}]")
+        if failed:
+            parts.append(f"[另有 {failed} 个文件下载失败]")
+        enrich = [photo_ocr, submit_ocr([path for _, path in docs])]
+        enrich += [submit_table_preview(path, name) for name, path in docs]
+        _enqueue_task("\n".join(parts), album["chat_id"], enrich=[f for f in enrich if f])
+    except Exception as e:
+        log(f"Album {group_id} error: {e}")
+
+
 # ─── Voice Transcription ────────────────────────────────────────
-def download_voice(file_id):
-    """Download voice message from Telegram and return local path."""
+# Voice notes stay in memory end to end (Telegram → bytes → Groq, or → WAV buffer →
+# Google). Each message's per-stage timings go to voice_timings.
+VOICE_MAX_BYTES = 20 * 1024 * 1024   # Bot API download limit
+VOICE_TIMINGS_MAX = 50
+voice_timings = deque(maxlen=VOICE_TIMINGS_MAX)   # recent {"bytes", stage: sec, ...}
+_groq_client = [None]
+_groq_client_lock = threading.Lock()
+
+
+def _get_groq_client():
+    """Module-level Groq client, created on first use. Its HTTP pool is kept alive between
+    voice notes (httpx's default 5s keep-alive would reconnect for almost every message)."""
+    if _groq_client[0] is None:
+        with _groq_client_lock:
+            if _groq_client[0] is None:
+                kwargs = {}
+                try:
+                    import httpx  # groq's own HTTP dependency
+                    kwargs["http_client"] = httpx.Client(
+                        timeout=60.0,
+                        limits=httpx.Limits(max_connections=4, max_keepalive_connections=2, keepalive_expiry=300),
+                    )
+                except ImportError:
+                    pass
+                _groq_client[0] = GroqClient(api_key=GROQ_API_KEY, max_retries=2, **kwargs)
+    return _groq_client[0]
+
+
+def _download_to_memory(url, timeout=30, limit=VOICE_MAX_BYTES):
+    """Stream a URL into memory in chunks. Returns bytes."""
+    buf = io.BytesIO()
+    req = urllib.request.Request(url)
+    with urllib.request.urlopen(req, timeout=timeout, context=SSL_CTX) as r:
+        while True:
+            chunk = r.read(64 * 1024)
+            if not chunk:
+                break
+            buf.write(chunk)
+            if buf.tell() > limit:
+                raise ValueError(f"file larger than {limit // 1024 // 1024}MB")
+    return buf.getvalue()
+
+
+def download_voice(file_id, timings=None):
+    """Download voice message from Telegram into memory. Returns OGG bytes or None."""
+    t0 = time.time()
     resp = tg_api("getFile", {"file_id": file_id})
     if not resp.get("ok"):
         return None
     file_path = resp["result"]["file_path"]
     url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
 
-    tmp = tempfile.NamedTemporaryFile(suffix=".ogg", delete=False)
     try:
-        req = urllib.request.Request(url)
-        with urllib.request.urlopen(req, timeout=30, context=SSL_CTX) as r:
-            tmp.write(r.read())
-        tmp.close()
-        return tmp.name
+        data = _download_to_memory(url)
     except Exception as e:
         log(f"Voice download error: {e}")
         return None
+    if timings is not None:
+        timings["download"] = time.time() - t0
+        timings["bytes"] = len(data)
+    return data
 
 
-def _recognize_with_timeout(recognizer, audio_data, lang, timeout=30):
-    """Run speech recognition with a timeout to prevent hanging."""
-    result = [None]
-    error = [None]
+def log_voice_timings(timings):
+    """Record one voice note's stage timings and log them on one line."""
+    voice_timings.append(dict(timings, ts=time.time()))
+    stages = " ".join(f"{k}={v:.2f}s" for k, v in timings.items() if isinstance(v, float))
+    log(f"Voice timings: {timings.get('bytes', 0) / 1024:.0f}KB {stages}")
 
-    def _worker():
-        try:
-            result[0] = recognizer.recognize_google(audio_data, language=lang)
-        except sr.UnknownValueError:
-            pass
-        except Exception as e:
-            error[0] = e
 
-    t = threading.Thread(target=_worker)
-    t.daemon = True
-    t.start()
-    t.join(timeout)
+GOOGLE_STT_LANGS = ["zh-CN", "en-US"]    # tried concurrently; earlier = preferred on a tie
+GOOGLE_STT_TIMEOUT = 30
+GOOGLE_STT_MIN_CONFIDENCE = 0.6          # a result at least this confident wins immediately
+_stt_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stt")
+
 
-    if t.is_alive():
-        log(f"Speech recognition timed out ({lang}, {timeout}s)")
+def _recognize_google(recognizer, audio_data, lang):
+    """One Google STT attempt. Returns (text, confidence) or None if nothing was recognized.
+    Google omits confidence for some results; those count as 0.5."""
+    try:
+        result = recognizer.recognize_google(audio_data, language=lang, show_all=True)
+    except sr.UnknownValueError:
+        return None
+    except Exception as e:
+        log(f"Speech recognition error ({lang}): {e}")
         return None
-    if error[0]:
-        log(f"Speech recognition error ({lang}): {error[0]}")
+    alternatives = result.get("alternative") if isinstance(result, dict) else None
+    if not alternatives or not alternatives[0].get("transcript"):
         return None
-    return result[0]
+    best = alternatives[0]
+    return best["transcript"], float(best.get("confidence", 0.5))
 
 
-def _transcribe_with_groq(ogg_path):
-    """Use Groq Whisper-large-v3 for transcription. Handles Chinese + English + Malay mixed."""
+def _transcribe_with_groq(audio, filename="voice.ogg", timings=None):
+    """Use Groq Whisper-large-v3 for transcription. Handles Chinese + English + Malay mixed.
+    audio: bytes. Upload and transcription are one HTTP request, timed together as "groq"."""
     if not GROQ_ENABLED or not GROQ_API_KEY:
         return None
+    t0 = time.time()
     try:
-        client = GroqClient(api_key=GROQ_API_KEY)
-        with open(ogg_path, "rb") as f:
-            result = client.audio.transcriptions.create(
-                file=(os.path.basename(ogg_path), f.read()),
-                model="whisper-large-v3",
-                response_format="text",
-                language=None,  # auto-detect: handles Chinese/English/Malay mix
-            )
+        result = _get_groq_client().audio.transcriptions.create(
+            file=(filename, audio),
+            model="whisper-large-v3",
+            response_format="text",
+            language=None,  # auto-detect: handles Chinese/English/Malay mix
+        )
         text = str(result).strip() if result else ""
         if text:
             log(f"Groq Whisper recognized: {text[:80]}...")
@@ -483,52 +1380,316 @@ def _transcribe_with_groq(ogg_path):
     except Exception as e:
         log(f"Groq transcription error: {e}")
         return None
+    finally:
+        if timings is not None:
+            timings["groq"] = time.time() - t0
 
 
-def _transcribe_with_google(ogg_path):
-    """Fallback: Google Speech Recognition (free, less accurate)."""
+def _transcribe_with_google(audio, timings=None):
+    """Fallback: Google Speech Recognition (free, less accurate). audio: OGG bytes.
+    Decoded to WAV in memory; all GOOGLE_STT_LANGS run concurrently on the STT pool and the
+    first confident result wins (otherwise the most confident one within the timeout)."""
     if not VOICE_ENABLED:
         return None
-    wav_path = ogg_path.replace(".ogg", ".wav")
+    t0 = time.time()
     try:
-        audio = AudioSegment.from_ogg(ogg_path)
-        audio.export(wav_path, format="wav")
+        wav = io.BytesIO()
+        AudioSegment.from_file(io.BytesIO(audio), format="ogg").export(wav, format="wav")
+        wav.seek(0)
         recognizer = sr.Recognizer()
-        with sr.AudioFile(wav_path) as source:
+        with sr.AudioFile(wav) as source:
             audio_data = recognizer.record(source)
-        for lang in ["zh-CN", "en-US"]:
-            text = _recognize_with_timeout(recognizer, audio_data, lang, timeout=30)
-            if text:
-                log(f"Google STT recognized ({lang}): {text[:60]}...")
-                return text
-        return None
+
+        futures = {_stt_pool.submit(_recognize_google, recognizer, audio_data, lang): lang
+                   for lang in GOOGLE_STT_LANGS}
+        pending, results = set(futures), {}
+        deadline = t0 + GOOGLE_STT_TIMEOUT
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+            if not done:
+                log(f"Speech recognition timed out ({', '.join(futures[f] for f in pending)}, {GOOGLE_STT_TIMEOUT}s)")
+                break
+            for f in done:
+                if f.result():
+                    results[futures[f]] = f.result()
+            confident = [lang for lang in GOOGLE_STT_LANGS
+                         if lang in results and results[lang][1] >= GOOGLE_STT_MIN_CONFIDENCE]
+            if confident:
+                break
+        for f in pending:
+            f.cancel()  # only stops attempts still queued; running ones finish in the background
+        if not results:
+            return None
+        lang = max(results, key=lambda l: (results[l][1], -GOOGLE_STT_LANGS.index(l)))
+        text, confidence = results[lang]
+        log(f"Google STT recognized ({lang}, {confidence:.2f}): {text[:60]}...")
+        return text
     except Exception as e:
         log(f"Google STT error: {e}")
         return None
     finally:
+        if timings is not None:
+            timings["google"] = time.time() - t0
+
+
+# ── Long voice notes: split at silences, transcribe chunks in parallel, stitch ──
+VOICE_LONG_SEC = 75            # notes longer than this are split
+VOICE_CHUNK_MIN_MS = 20_000    # never cut earlier than this into a chunk
+VOICE_CHUNK_TARGET_MS = 40_000
+VOICE_CHUNK_MAX_MS = 55_000    # hard cut (at the quietest frame) if no silence before this
+VOICE_CHUNK_OVERLAP_MS = 600   # each side of a cut, so a word split by a hard cut survives
+VOICE_FRAME_MS = 50
+VOICE_SILENCE_OFFSET_DB = 16   # silence = this much quieter than the note's average loudness
+STITCH_MAX_OVERLAP_TOKENS = 12
+_voice_chunk_pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="voice-chunk")
+_STITCH_TOKEN_RE = re.compile(r'[\u3400-\u9fff]|[A-Za-z0-9\']+')
+
+
+def plan_voice_chunks(levels, frame_ms=VOICE_FRAME_MS, silence_db=-40.0, min_ms=VOICE_CHUNK_MIN_MS,
+                      target_ms=VOICE_CHUNK_TARGET_MS, max_ms=VOICE_CHUNK_MAX_MS,
+                      overlap_ms=VOICE_CHUNK_OVERLAP_MS):
+    """Plan chunk boundaries from a loudness envelope (dBFS per frame; -inf for digital silence).
+    Each cut goes in the middle of the longest silent run between min_ms and max_ms into the
+    chunk (ties → closest to target_ms), or at the quietest frame if there is no silence.
+    Returns [(start_ms, end_ms)], each widened by overlap_ms around interior cuts."""
+    total_ms = len(levels) * frame_ms
+    cuts, start = [], 0
+    while total_ms - start > max_ms:
+        lo = (start + min_ms) // frame_ms
+        hi = min(len(levels), (start + max_ms) // frame_ms)
+        best, run_start = None, None
+        for i in range(lo, hi + 1):
+            silent = i < hi and levels[i] < silence_db
+            if silent and run_start is None:
+                run_start = i
+            elif not silent and run_start is not None:
+                mid = (run_start + i) // 2
+                key = (i - run_start, -abs(mid * frame_ms - start - target_ms))
+                if best is None or key > best[0]:
+                    best = (key, mid)
+                run_start = None
+        cut_frame = best[1] if best else min(
+            range(lo, hi), key=lambda i: (levels[i], abs(i * frame_ms - start - target_ms)))
+        cut = cut_frame * frame_ms
+        cuts.append(cut)
+        start = cut
+    bounds = [0] + cuts + [total_ms]
+    return [(max(0, a - overlap_ms) if a else 0, min(total_ms, b + overlap_ms) if b < total_ms else total_ms)
+            for a, b in zip(bounds, bounds[1:])]
+
+
+def stitch_transcripts(parts, durations=None, overlap_ms=VOICE_CHUNK_OVERLAP_MS):
+    """Join chunk transcripts in order, dropping text repeated across a boundary: the longest
+    run of ≥2 tokens that ends one part and starts the next, as long as it fits in the audio
+    the two chunks share (2 × overlap_ms, in tokens at each chunk's own speech rate when
+    durations are given) and leaves something of the next part. None parts → "…"."""
+    out, prev = "", []
+    for i, part in enumerate(parts):
+        part = (part or "…").strip()
+        spans = list(_STITCH_TOKEN_RE.finditer(part))
+        nxt = [m.group().lower() for m in spans]
+        if not out:
+            out, prev = part, nxt
+            continue
+        k = min(STITCH_MAX_OVERLAP_TOKENS, len(prev), len(nxt) - 1)
+        if durations:
+            window = 2 * overlap_ms
+            k = min(k, math.ceil(len(prev) * window / max(durations[i - 1], window)) + 1,
+                    math.ceil(len(nxt) * window / max(durations[i], window)) + 1)
+        while k >= 2 and prev[-k:] != nxt[:k]:
+            k -= 1
+        if k >= 2:
+            part = part[spans[k - 1].end():].lstrip(" ,，.。、")
+        prev = nxt
+        cjk_edge = any("\u3400" <= c <= "\u9fff" or c in "，。、" for c in (out[-1], part[0]))
+        out += ("" if cjk_edge else " ") + part
+    return out
+
+
+def transcribe_long_voice(segment, transcriber, timings=None):
+    """Split a pydub AudioSegment at silences and transcribe the chunks in parallel.
+    transcriber(ogg_bytes, timings) -> str | None. Returns stitched text or None if every
+    chunk failed."""
+    t0 = time.time()
+    levels = [segment[i:i + VOICE_FRAME_MS].dBFS for i in range(0, len(segment), VOICE_FRAME_MS)]
+    plan = plan_voice_chunks(levels, silence_db=segment.dBFS - VOICE_SILENCE_OFFSET_DB)
+
+    chunks = [encode_voice(segment[a:b]) for a, b in plan]
+    chunk_timings = [{} for _ in plan]
+    parts = list(_voice_chunk_pool.map(transcriber, chunks, chunk_timings))
+    if timings is not None:
+        # Chunks run in parallel, so the note waited as long as its slowest chunk
+        for key in ("groq", "google"):
+            spent = [t[key] for t in chunk_timings if key in t]
+            if spent:
+                timings[key] = max(spent)
+        timings["bytes_sent"] = sum(len(c) for c in chunks)
+        timings["chunks"] = len(plan)
+        timings["chunked"] = time.time() - t0
+    log(f"Long voice: {len(segment) / 1000:.0f}s → {len(plan)} chunks, "
+        f"{sum(1 for p in parts if p)} transcribed in {time.time() - t0:.1f}s")
+    if not any(parts):
+        return None
+    return stitch_transcripts(parts, [b - a for a, b in plan])
+
+
+# ── Preprocessing: mono 16 kHz, trimmed, re-encoded as low-bitrate Opus before upload ──
+VOICE_PREPROCESS = os.environ.get("VOICE_PREPROCESS", "1") != "0"   # 0 = send the original OGG
+VOICE_SAMPLE_RATE = 16000        # what Whisper resamples to anyway
+VOICE_OPUS_BITRATE = "20k"
+VOICE_TRIM_PAD_MS = 200          # silence kept at each end
+
+
+def preprocess_voice(segment):
+    """Downmix to mono, resample to VOICE_SAMPLE_RATE and trim leading/trailing silence."""
+    segment = segment.set_channels(1).set_frame_rate(VOICE_SAMPLE_RATE)
+    thresh = segment.dBFS - VOICE_SILENCE_OFFSET_DB
+    lead = detect_leading_silence(segment, silence_threshold=thresh, chunk_size=10)
+    tail = detect_leading_silence(segment.reverse(), silence_threshold=thresh, chunk_size=10)
+    if lead + tail < len(segment):
+        segment = segment[max(0, lead - VOICE_TRIM_PAD_MS):len(segment) - max(0, tail - VOICE_TRIM_PAD_MS)]
+    return segment
+
+
+def encode_voice(segment):
+    buf = io.BytesIO()
+    segment.export(buf, format="ogg", codec="libopus", bitrate=VOICE_OPUS_BITRATE,
+                   parameters=["-application", "voip"])
+    return buf.getvalue()
+
+
+def voice_stats_line():
+    """Preprocessing effect over recent voice notes (for /health)."""
+    notes = [t for t in voice_timings if "groq" in t]
+    if not notes:
+        return "暂无记录"
+    pre = [t for t in notes if t.get("bytes_sent", t.get("bytes")) < t.get("bytes", 0)]
+    raw = [t for t in notes if t not in pre]
+    parts = [f"近 {len(notes)} 条"]
+    if pre:
+        saved = sum(t["bytes"] - t["bytes_sent"] for t in pre) / sum(t["bytes"] for t in pre) * 100
+        parts.append(f"预处理省 {saved:.0f}% 流量，识别均 {sum(t['groq'] for t in pre) / len(pre):.1f}s")
+    if raw:
+        parts.append(f"原始上传识别均 {sum(t['groq'] for t in raw) / len(raw):.1f}s")
+    return "，".join(parts)
+
+
+def _transcribe_blob(audio, timings=None):
+    # 优先用 Groq Whisper (高精度，支持华语/英语/马来语混合)
+    text = _transcribe_with_groq(audio, timings=timings)
+    if text:
+        return text
+    # 备用: Google Speech Recognition
+    log("Groq failed or unavailable, trying Google STT...")
+    return _transcribe_with_google(audio, timings=timings)
+
+
+def transcribe_voice(audio, timings=None, duration=None):
+    """Convert OGG voice (bytes) to text. Uses Groq Whisper first, falls back to Google STT.
+    The note is preprocessed first (see preprocess_voice) when that makes the upload smaller;
+    notes longer than VOICE_LONG_SEC (Telegram's duration field) are split and done in parallel."""
+    timings = {} if timings is None else timings
+    long_note = bool(duration and duration > VOICE_LONG_SEC)
+    if VOICE_ENABLED and (VOICE_PREPROCESS or long_note):
         try:
-            os.unlink(wav_path)
-        except Exception:
-            pass
+            t0 = time.time()
+            segment = AudioSegment.from_file(io.BytesIO(audio), format="ogg")
+            if VOICE_PREPROCESS:
+                segment = preprocess_voice(segment)
+            if long_note:
+                timings["preprocess"] = time.time() - t0
+                return transcribe_long_voice(segment, _transcribe_blob, timings)
+            encoded = encode_voice(segment)
+            timings["preprocess"] = time.time() - t0
+            if len(encoded) < len(audio):
+                timings["bytes_sent"] = len(encoded)
+                log(f"Voice preprocessed: {len(audio) / 1024:.0f}KB → {len(encoded) / 1024:.0f}KB "
+                    f"(-{(1 - len(encoded) / len(audio)) * 100:.0f}%), {len(segment) / 1000:.1f}s audio")
+                audio = encoded
+        except Exception as e:
+            log(f"Voice preprocessing failed, using original audio: {e}")
+    return _transcribe_blob(audio, timings)
 
 
-def transcribe_voice(ogg_path):
-    """Convert OGG voice to text. Uses Groq Whisper first, falls back to Google STT."""
-    try:
-        # 优先用 Groq Whisper (高精度，支持华语/英语/马来语混合)
-        text = _transcribe_with_groq(ogg_path)
-        if text:
-            return text
-        # 备用: Google Speech Recognition
-        log("Groq failed or unavailable, trying Google STT...")
-        text = _transcribe_with_google(ogg_path)
-        return text
-    finally:
-        # 清理原始 OGG 文件
+# ── Transcript cache: forwarded / re-sent voice notes cost no download or API call ──
+TRANSCRIPT_CACHE_FILE = SCRIPT_DIR / "transcript_cache.json"
+TRANSCRIPT_CACHE_MAX = 500
+TRANSCRIPT_CACHE_MAX_AGE_DAYS = 90
+
+
+class TranscriptCache:
+    """Persistent LRU of voice transcripts keyed by Telegram file_unique_id, with a content-hash
+    index as fallback (the same audio re-uploaded gets a new file_unique_id).
+    Bounded by entry count and by age since last use."""
+
+    def __init__(self, path, max_entries=TRANSCRIPT_CACHE_MAX, max_age_days=TRANSCRIPT_CACHE_MAX_AGE_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._entries = None   # OrderedDict uid -> {"text", "hash", "used"}, LRU first
+        self._by_hash = {}
+
+    @staticmethod
+    def content_hash(audio):
+        return hashlib.sha256(audio).hexdigest()[:24]
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
         try:
-            os.unlink(ogg_path)
+            rows = json.loads(self.path.read_text(encoding="utf-8"))
         except Exception:
-            pass
+            rows = []
+        for row in sorted(rows, key=lambda r: r.get("used", 0)):
+            self._entries[row["uid"]] = {"text": row["text"], "hash": row.get("hash", ""), "used": row.get("used", 0)}
+        self._prune()
+
+    def _prune(self):
+        cutoff = time.time() - self.max_age
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or next(iter(self._entries.values()))["used"] < cutoff):
+            self._entries.popitem(last=False)
+        self._by_hash = {e["hash"]: uid for uid, e in self._entries.items() if e["hash"]}
+
+    def _save(self):
+        rows = [{"uid": uid, **e} for uid, e in self._entries.items()]
+        try:
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(rows, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(self.path)
+        except Exception as e:
+            log(f"Transcript cache save error: {e}")
+
+    def _touch(self, uid):
+        entry = self._entries[uid]
+        entry["used"] = time.time()
+        self._entries.move_to_end(uid)
+        self._save()
+        return entry["text"]
+
+    def get(self, uid=None, audio_hash=None):
+        """Cached transcript by file_unique_id, else by content hash; None on a miss."""
+        with self._lock:
+            self._load()
+            if uid and uid in self._entries:
+                return self._touch(uid)
+            if audio_hash and audio_hash in self._by_hash:
+                return self._touch(self._by_hash[audio_hash])
+            return None
+
+    def put(self, uid, audio_hash, text):
+        with self._lock:
+            self._load()
+            uid = uid or f"hash:{audio_hash}"
+            self._entries[uid] = {"text": text, "hash": audio_hash or "", "used": time.time()}
+            self._entries.move_to_end(uid)
+            self._prune()
+            self._save()
+
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_FILE)
 
 
 # ─── Self-Heal System (v2) ──────────────────────────────────────
@@ -1058,13 +2219,106 @@ def run_diagnose():
     return "\n".join(results)
 
 
+# ─── History Records ─────────────────────────────────────────────
+HISTORY_USER_MAX = 200   # chars of the boss's message shown per exchange
+HISTORY_RESP_MAX = 300   # chars of the reply shown per exchange
+
+# Legacy format written by older versions: "[03/02 11:17] 老板: ... → 秘书: ..."
+_LEGACY_HISTORY_RE = re.compile(
+    r'^\[(\d{2})/(\d{2}) (\d{2}):(\d{2})\] 老板: (.*?) → 秘书: (.*)$', re.DOTALL
+)
+
+
+class HistoryRecord:
+    """One boss ↔ secretary exchange.
+    Persisted in memory.json as a compact row [ts, chat, user, response, model, elapsed, code];
+    rendered to the "[mm/dd HH:MM] 老板: … → 秘书: …" line only when building prompts."""
+
+    __slots__ = ("ts", "chat", "user", "response", "model", "elapsed", "code")
+
+    def __init__(self, ts, chat="", user="", response="", model="", elapsed=0.0, code=""):
+        self.ts = int(ts)
+        self.chat = str(chat or "")
+        self.user = user or ""
+        self.response = response or ""
+        self.model = model or ""
+        self.elapsed = round(float(elapsed or 0), 1)
+        self.code = code or ""
+
+    @classmethod
+    def from_legacy(cls, line):
+        """Parse an old preformatted history string. The year is not stored,
+        so assume the most recent year that doesn't put the entry in the future."""
+        match = _LEGACY_HISTORY_RE.match(line)
+        if not match:
+            return cls(time.time(), user=line)
+        mon, day, hh, mm, user, resp = match.groups()
+        now = datetime.now()
+        ts = None
+        for year in (now.year, now.year - 1, now.year - 2, now.year - 3):
+            try:
+                dt = datetime(year, int(mon), int(day), int(hh), int(mm))
+            except ValueError:
+                continue  # 02/29 in a non-leap year
+            if dt.timestamp() <= now.timestamp() + 86400:
+                ts = dt.timestamp()
+                break
+        return cls(ts if ts is not None else time.time(), user=user, response=resp)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row[:7])
+
+    @classmethod
+    def coerce(cls, item):
+        """Accept a HistoryRecord, a stored row, or a legacy string."""
+        if isinstance(item, cls):
+            return item
+        if isinstance(item, (list, tuple)):
+            return cls.from_row(item)
+        return cls.from_legacy(str(item))
+
+    def to_row(self):
+        return [self.ts, self.chat, self.user, self.response, self.model, self.elapsed, self.code]
+
+    def day(self):
+        """Day key in the daily_summaries format (mm/dd)."""
+        return time.strftime("%m/%d", time.localtime(self.ts))
+
+    def render(self):
+        ts = time.strftime("%m/%d %H:%M", time.localtime(self.ts))
+        user_short = self.user[:HISTORY_USER_MAX].replace("\n", " ")
+        resp_short = self.response[:HISTORY_RESP_MAX].replace("\n", " ")
+        return f"[{ts}] 老板: {user_short} → 秘书: {resp_short}"
+
+    def matches(self, keyword):
+        kw = keyword.lower()
+        return kw in self.user.lower() or kw in self.response.lower()
+
+    def is_error(self):
+        return any(p in self.response or p in self.user for p in _ERROR_PATTERNS)
+
+
+def _json_default(obj):
+    """json.dumps hook: store HistoryRecord objects as compact rows."""
+    if isinstance(obj, HistoryRecord):
+        return obj.to_row()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _normalize_memory(data):
+    """Convert stored history (rows or legacy strings) into HistoryRecord objects."""
+    data["history"] = [HistoryRecord.coerce(h) for h in data.get("history", [])]
+    return data
+
+
 # ─── Memory ──────────────────────────────────────────────────────
 def load_memory():
     """Load memory, auto-recover from backup if corrupted."""
     # 尝试主文件
     if MEMORY_FILE.exists():
         try:
-            return json.loads(MEMORY_FILE.read_text(encoding="utf-8"))
+            return _normalize_memory(json.loads(MEMORY_FILE.read_text(encoding="utf-8")))
         except Exception as e:
             log(f"⚠️ memory.json corrupted: {e}")
 
@@ -1072,7 +2326,7 @@ def load_memory():
     bak_file = MEMORY_FILE.with_suffix(".json.bak")
     if bak_file.exists():
         try:
-            data = json.loads(bak_file.read_text(encoding="utf-8"))
+            data = _normalize_memory(json.loads(bak_file.read_text(encoding="utf-8")))
             log("✅ Recovered memory from .bak file")
             try:
                 send_msg("⚠️ 老板，memory.json 损坏了，我从备份恢复了记忆，可能丢失最近一条对话。")
@@ -1101,7 +2355,7 @@ def load_memory():
 def save_memory(memory):
     """Save memory with atomic write and rolling backup. Thread-safe."""
     with _memory_lock:
-        content = json.dumps(memory, ensure_ascii=False, indent=2)
+        content = json.dumps(memory, ensure_ascii=False, indent=2, default=_json_default)
 
         # 1) 备份当前文件
         bak_file = MEMORY_FILE.with_suffix(".json.bak")
@@ -1215,17 +2469,18 @@ def _clean_history_errors(memory):
     Called once on startup to save token waste."""
     history = memory.get("history", [])
     before = len(history)
-    cleaned = [h for h in history if not any(p in h for p in _ERROR_PATTERNS)]
+    cleaned = [h for h in history if not h.is_error()]
     if len(cleaned) < before:
         memory["history"] = cleaned
         log(f"🧹 Cleaned {before - len(cleaned)} error entries from history")
         save_memory(memory)
 
 
-def add_history(memory, user_msg, response):
-    """Add conversation summary to memory. Uses tiered memory:
-    - history: last 50 detailed entries (recent conversations)
+def add_history(memory, user_msg, response, chat_id="", model="", elapsed=0.0, code=""):
+    """Add conversation record to memory. Uses tiered memory:
+    - history: last 100 structured records (recent conversations)
     - daily_summaries: compressed daily summaries, kept for 30 days
+    - history_archive/: every full exchange, gzip per month (loaded on demand)
     When old entries get pushed out, they're compressed into daily summaries.
     Skips saving error responses (401, empty output, etc.) to keep history clean.
     """
@@ -1234,20 +2489,27 @@ def add_history(memory, user_msg, response):
         log("Skipped saving error response to history")
         return
 
-    today = time.strftime("%m/%d")
-    ts = time.strftime("%m/%d %H:%M")
-    user_short = user_msg[:200].replace("\n", " ")
-    resp_short = response[:300].replace("\n", " ")
-    entry = f"[{ts}] 老板: {user_short} → 秘书: {resp_short}"
+    record = HistoryRecord(
+        time.time(), chat=chat_id,
+        user=user_msg[:HISTORY_USER_MAX], response=response[:HISTORY_RESP_MAX],
+        model=model, elapsed=elapsed, code=code,
+    )
 
     history = memory.setdefault("history", [])
-    history.append(entry)
+    history.append(record)
+    # Full exchange is spooled for the monthly archive; the hot record stays short
+    spool_history(HistoryRecord(
+        record.ts, chat=chat_id, user=user_msg, response=response,
+        model=model, elapsed=elapsed, code=code,
+    ))
 
     # Before trimming, compress old entries into daily summaries
     if len(history) > 100:
         # Entries that will be removed
         overflow = history[:-100]
         _compress_to_daily(memory, overflow)
+        # Records from before live archiving existed are only in memory.json — archive them now
+        archive_history([h for h in overflow if h.ts < _archive_live_since()])
         memory["history"] = history[-100:]
 
     # Clean up daily summaries older than 30 days
@@ -1260,44 +2522,566 @@ def add_history(memory, user_msg, response):
 
 
 def _compress_to_daily(memory, entries):
-    """Compress history entries into daily summaries."""
+    """Compress history records into daily summaries."""
     summaries = memory.setdefault("daily_summaries", {})
-    for entry in entries:
-        # Extract date from entry like "[02/28 11:25] 老板: ..."
-        match = re.match(r'\[(\d{2}/\d{2})', entry)
-        if match:
-            day = match.group(1)
-        else:
-            day = time.strftime("%m/%d")
-
+    for record in entries:
+        day = record.day()
         if day not in summaries:
             summaries[day] = {"topics": [], "count": 0}
-        # Extract the short topic (user's message part)
-        topic_match = re.search(r'老板: (.+?) →', entry)
-        if topic_match:
-            topic = topic_match.group(1).strip()[:40]
-            # Avoid duplicate topics
-            if topic not in summaries[day]["topics"]:
-                summaries[day]["topics"].append(topic)
-                # Keep max 10 topics per day
-                summaries[day]["topics"] = summaries[day]["topics"][-10:]
+        # The short topic is the start of the boss's message
+        topic = record.user.replace("\n", " ").strip()[:40]
+        # Avoid duplicate topics
+        if topic and topic not in summaries[day]["topics"]:
+            summaries[day]["topics"].append(topic)
+            # Keep max 10 topics per day
+            summaries[day]["topics"] = summaries[day]["topics"][-10:]
         summaries[day]["count"] += 1
 
 
-def add_to_knowledge_base(memory, category, key, value):
-    """Add or update a fact in the permanent knowledge base."""
-    kb = memory.setdefault("knowledge_base", {
+# ─── History Archive ─────────────────────────────────────────────
+# Full exchanges are first appended to history_archive/pending.jsonl (one line, no index
+# work); every ARCHIVE_BATCH exchanges the spool is folded into YYYY-MM.jsonl.gz (one gzip
+# member per batch) and index.json is rewritten once. index.json also keeps each month's
+# record key hashes, so a fold dedupes without decompressing the month. Nothing here is loaded
+# at startup — /recall and date-referencing prompts read the spool and the months they need.
+HISTORY_ARCHIVE_DIR = SCRIPT_DIR / "history_archive"
+HISTORY_ARCHIVE_INDEX = HISTORY_ARCHIVE_DIR / "index.json"
+HISTORY_ARCHIVE_SPOOL = HISTORY_ARCHIVE_DIR / "pending.jsonl"
+ARCHIVE_BATCH = 20        # spooled exchanges per fold into the monthly archive
+ARCHIVE_CACHE_MONTHS = 3  # decompressed months kept in RAM
+_archive_lock = threading.RLock()
+_archive_cache = OrderedDict()  # month -> (mtime, [HistoryRecord])
+_archive_index = [None]         # index.json, loaded once
+_archive_spooled = [None]       # lines in the spool file
+
+
+def _archive_key(record):
+    """Identity of an exchange for dedupe. Hot records carry a truncated message, so only
+    the stored prefix of the user text takes part."""
+    return record.ts, record.chat, record.code, record.user[:HISTORY_USER_MAX]
+
+
+def _archive_key_hash(record):
+    """Short stable digest of _archive_key, as kept in the month index."""
+    key = json.dumps(_archive_key(record), ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+def _rebuild_archive_index():
+    """Index from the month files themselves (index.json missing or unreadable)."""
+    months = {}
+    for path in sorted(HISTORY_ARCHIVE_DIR.glob("*.jsonl.gz")):
+        month = path.name[:-len(".jsonl.gz")]
+        records = load_archive_month(month)
+        if records:
+            months[month] = {"count": len(records), "first": min(r.ts for r in records),
+                             "last": max(r.ts for r in records), "bytes": path.stat().st_size,
+                             "keys": [_archive_key_hash(r) for r in records]}
+    if months:
+        log(f"Archive index rebuilt from {len(months)} month file(s)")
+    return {"live_since": None, "months": months}
+
+
+def _load_archive_index():
+    with _archive_lock:
+        if _archive_index[0] is None:
+            try:
+                _archive_index[0] = json.loads(HISTORY_ARCHIVE_INDEX.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                _archive_index[0] = _rebuild_archive_index()
+            except Exception as e:
+                log(f"Archive index unreadable, rebuilding: {e}")
+                _archive_index[0] = _rebuild_archive_index()
+        return _archive_index[0]
+
+
+def _archive_live_since():
+    """Timestamp from which every new exchange was archived at add time."""
+    since = _load_archive_index().get("live_since")
+    return since if since is not None else float("inf")
+
+
+def archive_history(records, live=False):
+    """Append records to their month's compressed archive and update the index.
+    Records already in the archive (same _archive_key) are skipped. live=True marks
+    exchanges archived as they happened (the spool), which starts the live window."""
+    if not records:
+        return
+    try:
+        with _archive_lock:
+            HISTORY_ARCHIVE_DIR.mkdir(exist_ok=True)
+            index = _load_archive_index()
+            months = index.setdefault("months", {})
+            by_month = {}
+            for r in records:
+                by_month.setdefault(time.strftime("%Y-%m", time.localtime(r.ts)), []).append(r)
+            written = 0
+            for month, recs in by_month.items():
+                info = months.get(month)
+                if info is not None and "keys" not in info:
+                    # Index written before keys were kept: read the month once to fill them in
+                    info["keys"] = [_archive_key_hash(r) for r in load_archive_month(month)]
+                existing = set(info["keys"]) if info else set()
+                fresh = {}
+                for r in recs:
+                    fresh.setdefault(_archive_key_hash(r), r)
+                recs = [r for k, r in fresh.items() if k not in existing]
+                if not recs:
+                    continue
+                path = HISTORY_ARCHIVE_DIR / f"{month}.jsonl.gz"
+                with gzip.open(path, "at", encoding="utf-8") as f:
+                    for r in recs:
+                        f.write(json.dumps(r.to_row(), ensure_ascii=False) + "\n")
+                info = months.setdefault(month, {"count": 0, "first": recs[0].ts, "last": recs[0].ts,
+                                                 "keys": []})
+                info["keys"].extend(k for k, r in fresh.items() if k not in existing)
+                info["count"] += len(recs)
+                info["first"] = min(info["first"], min(r.ts for r in recs))
+                info["last"] = max(info["last"], max(r.ts for r in recs))
+                info["bytes"] = path.stat().st_size
+                _archive_cache.pop(month, None)
+                written += len(recs)
+            if not written:
+                return
+            if live and index.get("live_since") is None:
+                index["live_since"] = min(r.ts for r in records)
+            tmp = HISTORY_ARCHIVE_INDEX.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+            tmp.replace(HISTORY_ARCHIVE_INDEX)
+    except Exception as e:
+        log(f"History archive write error (non-critical): {e}")
+
+
+def spool_history(record):
+    """Queue one full exchange for the archive; folds the spool every ARCHIVE_BATCH records."""
+    try:
+        with _archive_lock:
+            HISTORY_ARCHIVE_DIR.mkdir(exist_ok=True)
+            if _archive_spooled[0] is None:
+                try:
+                    with open(HISTORY_ARCHIVE_SPOOL, encoding="utf-8") as f:
+                        _archive_spooled[0] = sum(1 for _ in f)
+                except FileNotFoundError:
+                    _archive_spooled[0] = 0
+            with open(HISTORY_ARCHIVE_SPOOL, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record.to_row(), ensure_ascii=False) + "\n")
+            _archive_spooled[0] += 1
+            if _archive_spooled[0] >= ARCHIVE_BATCH:
+                flush_history_spool()
+    except Exception as e:
+        log(f"History spool write error (non-critical): {e}")
+
+
+def _spooled_records():
+    """Full exchanges waiting in the spool (not yet folded into a month)."""
+    with _archive_lock:
+        try:
+            lines = HISTORY_ARCHIVE_SPOOL.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            return []
+    records = []
+    for line in lines:
+        try:
+            records.append(HistoryRecord.from_row(json.loads(line)))
+        except ValueError:
+            continue  # torn last line
+    return records
+
+
+def flush_history_spool():
+    """Fold spooled exchanges into the monthly archives. A crash between the fold and the
+    spool removal is harmless: the re-fold skips what is already archived."""
+    with _archive_lock:
+        if not HISTORY_ARCHIVE_SPOOL.exists():
+            return
+        archive_history(_spooled_records(), live=True)
+        HISTORY_ARCHIVE_SPOOL.unlink()
+        _archive_spooled[0] = 0
+
+
+def load_archive_month(month):
+    """Return all archived records of a month (YYYY-MM), cached by file mtime."""
+    path = HISTORY_ARCHIVE_DIR / f"{month}.jsonl.gz"
+    if not path.exists():
+        return []
+    mtime = path.stat().st_mtime
+    with _archive_lock:
+        cached = _archive_cache.get(month)
+        if cached and cached[0] == mtime:
+            _archive_cache.move_to_end(month)
+            return cached[1]
+    records = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    records.append(HistoryRecord.from_row(json.loads(line)))
+    except (EOFError, OSError, ValueError) as e:
+        # Truncated last member (e.g. crash mid-write) — keep what was readable
+        log(f"Archive {month} partially read ({len(records)} records): {e}")
+    with _archive_lock:
+        _archive_cache[month] = (mtime, records)
+        while len(_archive_cache) > ARCHIVE_CACHE_MONTHS:
+            _archive_cache.popitem(last=False)
+    return records
+
+
+def _recent_history(memory):
+    """Hot records, with the full spooled exchange in place of the truncated hot copy."""
+    recent = {_archive_key(h): h for h in memory.get("history", [])}
+    for r in _spooled_records():
+        recent[_archive_key(r)] = r
+    return sorted(recent.values(), key=lambda r: r.ts)
+
+
+def search_history(memory, keyword, limit=10):
+    """Search recent history (hot + spool) first, then archived months newest-first until
+    `limit` hits. Returns records oldest → newest."""
+    hot = _recent_history(memory)
+    matches = [h for h in hot if h.matches(keyword)]
+    if len(matches) >= limit:
+        return matches[-limit:]
+    hot_start = min((h.ts for h in hot), default=float("inf"))
+    for month in sorted(_load_archive_index().get("months", {}), reverse=True):
+        older = [r for r in load_archive_month(month) if r.ts < hot_start and r.matches(keyword)]
+        matches = older + matches
+        if len(matches) >= limit:
+            break
+    return matches[-limit:]
+
+
+def history_for_day(memory, day_dt, limit=15):
+    """All exchanges on a given calendar day, from recent history plus that month's archive."""
+    start = datetime(day_dt.year, day_dt.month, day_dt.day).timestamp()
+    end = start + 86400
+    hot = [h for h in _recent_history(memory) if start <= h.ts < end]
+    month = day_dt.strftime("%Y-%m")
+    info = _load_archive_index().get("months", {}).get(month)
+    archived = []
+    if info and info["first"] < end and info["last"] >= start:
+        hot_ts = {h.ts for h in hot}
+        archived = [r for r in load_archive_month(month)
+                    if start <= r.ts < end and r.ts not in hot_ts]
+    return sorted(archived + hot, key=lambda r: r.ts)[-limit:]
+
+
+# 3月2号 / 3月2日, or slash dates: 03/02, 3/15, 3/2号 — but not fractions like 1/2 or 2/3
+_DAY_REF_RE = re.compile(r'(\d{1,2})\s*月\s*(\d{1,2})\s*[日号]'
+                         r'|(?<![A-Za-z0-9_./:-])(\d{1,2})/(\d{1,2})(\s*[日号])?(?![A-Za-z0-9_/%.:])')
+
+
+def _referenced_days(text):
+    """Dates the message refers to (昨天 / 前天 / 3月2号 / 03/02), excluding today."""
+    now = datetime.now()
+    days = []
+    if "前天" in text:
+        days.append(now - timedelta(days=2))
+    elif "昨天" in text:
+        days.append(now - timedelta(days=1))
+    for m in _DAY_REF_RE.finditer(text):
+        if m.group(1):
+            mon, day = m.group(1), m.group(2)
+        else:
+            mon, day = m.group(3), m.group(4)
+            if len(mon) < 2 and len(day) < 2 and not m.group(5):
+                continue  # "1/2" is far more often a fraction than January 2nd
+        try:
+            dt = datetime(now.year, int(mon), int(day))
+        except ValueError:
+            continue
+        if dt > now:
+            try:
+                dt = dt.replace(year=now.year - 1)
+            except ValueError:
+                continue
+        days.append(dt)
+    today = now.date()
+    seen, result = set(), []
+    for d in days:
+        if d.date() != today and d.date() not in seen:
+            seen.add(d.date())
+            result.append(d)
+    return result[:3]
+
+
+# ─── Knowledge Base ──────────────────────────────────────────────
+# rules / lessons are lists of {"text", "hits", "last"} entries (legacy plain strings
+# are upgraded on first touch). Near-duplicates are found with MinHash + LSH banding
+# over character bigrams: a lookup touches only the entries sharing a band with the
+# new fact, then confirms with exact Jaccard — no scan of the whole list.
+KB_LIMITS = {"rules": 30, "lessons": 30}   # the nightly review (the main writer) always kept 30
+KB_NEAR_DUP_JACCARD = 0.6    # shingle overlap treated as "same fact"
+KB_HALF_LIFE_DAYS = 30       # recency decay for eviction / prompt ranking
+_MINHASH_PERMS = 32
+_MINHASH_ROWS = 2            # rows per LSH band → 16 bands
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_COEFFS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MINHASH_PRIME | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MINHASH_PRIME)
+    for i in range(_MINHASH_PERMS)
+]
+_kb_version = [0]            # bumped on every KB change (lets lookup indexes rebuild lazily)
+_kb_indexes = {}             # category -> (id(list), version, _FactIndex)
+
+
+def _kb_changed():
+    _kb_version[0] += 1
+
+
+def _get_kb(memory):
+    return memory.setdefault("knowledge_base", {
         "people": {}, "systems": {}, "rules": [], "lessons": []
     })
-    if category in ("people", "systems"):
-        kb[category][key] = value
+
+
+def _shingles(text):
+    """Features of a short fact: CJK character bigrams + latin/digit words."""
+    text = text.lower()
+    feats = set(re.findall(r'[a-z0-9]+', text))
+    cjk = re.sub(r'[^\u4e00-\u9fff]', '', text)
+    feats.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    if len(cjk) == 1:
+        feats.add(cjk)
+    return feats
+
+
+def _minhash(feats):
+    hashes = [int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "big")
+              for f in feats] or [0]
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_COEFFS)
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if (a or b) else 1.0
+
+
+class _FactIndex:
+    """LSH-banded MinHash lookup over one KB list."""
+
+    def __init__(self, entries):
+        self._bands = {}
+        self._feats = {}  # id(entry) -> shingle set
+        for e in entries:
+            self.add(e)
+
+    @staticmethod
+    def _keys(sig):
+        return [(i, sig[i:i + _MINHASH_ROWS]) for i in range(0, _MINHASH_PERMS, _MINHASH_ROWS)]
+
+    def add(self, entry):
+        feats = _shingles(entry["text"])
+        self._feats[id(entry)] = feats
+        for k in self._keys(_minhash(feats)):
+            self._bands.setdefault(k, []).append(entry)
+
+    def remove(self, entry):
+        feats = self._feats.pop(id(entry), None)
+        if feats is None:
+            return
+        for k in self._keys(_minhash(feats)):
+            bucket = self._bands.get(k)
+            if bucket:
+                # By identity: two entries with the same text/counters compare equal
+                bucket[:] = [e for e in bucket if e is not entry]
+
+    def find(self, text):
+        """Most similar existing entry with Jaccard ≥ KB_NEAR_DUP_JACCARD, or None."""
+        feats = _shingles(text)
+        best, best_j = None, KB_NEAR_DUP_JACCARD
+        seen = set()
+        for k in self._keys(_minhash(feats)):
+            for e in self._bands.get(k, ()):
+                if id(e) in seen:
+                    continue
+                seen.add(id(e))
+                j = _jaccard(feats, self._feats[id(e)])
+                if j >= best_j:
+                    best, best_j = e, j
+        return best
+
+
+def _kb_entries(kb, category):
+    """Return the category's entry list, upgrading legacy strings in place."""
+    entries = kb.setdefault(category, [])
+    if any(not isinstance(e, dict) for e in entries):
+        now = int(time.time())
+        entries[:] = [e if isinstance(e, dict) else {"text": e, "hits": 1, "last": now}
+                      for e in entries]
+    return entries
+
+
+def _kb_index(kb, category):
+    entries = _kb_entries(kb, category)
+    cached = _kb_indexes.get(category)
+    if not cached or cached[0] != id(entries) or cached[1] != _kb_version[0]:
+        cached = (id(entries), _kb_version[0], _FactIndex(entries))
+        _kb_indexes[category] = cached
+    return cached[2]
+
+
+def _kb_score(entry, now):
+    """Frequency × recency: facts re-learned often and recently rank highest."""
+    age_days = max(0, now - entry.get("last", now)) / 86400
+    return (1 + entry.get("hits", 1)) * 0.5 ** (age_days / KB_HALF_LIFE_DAYS)
+
+
+def kb_add_fact(kb, category, text):
+    """Insert a rule/lesson, merging into a near-duplicate if one exists.
+    Returns True if a new entry was created."""
+    text = text.strip()
+    if not text:
+        return False
+    entries = _kb_entries(kb, category)
+    index = _kb_index(kb, category)
+    now = int(time.time())
+    dup = index.find(text)
+    if dup:
+        # Merge: keep the newest wording (facts get corrected over time), bump frequency
+        dup["hits"] = dup.get("hits", 1) + 1
+        dup["last"] = now
+        if dup["text"] != text:
+            index.remove(dup)
+            dup["text"] = text
+            index.add(dup)
+        created = False
+    else:
+        entry = {"text": text, "hits": 1, "last": now}
+        entries.append(entry)
+        index.add(entry)
+        created = True
+    # Evict lowest-scoring facts instead of slicing off the oldest
+    limit = KB_LIMITS.get(category, 30)
+    while len(entries) > limit:
+        i = min(range(len(entries)), key=lambda i: _kb_score(entries[i], now))
+        index.remove(entries.pop(i))
+    _kb_changed()
+    _kb_indexes[category] = (id(entries), _kb_version[0], index)
+    return created
+
+
+def kb_top(kb, category, n):
+    """Best-scoring rule/lesson texts for the prompt."""
+    now = int(time.time())
+    entries = _kb_entries(kb, category)
+    return [e["text"] for e in sorted(entries, key=lambda e: _kb_score(e, now), reverse=True)[:n]]
+
+
+# ─── Knowledge Injection (name matching) ─────────────────────────
+KB_INJECT_MAX = 20   # safety cap on entries injected per message
+
+
+class AhoCorasick:
+    """Multi-pattern matcher: build once, then scan a text in O(len(text) + hits)."""
+
+    def __init__(self, patterns):
+        """patterns: iterable of (pattern, payload); matching is case-insensitive (casefold)."""
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pattern, payload in patterns:
+            folded = pattern.casefold()
+            node = 0
+            for ch in folded:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append((len(folded), payload))
+        # BFS to build failure links
+        frontier = list(self._goto[0].values())
+        while frontier:
+            nxt_frontier = []
+            for node in frontier:
+                for ch, child in self._goto[node].items():
+                    f = self._fail[node]
+                    while f and ch not in self._goto[f]:
+                        f = self._fail[f]
+                    self._fail[child] = self._goto[f].get(ch, 0)
+                    self._out[child] = self._out[child] + self._out[self._fail[child]]
+                    nxt_frontier.append(child)
+            frontier = nxt_frontier
+
+    def search(self, text):
+        """Yield (start, end, payload) for every pattern occurrence, as offsets into text.
+        Characters are folded one at a time ("İ" and "ß" fold to two), so each folded
+        position remembers which original character it came from."""
+        node = 0
+        origin = []   # folded position -> index in text
+        for i, orig in enumerate(text):
+            for ch in orig.casefold():
+                origin.append(i)
+                while node and ch not in self._goto[node]:
+                    node = self._fail[node]
+                node = self._goto[node].get(ch, 0)
+                for length, payload in self._out[node]:
+                    yield origin[len(origin) - length], i + 1, payload
+
+
+_kb_matcher = {"key": None, "ac": None}
+
+
+def _kb_name_patterns(kb):
+    """(pattern, (category, name)) for people + system names, explicit aliases and
+    the first word of multi-word latin names (e.g. "RACHEL KANG JEY MIN" → "rachel")."""
+    patterns = []
+    first_words = {}
+    for category in ("people", "systems"):
+        for name in kb.get(category, {}):
+            patterns.append((name, (category, name)))
+            parts = name.split()
+            if len(parts) > 1 and parts[0].isascii() and len(parts[0]) >= 3:
+                first_words.setdefault(parts[0].lower(), []).append((category, name))
+    for word, targets in first_words.items():
+        if len(targets) == 1:  # ambiguous first names are left out
+            patterns.append((word, targets[0]))
+    for alias, name in kb.get("aliases", {}).items():
+        for category in ("people", "systems"):
+            if name in kb.get(category, {}):
+                patterns.append((alias, (category, name)))
+                break
+    return [(p, t) for p, t in patterns if len(p.strip()) >= 2]
+
+
+def _kb_name_matcher(kb):
+    """Automaton over all KB names, rebuilt only when the KB changes."""
+    key = (id(kb), _kb_version[0])
+    if _kb_matcher["key"] != key:
+        _kb_matcher["ac"] = AhoCorasick(_kb_name_patterns(kb))
+        _kb_matcher["key"] = key
+    return _kb_matcher["ac"]
+
+
+def kb_mentions(kb, text):
+    """KB people/systems entries mentioned in text, in order of first mention."""
+    found = []
+    seen = set()
+    for start, end, target in _kb_name_matcher(kb).search(text):
+        # Latin names must match whole words ("min" should not hit "admin")
+        if text[start:end].isascii():
+            before = text[start - 1] if start > 0 else " "
+            after = text[end] if end < len(text) else " "
+            if (before.isascii() and before.isalnum()) or (after.isascii() and after.isalnum()):
+                continue
+        if target not in seen:
+            seen.add(target)
+            found.append((start, target))
+    found.sort()
+    return [t for _, t in found][:KB_INJECT_MAX]
+
+
+def add_to_knowledge_base(memory, category, key, value):
+    """Add or update a fact in the permanent knowledge base.
+    category "aliases" maps an alternative name (key) to a people/systems name (value)."""
+    kb = _get_kb(memory)
+    if category in ("people", "systems", "aliases"):
+        kb.setdefault(category, {})[key] = value
+        _kb_changed()
     elif category in ("rules", "lessons"):
-        target = kb[category]
-        entry = f"{key}: {value}" if key else value
-        if entry not in target:
-            target.append(entry)
-            # Keep last 20 rules/lessons
-            kb[category] = target[-20:]
+        kb_add_fact(kb, category, f"{key}: {value}" if key else value)
 
 
 # ─── Smart Model Selection ───────────────────────────────────────
@@ -1396,24 +3180,28 @@ def run_claude(prompt, memory, continue_session=True):
     """Run claude CLI and return the response text."""
     # Auto-select model based on task complexity
     model, reason = auto_select_model(prompt, memory)
+    _run_info.model, _run_info.reason = model, reason
     cwd = memory.get("cwd", DEFAULT_CWD)
     system_prompt = load_system_prompt()
+    # Live data the message asks about (bookings, LDS) — per message, so added even when continuing
+    live = live_data_context(prompt)
 
     # Build context from tiered memory (skip if continuing session — already has context)
     if not continue_session:
         context_parts = []
 
-        # Layer 0: Knowledge base — permanent facts about people, systems, rules, lessons
+        # Layer 0: Knowledge base — people/systems mentioned in this message, plus rules & lessons
         kb = memory.get("knowledge_base", {})
         kb_lines = []
-        if kb.get("people"):
-            for name, info in list(kb["people"].items())[:10]:
-                kb_lines.append(f"  [{name}]: {info}")
+        for category, name in kb_mentions(kb, prompt):
+            info = kb[category][name]
+            label = name if category == "people" else f"系统 {name}"
+            kb_lines.append(f"  [{label}]: {info}")
         if kb.get("rules"):
-            for rule in kb["rules"][-5:]:
+            for rule in kb_top(kb, "rules", 5):
                 kb_lines.append(f"  [规则] {rule}")
         if kb.get("lessons"):
-            for lesson in kb["lessons"][-5:]:
+            for lesson in kb_top(kb, "lessons", 5):
                 kb_lines.append(f"  [教训] {lesson}")
         if kb_lines:
             context_parts.append("[永久知识库]\n" + "\n".join(kb_lines))
@@ -1433,16 +3221,27 @@ def run_claude(prompt, memory, continue_session=True):
             if day_lines:
                 context_parts.append("[过去几天的对话摘要]\n" + "\n".join(day_lines))
 
+        # Layer 1b: Full exchanges of specific past days the message refers to (lazy archive load)
+        for day_dt in _referenced_days(prompt):
+            records = history_for_day(memory, day_dt)
+            if records:
+                context_parts.append(
+                    f"[{day_dt.strftime('%m/%d')} 的对话记录]\n" + "\n".join(r.render() for r in records)
+                )
+
         # Layer 2: Recent detailed history (last 20 messages)
         history = memory.get("history", [])
         if history:
-            recent = "\n".join(history[-20:])
+            recent = "\n".join(h.render() for h in history[-20:])
             context_parts.append(f"[最近对话记录]\n{recent}")
 
         # Combine context with current message
         if context_parts:
             context = "\n\n".join(context_parts)
             prompt = f"{context}\n\n[当前消息]\n{prompt}"
+    if live:
+        prompt = f"{live}\n\n{prompt}"
+    _run_info.prompt_chars = len(prompt)
 
     # Select max_turns based on model complexity
     if model == "haiku":
@@ -1498,6 +3297,7 @@ def run_claude(prompt, memory, continue_session=True):
     # Retry logic: up to 3 attempts for empty/failed/401 results
     max_retries = 3
     for attempt in range(1, max_retries + 1):
+        _run_info.attempts = attempt
         try:
             t_start = time.time()
             proc = subprocess.Popen(
@@ -1726,18 +3526,16 @@ def handle_command(text, memory):
         keyword = text[8:].strip()
         if not keyword:
             return "用法：/recall 关键词（搜索对话记忆）", False
-        history = memory.get("history", [])
         daily = memory.get("daily_summaries", {})
         matches = []
-        # Search recent history
-        for h in history:
-            if keyword.lower() in h.lower():
-                matches.append(h)
         # Search daily summaries
         for day, info in sorted(daily.items()):
             for topic in info.get("topics", []):
                 if keyword.lower() in topic.lower():
                     matches.append(f"[{day}] {topic}")
+        # Search recent history, then the monthly archives (loaded on demand).
+        # Full exchanges go last so they win the "last 10" cut over bare topics.
+        matches += [h.render() for h in search_history(memory, keyword, limit=10)]
         if not matches:
             return f"找不到关于「{keyword}」的记忆", False
         result = f"🔍 搜索「{keyword}」找到 {len(matches)} 条：\n\n"
@@ -1754,11 +3552,11 @@ def handle_command(text, memory):
         q_size = _task_queue.qsize()
         history_count = len(memory.get("history", []))
         model = memory.get("current_model", DEFAULT_MODEL)
-        # Token usage stats
-        usage = memory.get("token_usage", {})
-        today_str = time.strftime("%Y-%m-%d")
-        today_calls = usage.get(today_str, {}).get("calls", 0)
-        today_secs = usage.get(today_str, {}).get("total_seconds", 0)
+        # Usage stats (from the usage time-series)
+        midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        today_usage = usage_store.aggregate(midnight)
+        today_calls = today_usage["calls"]
+        today_secs = today_usage["wall"]
         # Worker status
         worker_alive = _worker_thread is not None and _worker_thread.is_alive()
         worker_status = "🟢 正常" if worker_alive else "🔴 已停止"
@@ -1772,11 +3570,34 @@ def handle_command(text, memory):
             f"当前模型：{model}\n"
             f"记忆条数：{history_count}\n"
             f"今日调用：{today_calls} 次，{today_secs:.0f} 秒\n"
+            f"数据缓存：{data_cache.stats_line()}\n"
             f"语音���{'✅' if VOICE_ENABLED else '❌'}\n"
+            f"语音识别：{voice_stats_line()}\n"
             f"Supabase：{'✅' if SUPABASE_SERVICE_KEY else '❌ 未配置'}\n"
             f"Groq：{'✅' if GROQ_API_KEY else '❌ 未配置'}"
         ), False
 
+    if text == "/pm2" or is_pm2_status_query(text):
+        # `pm2 jlist` can take seconds; collect on the job executor, not the poll loop
+        if job_executor.submit("pm2_status", lambda: send_msg(pm2_status_text()), timeout=30) is None:
+            return "⏳ PM2 状态查询进行中，稍等", False
+        return "🔍 正在查询 PM2 状态…", False
+
+    if text == "/jobs":
+        return job_executor.report(), False
+
+    if text == "/uptime":
+        return uptime_report(), False
+
+    if text == "/usage" or text.startswith("/usage "):
+        period = text[6:].strip().lower() or "day"
+        if period not in ("day", "week", "month", "year"):
+            return "用法：/usage [day|week|month|year]", False
+        return usage_report(period), False
+
+    if text == "/schedule" or text.startswith("/schedule "):
+        return handle_schedule_command(text[9:].strip()), False
+
     if text == "/diagnose":
         send_msg("🔍 正在运行自我诊断，稍等...")
         report = run_diagnose()
@@ -1847,22 +3668,328 @@ def log(msg):
         pass
 
 
-def _track_usage(memory, elapsed_sec):
-    """Track daily Claude CLI usage in memory for /health report."""
-    today = time.strftime("%Y-%m-%d")
-    usage = memory.setdefault("token_usage", {})
-    if today not in usage:
-        usage[today] = {"calls": 0, "total_seconds": 0}
-    usage[today]["calls"] += 1
-    usage[today]["total_seconds"] += elapsed_sec
-    # Keep only last 7 days of usage data
-    for key in list(usage.keys()):
-        if key < (datetime.now().strftime("%Y-%m-%d")[:8] + "01"):  # roughly >30 days
-            pass  # fine-grained cleanup below
-    cutoff_keys = sorted(usage.keys())
-    if len(cutoff_keys) > 7:
-        for old_key in cutoff_keys[:-7]:
-            del usage[old_key]
+# ─── Usage Time-Series ───────────────────────────────────────────
+# Append-only store: usage/rows.bin holds one fixed-width packed record per Claude call
+# (categorical columns are dictionary-encoded via usage/dict.json), read back column-wise.
+# Raw rows are kept USAGE_RAW_DAYS; older days are folded into usage/rollup.json.
+USAGE_DIR = SCRIPT_DIR / "usage"
+USAGE_RAW_DAYS = 35       # raw per-call rows (covers /usage month)
+USAGE_ROLLUP_DAYS = 366   # daily rollups
+_USAGE_COLUMNS = [        # (name, array typecode)
+    ("ts", "d"), ("model", "B"), ("reason", "B"), ("wall", "f"), ("wait", "f"),
+    ("retries", "B"), ("outcome", "B"), ("prompt_chars", "I"), ("resp_chars", "I"),
+]
+_USAGE_CATEGORICAL = ("model", "reason", "outcome")
+_NP_DTYPES = {"d": "f8", "B": "u1", "f": "f4", "I": "u4"}
+_USAGE_ROW = struct.Struct("<" + "".join(tc for _, tc in _USAGE_COLUMNS))
+USAGE_OUTCOME_LABELS = {
+    "ok": "成功", "timeout": "超时", "max_turns": "步数上限", "auth": "认证失败",
+    "network": "网络错误", "cancelled": "已取消", "error": "出错",
+}
+
+
+def _classify_outcome(response):
+    """Map run_claude's user-facing text back to an outcome code."""
+    if response.startswith("⏰") or "执行超时了" in response:
+        return "timeout"
+    if "操作步骤太多达到上限" in response:
+        return "max_turns"
+    if response.startswith("🔑"):
+        return "auth"
+    if response.startswith("🌐"):
+        return "network"
+    if response.startswith("✋"):
+        return "cancelled"
+    if any(response.startswith(p) for p in ("执行出错了", "执行时遇到问题", "CLI 启动异常", "（没有输出", "（重试后仍无输出）", "老板，我找不到 claude")):
+        return "error"
+    return "ok"
+
+
+class UsageStore:
+    """Per-call usage records on disk; aggregates are computed column-wise without
+    ever putting the raw rows into memory.json."""
+
+    def __init__(self, directory):
+        self.dir = Path(directory)
+        self._lock = threading.Lock()
+        self._dict = None
+        self._compacted_day = None
+
+    # ── storage ──
+    @property
+    def _rows_path(self):
+        return self.dir / "rows.bin"
+
+    def _load_dict(self):
+        if self._dict is None:
+            try:
+                self._dict = json.loads((self.dir / "dict.json").read_text(encoding="utf-8"))
+            except Exception:
+                self._dict = {c: ["?"] for c in _USAGE_CATEGORICAL}  # code 0 = unknown/overflow
+        return self._dict
+
+    def _encode(self, col, value):
+        values = self._load_dict().setdefault(col, ["?"])
+        value = str(value or "?")
+        if value not in values:
+            if len(values) >= 256:
+                return 0  # uint8 dictionary full
+            values.append(value)
+            (self.dir / "dict.json").write_text(json.dumps(self._dict, ensure_ascii=False), encoding="utf-8")
+        return values.index(value)
+
+    def _migrate_columns(self):
+        """One-off: fold the old per-column usage/<col>.bin files into rows.bin."""
+        legacy = [self.dir / f"{col}.bin" for col, _ in _USAGE_COLUMNS]
+        if self._rows_path.exists() or not any(p.exists() for p in legacy):
+            return
+        cols = {}
+        for (col, tc), path in zip(_USAGE_COLUMNS, legacy):
+            arr = array.array(tc)
+            if path.exists():
+                arr.frombytes(path.read_bytes()[:path.stat().st_size // arr.itemsize * arr.itemsize])
+            cols[col] = arr
+        n = min(len(v) for v in cols.values())
+        self._write({k: v[:n] for k, v in cols.items()})
+        for path in legacy:
+            path.unlink(missing_ok=True)
+        log(f"Usage store: migrated {n} rows to rows.bin")
+
+    def append(self, **rec):
+        """Append one call record (ts, model, reason, wall, wait, retries, outcome,
+        prompt_chars, resp_chars) as a single write."""
+        with self._lock:
+            self.dir.mkdir(exist_ok=True)
+            self._migrate_columns()
+            rec.setdefault("ts", time.time())
+            values = []
+            for col, tc in _USAGE_COLUMNS:
+                value = rec.get(col, 0)
+                if col in _USAGE_CATEGORICAL:
+                    value = self._encode(col, value)
+                elif tc in "BI":
+                    value = max(0, min(int(value or 0), 255 if tc == "B" else 2**32 - 1))
+                values.append(value)
+            with open(self._rows_path, "ab") as f:
+                size = f.tell()
+                if size % _USAGE_ROW.size:
+                    # A crash cut the last record short: drop it so this one stays aligned
+                    f.truncate(size - size % _USAGE_ROW.size)
+                f.write(_USAGE_ROW.pack(*values))
+            today = time.strftime("%Y-%m-%d")
+            if self._compacted_day != today:
+                self._compacted_day = today
+                self._compact()
+
+    def compact(self):
+        """Fold expired raw rows into the rollups now (before reports that span both)."""
+        with self._lock:
+            if self.dir.exists():
+                self._compact()
+
+    def _read(self):
+        """Load all rows as columns (NumPy arrays if available, else array.array),
+        ignoring a partial trailing record left by an interrupted append."""
+        self._migrate_columns()
+        path = self._rows_path
+        data = path.read_bytes() if path.exists() else b""
+        data = data[:len(data) // _USAGE_ROW.size * _USAGE_ROW.size]
+        if NUMPY_ENABLED:
+            rows = np.frombuffer(data, dtype=np.dtype([(c, "<" + _NP_DTYPES[tc]) for c, tc in _USAGE_COLUMNS]))
+            return {col: rows[col] for col, _ in _USAGE_COLUMNS}
+        cols = {col: array.array(tc) for col, tc in _USAGE_COLUMNS}
+        for row in _USAGE_ROW.iter_unpack(data):
+            for (col, _), value in zip(_USAGE_COLUMNS, row):
+                cols[col].append(value)
+        return cols
+
+    def _write(self, cols):
+        tmp = self._rows_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(b"".join(_USAGE_ROW.pack(*row)
+                             for row in zip(*(cols[col] for col, _ in _USAGE_COLUMNS))))
+        tmp.replace(self._rows_path)
+
+    # ── rollups ──
+    def _load_rollup(self):
+        try:
+            return json.loads((self.dir / "rollup.json").read_text(encoding="utf-8"))
+        except Exception:
+            return {}
+
+    def _save_rollup(self, rollup):
+        for day in sorted(rollup)[:-USAGE_ROLLUP_DAYS]:
+            del rollup[day]
+        tmp = self.dir / "rollup.json.tmp"
+        tmp.write_text(json.dumps(rollup, ensure_ascii=False, indent=1), encoding="utf-8")
+        tmp.replace(self.dir / "rollup.json")
+
+    def _compact(self):
+        """Fold raw rows older than USAGE_RAW_DAYS into daily rollups (called once a day)."""
+        try:
+            cols = self._read()
+            cutoff = time.time() - USAGE_RAW_DAYS * 86400
+            ts = cols["ts"]
+            old = [i for i in range(len(ts)) if ts[i] < cutoff]
+            if not old:
+                return
+            rollup = self._load_rollup()
+            names = self._load_dict()
+            for i in old:
+                day = time.strftime("%Y-%m-%d", time.localtime(ts[i]))
+                r = rollup.setdefault(day, {"calls": 0, "wall": 0.0, "wait": 0.0, "retries": 0,
+                                            "errors": 0, "models": {}})
+                r["calls"] += 1
+                r["wall"] = round(r["wall"] + float(cols["wall"][i]), 1)
+                r["wait"] = round(r["wait"] + float(cols["wait"][i]), 1)
+                r["retries"] += int(cols["retries"][i])
+                if names["outcome"][int(cols["outcome"][i])] != "ok":
+                    r["errors"] += 1
+                model = names["model"][int(cols["model"][i])]
+                r["models"][model] = r["models"].get(model, 0) + 1
+            self._save_rollup(rollup)
+            if NUMPY_ENABLED:
+                mask = ts >= cutoff
+                self._write({k: v[mask] for k, v in cols.items()})
+            else:
+                keep = [i for i in range(len(ts)) if ts[i] >= cutoff]
+                self._write({k: [v[i] for i in keep] for k, v in cols.items()})
+            log(f"Usage store: rolled up {len(old)} old call records")
+        except Exception as e:
+            log(f"Usage compaction error (non-critical): {e}")
+
+    def import_legacy(self, token_usage):
+        """Seed daily rollups from the old memory["token_usage"] {date: {calls, total_seconds}}."""
+        if not token_usage:
+            return
+        with self._lock:
+            self.dir.mkdir(exist_ok=True)
+            rollup = self._load_rollup()
+            for day, u in token_usage.items():
+                rollup.setdefault(day, {"calls": u.get("calls", 0), "wall": round(u.get("total_seconds", 0), 1),
+                                        "wait": 0.0, "retries": 0, "errors": 0, "models": {}})
+            self._save_rollup(rollup)
+
+    # ── queries ──
+    def aggregate(self, since_ts):
+        """Aggregate raw rows with ts >= since_ts."""
+        with self._lock:
+            cols = self._read()
+            names = self._load_dict()
+        labels = {c: names.get(c, []) for c in _USAGE_CATEGORICAL}
+        if NUMPY_ENABLED:
+            mask = cols["ts"] >= since_ts
+            sel = {k: v[mask] for k, v in cols.items()}
+            n = int(mask.sum())
+            wall = sel["wall"].astype("f8")
+            by_model = np.bincount(sel["model"], minlength=len(labels["model"]))
+            wall_by_model = np.bincount(sel["model"], weights=wall, minlength=len(labels["model"]))
+            by_outcome = np.bincount(sel["outcome"], minlength=len(labels["outcome"]))
+            stats = {
+                "calls": n,
+                "wall": float(wall.sum()),
+                "p95": float(np.percentile(wall, 95)) if n else 0.0,
+                "wait": float(sel["wait"].sum()),
+                "retries": int(sel["retries"].sum()),
+                "prompt_chars": float(sel["prompt_chars"].mean()) if n else 0.0,
+                "resp_chars": float(sel["resp_chars"].mean()) if n else 0.0,
+                "models": {labels["model"][i]: (int(c), float(wall_by_model[i]))
+                           for i, c in enumerate(by_model) if c},
+                "outcomes": {labels["outcome"][i]: int(c) for i, c in enumerate(by_outcome) if c},
+            }
+        else:
+            idx = [i for i, t in enumerate(cols["ts"]) if t >= since_ts]
+            n = len(idx)
+            wall = sorted(cols["wall"][i] for i in idx)
+            models, outcomes = {}, {}
+            for i in idx:
+                m = labels["model"][cols["model"][i]]
+                c, w = models.get(m, (0, 0.0))
+                models[m] = (c + 1, w + cols["wall"][i])
+                o = labels["outcome"][cols["outcome"][i]]
+                outcomes[o] = outcomes.get(o, 0) + 1
+            stats = {
+                "calls": n,
+                "wall": float(sum(wall)),
+                "p95": float(wall[min(n - 1, int(0.95 * n))]) if n else 0.0,
+                "wait": float(sum(cols["wait"][i] for i in idx)),
+                "retries": sum(cols["retries"][i] for i in idx),
+                "prompt_chars": sum(cols["prompt_chars"][i] for i in idx) / n if n else 0.0,
+                "resp_chars": sum(cols["resp_chars"][i] for i in idx) / n if n else 0.0,
+                "models": models,
+                "outcomes": outcomes,
+            }
+        return stats
+
+    def rollup_totals(self, since_day):
+        """Sum daily rollups from since_day (YYYY-MM-DD) — used for spans beyond raw retention."""
+        rollup = self._load_rollup()
+        days = [d for d in rollup if d >= since_day]
+        return {
+            "days": len(days),
+            "calls": sum(rollup[d]["calls"] for d in days),
+            "wall": sum(rollup[d]["wall"] for d in days),
+            "errors": sum(rollup[d].get("errors", 0) for d in days),
+        }
+
+
+usage_store = UsageStore(USAGE_DIR)
+
+
+def _track_usage(response, wall_sec, queue_wait=0.0):
+    """Record one Claude CLI call in the usage time-series."""
+    try:
+        usage_store.append(
+            model=getattr(_run_info, "model", ""),
+            reason=getattr(_run_info, "reason", ""),
+            wall=wall_sec,
+            wait=queue_wait,
+            retries=max(0, getattr(_run_info, "attempts", 1) - 1),
+            outcome=_classify_outcome(response),
+            prompt_chars=getattr(_run_info, "prompt_chars", 0),
+            resp_chars=len(response),
+        )
+    except Exception as e:
+        log(f"Usage tracking error (non-critical): {e}")
+
+
+def usage_report(period="day"):
+    """Text report for /usage [day|week|month|year]."""
+    now = datetime.now()
+    midnight = datetime(now.year, now.month, now.day).timestamp()
+    spans = {"day": ("今天", midnight), "week": ("近7天", midnight - 6 * 86400),
+             "month": ("近30天", midnight - 29 * 86400)}
+    if period == "year":
+        # Every raw row not yet folded into a rollup counts as raw, so nothing between
+        # retention and the next compaction is lost (or counted twice)
+        usage_store.compact()
+        raw = usage_store.aggregate(0)
+        old = usage_store.rollup_totals((now - timedelta(days=365)).strftime("%Y-%m-%d"))
+        calls = raw["calls"] + old["calls"]
+        wall = raw["wall"] + old["wall"]
+        return (f"📈 近一年用量\n"
+                f"调用：{calls} 次，总耗时 {wall / 3600:.1f} 小时\n"
+                f"（近{USAGE_RAW_DAYS}天明细 {raw['calls']} 次 + 更早 {old['days']} 天汇总 {old['calls']} 次）")
+    label, since = spans.get(period, spans["day"])
+    st = usage_store.aggregate(since)
+    if not st["calls"]:
+        return f"📈 {label}还没有调用记录"
+    n = st["calls"]
+    ok = st["outcomes"].get("ok", 0)
+    lines = [
+        f"📈 {label}用量",
+        f"调用：{n} 次（成功 {ok}，其他 {n - ok}）",
+        f"总耗时：{st['wall'] / 60:.1f} 分钟，平均 {st['wall'] / n:.0f} 秒，P95 {st['p95']:.0f} 秒",
+        f"排队等待：平均 {st['wait'] / n:.0f} 秒",
+        f"重试：{st['retries']} 次",
+    ]
+    models = sorted(st["models"].items(), key=lambda kv: -kv[1][0])
+    lines.append("按模型：" + "，".join(f"{m} {c} 次/{w / 60:.0f} 分钟" for m, (c, w) in models))
+    bad = {o: c for o, c in st["outcomes"].items() if o != "ok"}
+    if bad:
+        lines.append("异常：" + "，".join(f"{USAGE_OUTCOME_LABELS.get(o, o)} {c}" for o, c in bad.items()))
+    lines.append(f"平均输入 {st['prompt_chars']:.0f} 字，回复 {st['resp_chars']:.0f} 字")
+    return "\n".join(lines)
 
 
 def task_worker(memory, typing_indicator):
@@ -1900,13 +4027,14 @@ def task_worker(memory, typing_indicator):
             t_task_start = time.time()
             typing_indicator.start(chat_id=reply_chat_id)
             try:
-                response = run_claude(text, memory, continue_session)
+                prompt_text = text + collect_enrichments(task.get('enrich'))
+                response = run_claude(prompt_text, memory, continue_session)
             finally:
                 typing_indicator.stop()
             task_elapsed = time.time() - t_task_start
 
             # Track usage
-            _track_usage(memory, task_elapsed)
+            _track_usage(response, task_elapsed, queue_wait=t_task_start - task.get('queued_at', t_task_start))
 
             # 检查是否达到 max turns — 下次需要 continue session
             hit_max_turns = "操作步骤太多达到上限" in response
@@ -1922,7 +4050,9 @@ def task_worker(memory, typing_indicator):
             if reset_session:
                 continue_session = False
 
-            add_history(memory, text, response)
+            add_history(memory, text, response, chat_id=reply_chat_id,
+                        model=getattr(_run_info, "model", ""),
+                        elapsed=task_elapsed, code=current_code)
             save_memory(memory)
 
             send_msg(f"[{current_code}] {response}", chat_id=reply_chat_id)
@@ -1936,6 +4066,8 @@ def task_worker(memory, typing_indicator):
             except Exception:
                 pass
         finally:
+            if task:
+                received_store.unpin(task.get('files'))
             try:
                 _task_queue.task_done()
             except Exception:
@@ -2027,6 +4159,10 @@ def main():
 
     memory = load_memory()
     _clean_history_errors(memory)  # Remove 401/error garbage from history
+    if "token_usage" in memory:
+        # Old per-day counters → usage time-series rollups (memory.json no longer holds usage)
+        usage_store.import_legacy(memory.pop("token_usage"))
+        save_memory(memory)
     # Expose memory globally so daily_reporter_thread can access it for self-review
     import __main__
     __main__._global_memory = memory
@@ -2070,7 +4206,7 @@ def main():
     # Start daily reporter background thread (10:00 & 22:00)
     reporter = threading.Thread(target=daily_reporter_thread, daemon=True)
     reporter.start()
-    log("Daily reporter started — will send at 10:00 & 22:00 daily")
+    log(f"Scheduler started — {len(SCHEDULED_JOBS)} jobs registered")
 
     # Clean old received files on startup (>7 days)
     _clean_received_files()
@@ -2192,6 +4328,12 @@ def main():
                         log(f"Ignored message from unknown chat: {chat_id}")
                         continue
 
+                enrich = []  # background extras (OCR, table previews) appended to the prompt by the worker
+
+                # ── Album (media group): buffered briefly, then one task for all items ──
+                if msg.get("media_group_id") and buffer_album_item(msg, chat_id):
+                    continue
+
                 # ── Handle voice message ──
                 voice = msg.get("voice")
                 if voice and not text:
@@ -2200,25 +4342,44 @@ def main():
                         if not VOICE_ENABLED:
                             send_msg("语音功能未启用，请安装 SpeechRecognition 和 pydub")
                             continue
-                        ogg_path = download_voice(file_id)
-                        if ogg_path:
-                            text = transcribe_voice(ogg_path)
+                        unique_id = voice.get("file_unique_id")
+                        text = transcript_cache.get(unique_id)
+                        if text:
+                            log(f"Voice transcript cache hit ({unique_id})")
+                        else:
+                            timings = {}
+                            t0 = time.time()
+                            audio = download_voice(file_id, timings)
+                            if not audio:
+                                send_msg("语音下载失败了，请重新发送")
+                                continue
+                            audio_hash = TranscriptCache.content_hash(audio)
+                            text = transcript_cache.get(audio_hash=audio_hash)
+                            if text:
+                                log("Voice transcript cache hit (same audio, new file id)")
+                            else:
+                                text = transcribe_voice(audio, timings, duration=voice.get("duration"))
+                                timings["total"] = time.time() - t0
+                                log_voice_timings(timings)
                             if not text:
                                 send_msg("抱歉老板，没听清楚，能再说一次吗？ 🙉")
                                 continue
-                        else:
-                            send_msg("语音下载失败了，请重新发送")
-                            continue
+                            transcript_cache.put(unique_id, audio_hash, text)
 
                 # ── Handle photo ──
                 photo = msg.get("photo")
                 if photo:
-                    # Telegram sends multiple sizes, take largest
-                    file_id = photo[-1]["file_id"]
-                    path = download_telegram_file(file_id, suffix=".jpg")
+                    # Telegram sends multiple sizes — take the smallest that is big enough
+                    path = prepare_incoming_photo(photo)
                     if path:
                         user_caption = text or caption or ""
-                        text = user_caption + f"\n[用户发了一张图片，已保存在: {path}。请务必用 Read 工具读取这个图片文件，看清楚图片内容后再回答。]"
+                        # With OCR the Read instruction comes with its result (see _ocr_context)
+                        photo_ocr = submit_ocr([path], photos=True)
+                        if photo_ocr:
+                            text = user_caption + f"\n[用户发了一张图片，已保存在: {path}]"
+                            enrich.append(photo_ocr)
+                        else:
+                            text = user_caption + f"\n[用户发了一张图片，已保存在: {path}。请务必用 Read 工具读取这个图片文件，看清楚图片内容后再回答。]"
 
                 # ── Handle document/file ──
                 doc = msg.get("document")
@@ -2228,6 +4389,8 @@ def main():
                     path = download_telegram_file(file_id, filename=file_name)
                     if path:
                         text = (text or caption or "") + f"\n[用户发了文件 {file_name}，已保存在: {path}]"
+                        enrich.append(submit_ocr([path]))
+                        enrich.append(submit_table_preview(path, file_name))
 
                 if not text:
                     continue
@@ -2250,12 +4413,7 @@ def main():
 
                 # Normal message → enqueue for background processing
                 # Main loop stays responsive; worker sends result with task code
-                code = _next_task_code()
-                q_size = _task_queue.qsize()
-                queue_note = f"（前面还有 {q_size} 个任务排队）" if q_size > 0 else ""
-                send_msg(f"[{code}] 收到，处理中...{queue_note}", chat_id=chat_id)
-                _task_queue.put({'code': code, 'text': text, 'chat_id': chat_id})
-                log(f"[{code}] Queued (pos={q_size+1}): {text[:60]}")
+                _enqueue_task(text, chat_id, enrich=[f for f in enrich if f])
                 consecutive_errors = 0
 
                 # Watchdog: restart worker if it died
@@ -2317,97 +4475,383 @@ def _take_screenshot():
 
 def send_booking_report_5pm():
     """每天 17:00 发送今日预约汇报。"""
-    import urllib.request as _urllib
-    import json as _json
-
     now = datetime.now()
     date_str = now.strftime('%Y-%m-%d')
     log("Booking report 17:00 triggered")
 
-    ctx = SSL_CTX  # Use global certifi-backed SSL context
-
-    BOOK_API = f"https://script.google.com/macros/s/AKfycbyq1uhgRek_xCtOeAeWnS6mKxoYI4FMSiezAHlGHB-GXkJNGIZNTaotIT76CmKNvoY_/exec?page=api&key=zchhp2024&action={date_str}"
-
     try:
-        req = _urllib.Request(BOOK_API, headers={"User-Agent": "Mozilla/5.0"})
-        raw = _urllib.urlopen(req, context=ctx, timeout=20).read().decode()
-        book = _json.loads(raw)
+        book = data_cache.get("booking", date_str)
         bookings = book.get('bookings', [])
         total_b = book.get('total', len(bookings))
 
-        lines = [f"📅 今日预约汇报 {date_str}  共 {total_b} 张"]
-        if bookings:
-            for b in bookings:
-                status_icon = "✅" if b.get('status') == 'accepted' else ("❌" if b.get('status') == 'cancelled' else "⏳")
-                lines.append(f"{status_icon} {b.get('time','?')}  {b.get('name','?')}  {b.get('pax','?')}人")
-        else:
-            lines.append("今日暂无预约")
-
+        lines = [f"📅 今日预约汇报 {date_str}  共 {total_b} 张"] + _booking_lines(bookings)
         send_msg("\n".join(lines))
     except Exception as e:
         log(f"send_booking_report_5pm error: {e}")
         send_msg(f"⚠️ 预约汇报查询失败: {e}")
 
 
+# ─── PM2 Status ──────────────────────────────────────────────────
+# pm2 is called directly (node + pm2's JS entry when it can be found) instead of
+# `npx pm2` through a shell, and results are cached briefly so the 09:00 report, /pm2,
+# "pm2状态" questions and the restart poller share one call.
+PM2_CACHE_SEC = 15
+PM2_TIMEOUT = 20
+PM2_RESTART_SPIKE = 3   # restarts between two polls that count as a crash loop
+
+
+class PM2Error(Exception):
+    pass
+
+
+class PM2Collector:
+    """Cached `pm2 jlist` → [{"name", "status", "restarts", "mem_mb", "cpu"}]."""
+
+    def __init__(self, ttl=PM2_CACHE_SEC):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cmd = None
+        self._cached_at = 0.0
+        self._cached = None
+
+    @staticmethod
+    def _resolve_command():
+        """argv prefix for pm2 without npx or a shell. PM2_BIN overrides."""
+        if os.environ.get("PM2_BIN"):
+            return [os.environ["PM2_BIN"]]
+        node = shutil.which("node")
+        candidates = [SCRIPT_DIR / "node_modules" / "pm2" / "bin" / "pm2"]
+        pm2 = shutil.which("pm2")
+        if pm2:
+            real = Path(os.path.realpath(pm2))
+            # unix: the bin symlink resolves to the JS file; Windows: pm2.cmd sits next to node_modules
+            candidates += [real, real.parent / "node_modules" / "pm2" / "bin" / "pm2"]
+        for c in candidates:
+            if node and c.is_file() and c.suffix not in (".cmd", ".ps1", ".exe") and "node_modules" in c.parts:
+                return [node, str(c)]
+        if pm2:
+            return [pm2]
+        npx = shutil.which("npx")
+        if npx:
+            return [npx, "pm2"]
+        raise PM2Error("找不到 pm2（可设置 PM2_BIN）")
+
+    def _jlist(self):
+        if self._cmd is None:
+            self._cmd = self._resolve_command()
+            log(f"PM2 command: {' '.join(self._cmd)}")
+        result = subprocess.run(
+            self._cmd + ["jlist"], capture_output=True, text=True, timeout=PM2_TIMEOUT,
+            cwd=str(SCRIPT_DIR), encoding="utf-8", errors="replace",
+        )
+        out = result.stdout or ""
+        if result.returncode != 0 or not out.strip():
+            self._cmd = None  # re-resolve next time (pm2 moved / reinstalled)
+            raise PM2Error(f"PM2 检查失败\n{(result.stderr or '')[:150]}")
+        start = out.find("[")  # pm2 may print update notices before the JSON
+        try:
+            return json.loads(out[start:] if start >= 0 else out)
+        except ValueError:
+            raise PM2Error(f"PM2 输出解析失败：{out[:200]}")
+
+    def processes(self, max_age=None):
+        """Process summaries, served from cache if younger than max_age (default ttl)."""
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            if self._cached is not None and time.time() - self._cached_at < max_age:
+                return self._cached
+            procs = []
+            for p in self._jlist():
+                env = p.get('pm2_env', {})
+                monit = p.get('monit') or {}
+                procs.append({
+                    "name": p.get('name', '?'),
+                    "status": env.get('status', '?'),
+                    "restarts": env.get('restart_time', 0),
+                    "mem_mb": round(monit.get('memory', 0) / 1024 / 1024, 1),
+                    "cpu": monit.get('cpu', 0),
+                })
+            self._cached, self._cached_at = procs, time.time()
+            return procs
+
+
+pm2_collector = PM2Collector()
+_pm2_last_restarts = {}   # name -> restart count at the previous poll
+_pm2_alerting = set()     # names with an open alert (crash loop or offline)
+
+
+def pm2_status_text(title=None):
+    """Formatted PM2 status (for the 09:00 report, /pm2 and PM2_STATUS_PHRASES)."""
+    try:
+        processes = pm2_collector.processes()
+    except Exception as e:
+        return f"⚠️ {str(e)[:200]}"
+    if not processes:
+        return "🔴 PM2 目前没有任何进程"
+
+    lines = [title or f"🤖 PM2 状态 {datetime.now().strftime('%H:%M')}"]
+    all_ok = True
+    for p in processes:
+        icon = '✅' if p["status"] == 'online' else '❌'
+        if p["status"] != 'online':
+            all_ok = False
+
+        restarts = p["restarts"]
+        restart_note = ''
+        if restarts > 10:
+            restart_note = f'  ⚠️重启{restarts}次'
+        elif restarts > 0:
+            restart_note = f'  (重启{restarts}次)'
+
+        lines.append(f"{icon} {p['name']}  {p['status']}  {p['mem_mb']}MB{restart_note}")
+
+    lines.append('')
+    lines.append('全部正常 👍' if all_ok else '⚠️ 有进程不正常，请检查！')
+    return '\n'.join(lines)
+
+
+# Whole-message phrases answered with the status dump; anything longer ("查pm2日志",
+# "检查pm2为什么重启") is a real question and goes to Claude
+PM2_STATUS_PHRASES = {"pm2状态", "查pm2", "检查pm2", "查pm2状态", "检查pm2状态"}
+
+
+def is_pm2_status_query(text):
+    t = text.lower().replace(" ", "").rstrip("?？!！。.")
+    return t in PM2_STATUS_PHRASES
+
+
 def send_pm2_report():
     """每天 9:00 检查所有 PM2 进程状态并汇报"""
+    send_msg(pm2_status_text(f"🤖 PM2 状态 09:00  {datetime.now().strftime('%Y-%m-%d')}"))
+    log("PM2 status report sent at 09:00")
+
+
+def check_pm2_restarts():
+    """Poll PM2 between daily reports: alert on restart spikes (crash loops) and processes going
+    offline; one alert per incident, cleared once the process is stable again."""
     try:
-        result = subprocess.run(
-            "npx pm2 jlist",
-            shell=True, capture_output=True, text=True, timeout=30,
-            cwd=str(SCRIPT_DIR)
-        )
-        if result.returncode != 0 or not result.stdout.strip():
-            send_msg(f"⚠️ PM2 检查失败\n{result.stderr[:150]}")
-            return
+        processes = pm2_collector.processes(max_age=0)
+    except Exception as e:
+        log(f"PM2 poll error: {e}")
+        return
+    alerts = []
+    for p in processes:
+        name = p["name"]
+        prev = _pm2_last_restarts.get(name)
+        _pm2_last_restarts[name] = p["restarts"]
+        delta = p["restarts"] - prev if prev is not None and p["restarts"] >= prev else 0
+        if p["status"] != "online" or delta >= PM2_RESTART_SPIKE:
+            if name not in _pm2_alerting:
+                _pm2_alerting.add(name)
+                if p["status"] != "online":
+                    alerts.append(f"❌ {name} 状态 {p['status']}（累计重启 {p['restarts']} 次）")
+                else:
+                    alerts.append(f"⚠️ {name} 频繁重启：最近一次检查后又重启 {delta} 次")
+        elif delta == 0 and name in _pm2_alerting:
+            _pm2_alerting.discard(name)
+            alerts.append(f"✅ {name} 已稳定运行")
+    if alerts:
+        send_msg("PM2 监控告警:\n" + "\n".join(alerts))
+        log(f"PM2 alert: {alerts}")
 
-        import json as _pj
-        try:
-            processes = _pj.loads(result.stdout)
-        except Exception:
-            send_msg(f"⚠️ PM2 输出解析失败：{result.stdout[:200]}")
-            return
 
-        if not processes:
-            send_msg("🔴 PM2 目前没有任何进程")
-            return
+# ─── Concurrent Data Fetching ────────────────────────────────────
+FETCH_POOL_WORKERS = 6
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_POOL_WORKERS, thread_name_prefix="fetch")
 
-        lines = [f"🤖 PM2 状态 09:00  {datetime.now().strftime('%Y-%m-%d')}"]
-        all_ok = True
-        for p in processes:
-            name = p.get('name', '?')
-            env = p.get('pm2_env', {})
-            status = env.get('status', '?')
-            restarts = env.get('restart_time', 0)
-            mem_bytes = (p.get('monit') or {}).get('memory', 0)
-            mem_mb = round(mem_bytes / 1024 / 1024, 1)
-
-            icon = '✅' if status == 'online' else '❌'
-            if status != 'online':
-                all_ok = False
-
-            restart_note = ''
-            if restarts > 10:
-                restart_note = f'  ⚠️重启{restarts}次'
-            elif restarts > 0:
-                restart_note = f'  (重启{restarts}次)'
-
-            lines.append(f"{icon} {name}  {status}  {mem_mb}MB{restart_note}")
-
-        lines.append('')
-        lines.append('全部正常 👍' if all_ok else '⚠️ 有进程不正常，请检查！')
-        send_msg('\n'.join(lines))
-        log("PM2 status report sent at 09:00")
+
+def _http_get_json(url, timeout=20, context=SSL_CTX):
+    req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
+    with urllib.request.urlopen(req, timeout=timeout, context=context) as r:
+        return json.loads(r.read().decode())
+
+
+def _timed_call(fn):
+    t0 = time.time()
+    try:
+        return True, fn(), time.time() - t0
     except Exception as e:
-        send_msg(f"❌ PM2 检查出错：{str(e)[:100]}")
-        log(f"PM2 report error: {e}")
+        return False, e, time.time() - t0
+
+
+def fetch_sources(sources):
+    """Fetch several data sources concurrently on the shared bounded pool.
+    sources: {name: (callable, deadline_sec)}. A source that errors or misses its
+    deadline doesn't affect the others.
+    Returns {name: {"ok": bool, "data": ..., "error": str, "latency": sec}}."""
+    start = time.time()
+    futures = {name: _fetch_pool.submit(_timed_call, fn) for name, (fn, _) in sources.items()}
+    results = {}
+    for name, fut in futures.items():
+        deadline = sources[name][1]
+        try:
+            ok, value, latency = fut.result(timeout=max(0, start + deadline - time.time()))
+        except FuturesTimeout:
+            ok, value, latency = False, TimeoutError(f"超时（>{deadline}s）"), time.time() - start
+        if ok:
+            results[name] = {"ok": True, "data": value, "latency": latency}
+        else:
+            results[name] = {"ok": False, "error": str(value)[:100] or type(value).__name__, "latency": latency}
+        log(f"Fetch {name}: {'ok' if ok else 'FAILED (' + results[name]['error'][:60] + ')'} in {latency:.1f}s")
+    return results
+
+
+def _booking_lines(bookings):
+    lines = []
+    for b in bookings:
+        status_icon = "✅" if b.get('status') == 'accepted' else ("❌" if b.get('status') == 'cancelled' else "⏳")
+        lines.append(f"{status_icon} {b.get('time','?')}  {b.get('name','?')}  {b.get('pax','?')}人")
+    return lines or ["今日暂无预约"]
+
+
+def _print_server_status():
+    ps_resp = _http_get_json("http://localhost:3333/health", timeout=5, context=None)
+    ps_ok = ps_resp.get('status') == 'ok'
+    ps_connected = ps_resp.get('realtimeConnected', False)
+    if ps_ok and ps_connected:
+        return "✅ 打印服务器正常（9:00 已重启）"
+    return f"⚠️ 打印服务器异常 status={ps_resp.get('status')} connected={ps_connected}"
+
+
+# ─── Data Source Cache ───────────────────────────────────────────
+# Apps Script endpoints cold-start in several seconds, so responses are shared process-wide.
+# name -> (url builder, fresh_sec, stale_sec). Within fresh_sec the cached value is served
+# as-is; for a further stale_sec it is served immediately while one refresh runs in the background.
+DATA_SOURCES = {
+    "booking": (lambda date: BOOKING_API_URL + (f"&action={date}" if date else ""), 120, 900),
+    "lds": (lambda _: LDS_API_URL, 300, 1800),
+}
+DATA_CACHE_WAIT = 25     # max seconds a caller waits on someone else's in-flight fetch
+LIVE_DATA_WAIT = 8       # max seconds a Claude prompt waits for live data before going without
+LIVE_DATA_TRIGGERS = {
+    "booking": ("预约", "booking", "订位"),
+    "lds": ("lds", "抽奖", "兑换"),
+}
+
+
+class DataSourceCache:
+    """Process-wide TTL cache for the JSON data sources in DATA_SOURCES.
+    - fresh hit: served from memory
+    - stale hit: served from memory, one background refresh on the fetch pool
+    - miss or force=True: callers share a single upstream fetch (single-flight); the first
+      caller runs it in its own thread, later callers wait on its Future."""
+
+    def __init__(self, sources):
+        self._sources = sources
+        self._lock = threading.Lock()
+        self._entries = {}    # (name, url) -> (value, fetched_ts)
+        self._inflight = {}   # (name, url) -> Future
+        self._stats = {name: {"hits": 0, "stale": 0, "misses": 0, "errors": 0, "fetches": 0, "latency": 0.0}
+                       for name in sources}
+
+    def _key(self, name, key):
+        # Entries are keyed on the URL actually requested, so callers share one only
+        # when they would have made the same upstream call
+        return name, self._sources[name][0](key)
+
+    def _fetch(self, k, fut, timeout=20):
+        name, url = k
+        t0 = time.time()
+        try:
+            value = _http_get_json(url, timeout=timeout)
+        except Exception as e:
+            with self._lock:
+                self._stats[name]["errors"] += 1
+                self._inflight.pop(k, None)
+            log(f"Data source {name} fetch failed: {str(e)[:80]}")
+            fut.set_exception(e)
+            return
+        latency = time.time() - t0
+        with self._lock:
+            self._entries[k] = (value, time.time())
+            st = self._stats[name]
+            st["fetches"] += 1
+            st["latency"] += latency
+            self._inflight.pop(k, None)
+        fut.set_result(value)
+
+    def get(self, name, key=None, force=False, timeout=DATA_CACHE_WAIT):
+        """Return the decoded JSON for data source `name` (raises on upstream failure with no cache).
+        force=True skips the cache but still joins a fetch that is already in flight.
+        timeout bounds both the wait and, when this caller does the fetch, the request itself."""
+        k = self._key(name, key)
+        _, fresh, stale = self._sources[name]
+        with self._lock:
+            st = self._stats[name]
+            entry = self._entries.get(k)
+            age = time.time() - entry[1] if entry else None
+            if entry and not force and age < fresh:
+                st["hits"] += 1
+                return entry[0]
+            if entry and not force and age < fresh + stale:
+                st["stale"] += 1
+                if k not in self._inflight:
+                    fut = self._inflight[k] = Future()
+                    _fetch_pool.submit(self._fetch, k, fut)
+                return entry[0]
+            st["misses"] += 1
+            fut = self._inflight.get(k)
+            owner = fut is None
+            if owner:
+                fut = self._inflight[k] = Future()
+        if owner:
+            self._fetch(k, fut, timeout)
+        return fut.result(timeout=timeout)
+
+    def age(self, name, key=None):
+        """Seconds since (name, key) was last fetched, or None if never."""
+        entry = self._entries.get(self._key(name, key))
+        return time.time() - entry[1] if entry else None
+
+    def stats_line(self):
+        parts = []
+        with self._lock:
+            for name, st in self._stats.items():
+                served = st["hits"] + st["stale"] + st["misses"]
+                if not served:
+                    continue
+                hit_pct = (st["hits"] + st["stale"]) * 100 / served
+                avg = f"{st['latency'] / st['fetches']:.1f}s" if st["fetches"] else "-"
+                err = f" 失败{st['errors']}" if st["errors"] else ""
+                parts.append(f"{name} 命中{hit_pct:.0f}%（{served}次）上游均{avg}{err}")
+        return "；".join(parts) or "暂无请求"
+
+
+data_cache = DataSourceCache(DATA_SOURCES)
+
+
+def _live_data_summary(name, data):
+    if name == "booking":
+        bookings = data.get('bookings', [])
+        head = (f"今日共 {data.get('total', len(bookings))} 张，"
+                f"待处理 {data.get('pending', '?')}，已接受 {data.get('accepted', '?')}")
+        return "\n".join([head] + _booking_lines(bookings))
+    return (f"今日新用户 {data.get('todayNewUsers', '?')}（累计 {data.get('totalUsers', '?')}），"
+            f"今日抽奖 {data.get('todayDraws', '?')}，今日兑换 {data.get('todayVerified', '?')}，"
+            f"待兑换 {data.get('totalPending', '?')}")
+
+
+def live_data_context(text):
+    """Snapshots of the data sources the message asks about, served through data_cache so
+    Claude doesn't have to hit the Apps Script endpoints itself. Empty string if none apply
+    or every fetch fails."""
+    text_lower = text.lower()
+    wanted = {name: (lambda n=name: data_cache.get(n), LIVE_DATA_WAIT)
+              for name, words in LIVE_DATA_TRIGGERS.items() if any(w in text_lower for w in words)}
+    if not wanted:
+        return ""
+    labels = {"booking": "今日预约数据", "lds": "LDS 抽奖数据"}
+    parts = []
+    for name, res in fetch_sources(wanted).items():
+        if res["ok"]:
+            age = data_cache.age(name) or 0
+            parts.append(f"[{labels[name]}（{age:.0f} 秒前获取）]\n" + _live_data_summary(name, res["data"]))
+    return "\n\n".join(parts)
 
 
 def send_daily_report():
-    """Compose and send the daily report. Morning (10am) = booking + LDS brief. Evening (10pm) = full report."""
-    import urllib.request as _urllib
-    import json as _json
-
+    """Compose and send the daily report. Morning (10am) = booking + LDS brief. Evening (10pm) = full report.
+    Sources are fetched concurrently; a failed source shows an error marker instead of aborting the report."""
     now = datetime.now()
     is_morning = now.hour < 12
     period = "早上" if is_morning else "晚上"
@@ -2415,16 +4859,18 @@ def send_daily_report():
     log(f"Daily report triggered at {now.strftime('%H:%M')}")
     send_msg(f"⏰ {period} {now.strftime('%H:%M')} 自动汇报来了，正在查数据...")
 
-    ctx = SSL_CTX  # Use global certifi-backed SSL context
-
-    LDS_API        = "https://script.google.com/macros/s/AKfycbzTxymBxmmliLWpOdg-lh-Ev6tDKyjEf91wgTaDAtxx0gtEsZZrsL9rL9AFv7-XaySlew/exec?page=api&key=zchhp2024"
-    BOOK_API       = "https://script.google.com/macros/s/AKfycbyq1uhgRek_xCtOeAeWnS6mKxoYI4FMSiezAHlGHB-GXkJNGIZNTaotIT76CmKNvoY_/exec?page=api&key=zchhp2024"
-    CHAT_STATS_API = "https://script.google.com/macros/s/AKfycbw45op0Bqn4E8iHIbVLdGi-cLWFt-rEiEooWzwiynd6zIv6WoR7X9vIShdzIjTAa-_v/exec?action=stats&key=zchhp2024"
-
     try:
-        # ── Query Booking (both reports need it) ──
-        req2 = _urllib.Request(BOOK_API, headers={"User-Agent": "Mozilla/5.0"})
-        book = _json.loads(_urllib.urlopen(req2, context=ctx, timeout=20).read().decode())
+        sources = {
+            "booking": (lambda: data_cache.get("booking"), 20),
+            "lds": (lambda: data_cache.get("lds"), 20),
+        }
+        if is_morning:
+            sources["print_server"] = (_print_server_status, 5)
+        res = fetch_sources(sources)
+
+        book_res, lds_res = res["booking"], res["lds"]
+        book = book_res["data"] if book_res["ok"] else {}
+        lds = lds_res["data"] if lds_res["ok"] else {}
         bookings = book.get('bookings', [])
         total_b  = book.get('total', len(bookings))
         pending  = book.get('pending', '?')
@@ -2432,65 +4878,49 @@ def send_daily_report():
 
         if is_morning:
             # ════ 早报 10am：今日预约列表 + 昨日LDS新用户 + 打印服务器状态 ════
-            req = _urllib.Request(LDS_API, headers={"User-Agent": "Mozilla/5.0"})
-            lds = _json.loads(_urllib.urlopen(req, context=ctx, timeout=20).read().decode())
-
-            book_lines = [f"📅 今日预约 {date_str}  共 {total_b} 张"]
-            if bookings:
-                for b in bookings:
-                    status_icon = "✅" if b.get('status') == 'accepted' else ("❌" if b.get('status') == 'cancelled' else "⏳")
-                    line = f"{status_icon} {b.get('time','?')}  {b.get('name','?')}  {b.get('pax','?')}人"
-                    book_lines.append(line)
+            if book_res["ok"]:
+                book_lines = [f"📅 今日预约 {date_str}  共 {total_b} 张"] + _booking_lines(bookings)
+            else:
+                book_lines = [f"📅 今日预约 {date_str}", f"⚠️ 预约数据获取失败：{book_res['error']}"]
+
+            if lds_res["ok"]:
+                lds_line = f"🎰 昨日LDS新用户：{lds.get('todayNewUsers', '?')} 人  累计：{lds.get('totalUsers', '?')} 人"
             else:
-                book_lines.append("今日暂无预约")
+                lds_line = f"🎰 ⚠️ LDS 数据获取失败：{lds_res['error']}"
 
             # ── 打印服务器状态（9点已自动重启，检查是否正常）──
-            try:
-                import urllib.request as _ur2
-                ps_req = _ur2.Request("http://localhost:3333/health", headers={"User-Agent": "Mozilla/5.0"})
-                ps_resp = _json.loads(_ur2.urlopen(ps_req, timeout=5).read().decode())
-                ps_ok = ps_resp.get('status') == 'ok'
-                ps_connected = ps_resp.get('realtimeConnected', False)
-                if ps_ok and ps_connected:
-                    print_status = "✅ 打印服务器正常（9:00 已重启）"
-                else:
-                    print_status = f"⚠️ 打印服务器异常 status={ps_resp.get('status')} connected={ps_connected}"
-            except Exception as _pe:
-                print_status = f"❌ 打印服务器无响应 ({str(_pe)[:50]})"
+            ps_res = res["print_server"]
+            print_status = ps_res["data"] if ps_res["ok"] else f"❌ 打印服务器无响应 ({ps_res['error'][:50]})"
 
             report = (
                 f"🌅 早报 {date_str}\n\n"
                 + "\n".join(book_lines)
-                + f"\n\n🎰 昨日LDS新用户：{lds.get('todayNewUsers', '?')} 人  累计：{lds.get('totalUsers', '?')} 人"
+                + f"\n\n{lds_line}"
                 + f"\n\n🖨 {print_status}"
             )
 
         else:
             # ════ 晚报 10pm：LDS完整 + 预约汇总 + 小慧 + DocuScan ════
-            req = _urllib.Request(LDS_API, headers={"User-Agent": "Mozilla/5.0"})
-            lds = _json.loads(_urllib.urlopen(req, context=ctx, timeout=20).read().decode())
-
             # LDS section
-            lds_lines = [
-                "🎰 【抽奖系统 LDS】",
-                f"今日新用户：{lds.get('todayNewUsers', '?')} 人  累计：{lds.get('totalUsers', '?')} 人",
-                f"今日抽奖：{lds.get('todayDraws', '?')} 次  累计：{lds.get('totalDraws', '?')} 次",
-                f"今日兑换：{lds.get('todayVerified', '?')} 张  累计已兑换：{lds.get('totalVerified', '?')} 张",
-                f"待兑换：{lds.get('totalPending', '?')} 张",
-            ]
+            if lds_res["ok"]:
+                lds_lines = [
+                    "🎰 【抽奖系统 LDS】",
+                    f"今日新用户：{lds.get('todayNewUsers', '?')} 人  累计：{lds.get('totalUsers', '?')} 人",
+                    f"今日抽奖：{lds.get('todayDraws', '?')} 次  累计：{lds.get('totalDraws', '?')} 次",
+                    f"今日兑换：{lds.get('todayVerified', '?')} 张  累计已兑换：{lds.get('totalVerified', '?')} 张",
+                    f"待兑换：{lds.get('totalPending', '?')} 张",
+                ]
+            else:
+                lds_lines = ["🎰 【抽奖系统 LDS】", f"⚠️ 数据获取失败：{lds_res['error']}"]
 
             # Booking section
-            book_lines = [
-                f"📅 【预约系统】今日 {date_str} 共 {total_b} 张",
-                f"待处理：{pending}  已接受：{accepted}",
-            ]
-            if bookings:
-                for b in bookings:
-                    status_icon = "✅" if b.get('status') == 'accepted' else ("❌" if b.get('status') == 'cancelled' else "⏳")
-                    line = f"{status_icon} {b.get('time','?')}  {b.get('name','?')}  {b.get('pax','?')}人"
-                    book_lines.append(line)
+            if book_res["ok"]:
+                book_lines = [
+                    f"📅 【预约系统】今日 {date_str} 共 {total_b} 张",
+                    f"待处理：{pending}  已接受：{accepted}",
+                ] + _booking_lines(bookings)
             else:
-                book_lines.append("今日暂无预约")
+                book_lines = [f"📅 【预约系统】今日 {date_str}", f"⚠️ 数据获取失败：{book_res['error']}"]
 
             report = (
                 f"📊 晚报 {date_str}\n\n"
@@ -2500,128 +4930,446 @@ def send_daily_report():
             )
 
         send_msg(report)
-        log("Daily report sent successfully via API")
+        failed = [name for name, r in res.items() if not r["ok"]]
+        log(f"Daily report sent ({'partial, failed: ' + ', '.join(failed) if failed else 'all sources ok'})")
 
     except Exception as e:
         log(f"Daily report error: {e}")
         send_msg(f"自动汇报出错了 😅\n{str(e)[:300]}")
 
 
+# ─── One-off Scheduled Tasks ─────────────────────────────────────
+SCHEDULED_TASKS_FILE = SCRIPT_DIR / "scheduled_tasks.json"
+SCHEDULED_TASKS_POLL_SEC = 60  # how often external edits to the file are noticed (one stat)
+SCHEDULED_TASKS_RETRY_SEC = 5  # earliest re-fire while a due task is still waiting to be sent
+
+
+class OneOffTaskStore:
+    """scheduled_tasks.json held as an in-memory min-heap.
+    The file is parsed only when its mtime changes and rewritten only when tasks fire,
+    are added or are cancelled. Entry format: {"id", "datetime": "YYYY-MM-DD HH:MM",
+    "label"?, and one of "message" / "message_file" / "action"}."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tasks = {}      # id -> task dict
+        self._heap = []       # (fire_ts, id)
+        self._invalid = []    # unparseable entries, kept as-is in the file
+        self._mtime = None
+
+    @staticmethod
+    def _task_id(task):
+        raw = f"{task.get('datetime')}|{task.get('label')}|{task.get('message')}|{task.get('message_file')}|{task.get('action')}"
+        return hashlib.md5(raw.encode("utf-8")).hexdigest()[:6]
+
+    def _refresh(self):
+        try:
+            mtime = self.path.stat().st_mtime if self.path.exists() else None
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        tasks, heap, invalid = {}, [], []
+        if mtime is not None:
+            try:
+                raw = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception as e:
+                log(f"scheduled_tasks.json unreadable: {e}")
+                raw = []
+            for task in raw:
+                try:
+                    fire = datetime.strptime(task["datetime"], "%Y-%m-%d %H:%M")
+                except (KeyError, ValueError, TypeError):
+                    log(f"Scheduled task with bad datetime skipped: {task}")
+                    invalid.append(task)
+                    continue
+                tid = task.setdefault("id", self._task_id(task))
+                tasks[tid] = task
+                heap.append((fire.timestamp(), tid))
+        heapq.heapify(heap)
+        self._tasks, self._heap, self._invalid, self._mtime = tasks, heap, invalid, mtime
+
+    def _write(self):
+        remaining = sorted(self._tasks.values(), key=lambda t: t["datetime"]) + self._invalid
+        tmp = self.path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(remaining, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.replace(self.path)
+        self._mtime = self.path.stat().st_mtime
+
+    def _peek(self):
+        while self._heap and self._heap[0][1] not in self._tasks:
+            heapq.heappop(self._heap)  # cancelled
+        return self._heap[0][0] if self._heap else None
+
+    def next_due(self):
+        """Timestamp of the earliest pending task, or None."""
+        with self._lock:
+            self._refresh()
+            return self._peek()
+
+    def pop_due(self, now):
+        """Remove and return all tasks due at `now`."""
+        with self._lock:
+            self._refresh()
+            due = []
+            while self._peek() is not None and self._heap[0][0] <= now.timestamp():
+                _, tid = heapq.heappop(self._heap)
+                due.append(self._tasks.pop(tid))
+            if due:
+                self._write()
+            return due
+
+    def add(self, fire_dt, message, label=None):
+        with self._lock:
+            self._refresh()
+            task = {"datetime": fire_dt.strftime("%Y-%m-%d %H:%M"), "message": message}
+            if label:
+                task["label"] = label
+            task["id"] = self._task_id(task)
+            self._tasks[task["id"]] = task
+            heapq.heappush(self._heap, (fire_dt.replace(second=0, microsecond=0).timestamp(), task["id"]))
+            self._write()
+            return task["id"]
+
+    def cancel(self, tid):
+        with self._lock:
+            self._refresh()
+            if self._tasks.pop(tid, None) is None:
+                return False
+            self._write()
+            return True
+
+    def pending(self):
+        with self._lock:
+            self._refresh()
+            return sorted(self._tasks.values(), key=lambda t: t["datetime"])
+
+
+class _OneOffSchedule:
+    """Scheduler adapter: fire at the next due one-off task, and look at the file's
+    mtime every SCHEDULED_TASKS_POLL_SEC so hand/Claude edits are picked up."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def next_after(self, dt):
+        """Strictly after dt: an overdue task stays due until the queued job pops it, so
+        returning dt itself would re-arm the job in a tight loop while the pool is busy."""
+        poll = dt + timedelta(seconds=SCHEDULED_TASKS_POLL_SEC)
+        due = self.store.next_due()
+        if due is None:
+            return poll
+        return min(max(datetime.fromtimestamp(due), dt + timedelta(seconds=SCHEDULED_TASKS_RETRY_SEC)), poll)
+
+
+scheduled_task_store = OneOffTaskStore(SCHEDULED_TASKS_FILE)
+
+
 def check_scheduled_tasks(now):
-    """Check scheduled_tasks.json and send any due tasks."""
-    tasks_file = SCRIPT_DIR / "scheduled_tasks.json"
-    if not tasks_file.exists():
-        return
+    """Send any one-off tasks from scheduled_tasks.json that are due."""
     try:
-        import json as _json
-        with open(tasks_file, "r", encoding="utf-8") as f:
-            tasks = _json.load(f)
-
-        remaining = []
-        for task in tasks:
-            task_dt = datetime.strptime(task["datetime"], "%Y-%m-%d %H:%M")
-            if now >= task_dt:
-                # Send the task
-                action = task.get("action", "")
-                if action == "send_daily_report":
-                    t = threading.Thread(target=send_daily_report, daemon=True)
-                    t.start()
-                elif "message_file" in task:
-                    msg_path = SCRIPT_DIR / task["message_file"]
-                    if msg_path.exists():
-                        with open(msg_path, "r", encoding="utf-8") as mf:
-                            content = mf.read()
-                        # Split into chunks of 3000 chars to avoid Telegram limit
-                        chunks = [content[i:i+3000] for i in range(0, len(content), 3000)]
-                        for chunk in chunks:
-                            send_msg(chunk)
-                elif "message" in task:
-                    send_msg(task["message"])
-                log(f"Scheduled task sent: {task.get('label', task['datetime'])}")
-            else:
-                remaining.append(task)
+        for task in scheduled_task_store.pop_due(now):
+            action = task.get("action", "")
+            if action == "send_daily_report":
+                job_executor.submit("daily_report", send_daily_report, timeout=300)
+            elif "message_file" in task:
+                msg_path = SCRIPT_DIR / task["message_file"]
+                if msg_path.exists():
+                    with open(msg_path, "r", encoding="utf-8") as mf:
+                        content = mf.read()
+                    # Split into chunks of 3000 chars to avoid Telegram limit
+                    chunks = [content[i:i+3000] for i in range(0, len(content), 3000)]
+                    for chunk in chunks:
+                        send_msg(chunk)
+            elif "message" in task:
+                send_msg(task["message"])
+            log(f"Scheduled task sent: {task.get('label', task['datetime'])}")
+    except Exception as e:
+        log(f"check_scheduled_tasks error: {e}")
 
-        with open(tasks_file, "w", encoding="utf-8") as f:
-            _json.dump(remaining, f, ensure_ascii=False, indent=2)
 
+def _parse_schedule_time(date_part, time_part):
+    """'2026-10-20' '09:00' / '10-20' '09:00' / '' '09:00' (today, or tomorrow if passed)."""
+    now = datetime.now()
+    hh, mm = (int(x) for x in time_part.split(":"))
+    if not date_part:
+        dt = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
+        return dt if dt > now else dt + timedelta(days=1)
+    parts = [int(x) for x in date_part.replace("/", "-").split("-")]
+    if len(parts) == 2:
+        parts = [now.year] + parts
+    return datetime(parts[0], parts[1], parts[2], hh, mm)
+
+
+def handle_schedule_command(arg):
+    """/schedule [list] | add [YYYY-MM-DD] HH:MM 内容 | cancel <id>"""
+    parts = arg.split(maxsplit=1)
+    sub = parts[0].lower() if parts else "list"
+    rest = parts[1].strip() if len(parts) > 1 else ""
+
+    if sub == "list":
+        tasks = scheduled_task_store.pending()
+        if not tasks:
+            return "⏰ 没有待发送的定时任务"
+        lines = ["⏰ 定时任务："]
+        for t in tasks:
+            what = t.get("label") or t.get("message") or t.get("message_file") or t.get("action", "?")
+            lines.append(f"[{t['id']}] {t['datetime']}  {str(what)[:60]}")
+        return "\n".join(lines)
+
+    if sub == "add":
+        m = re.match(r'^(?:(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[-/]\d{1,2})\s+)?(\d{1,2}:\d{2})\s+(.+)$', rest, re.DOTALL)
+        if not m:
+            return "用法：/schedule add [2026-10-20] 09:00 提醒内容"
+        try:
+            fire = _parse_schedule_time(m.group(1) or "", m.group(2))
+        except ValueError:
+            return "❌ 时间格式不对，例如：/schedule add 2026-10-20 09:00 提醒内容"
+        if fire <= datetime.now():
+            return f"❌ {fire.strftime('%Y-%m-%d %H:%M')} 已经过去了"
+        tid = scheduled_task_store.add(fire, m.group(3).strip())
+        _scheduler.reschedule("scheduled_tasks")
+        return f"✅ 已安排 [{tid}] {fire.strftime('%Y-%m-%d %H:%M')} 发送"
+
+    if sub == "cancel":
+        if not rest:
+            return "用法：/schedule cancel <id>"
+        if scheduled_task_store.cancel(rest):
+            _scheduler.reschedule("scheduled_tasks")
+            return f"🗑 已取消定时任务 [{rest}]"
+        return f"❌ 找不到定时任务 [{rest}]"
+
+    return "用法：/schedule [list] | add [日期] HH:MM 内容 | cancel <id>"
+
+
+# ─── Supplier Price Sync ─────────────────────────────────────────
+# Sync scripts that define a sync() entry point are loaded once via importlib (reloaded when
+# the file changes) and called directly on the job executor's worker thread:
+#   sync(session=None, argv=None, log=None) -> dict
+#     structured result: items, changed (list or count), ok, error. Each keyword is passed
+#     only if the function accepts it: a pooled requests.Session, the argv the script would
+#     have had on the command line, and a callback for progress lines (kept as the output).
+# Legacy scripts (main() or top-level code only) — or all scripts when SUPPLIER_SYNC_SUBPROCESS=1 —
+# run in a subprocess, so nothing touches the bot's sys.argv / sys.stdout. A subprocess is
+# killed at the script's timeout; an in-process run is bounded by the job's soft timeout, and
+# the executor skips reruns until it returns.
+SUPPLIER_SYNCS = {
+    # name: (label, script, timeout sec)
+    "ddfresh": ("DD Fresh", "sync_supplier_prices.py", 120),
+    "ebuy": ("eBuy", "sync_ebuy_prices.py", 180),
+}
+SUPPLIER_SYNC_SUBPROCESS = os.environ.get("SUPPLIER_SYNC_SUBPROCESS", "") == "1"
+_sync_modules = {}          # script path -> (mtime, module)
+_sync_modules_lock = threading.Lock()
+_http_session = [None]
+supplier_sync_results = {}  # name -> last structured result
+
+
+def get_http_session():
+    """Shared pooled requests.Session (None when requests isn't installed)."""
+    if not REQUESTS_ENABLED:
+        return None
+    if _http_session[0] is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=2)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["User-Agent"] = "Mozilla/5.0"
+        _http_session[0] = session
+    return _http_session[0]
+
+
+def _load_sync_module(path):
+    """Import a sync script (cached; re-imported when its mtime changes)."""
+    mtime = path.stat().st_mtime
+    with _sync_modules_lock:
+        cached = _sync_modules.get(str(path))
+        if cached and cached[0] == mtime:
+            return cached[1]
+        spec = importlib.util.spec_from_file_location(f"supplier_sync_{path.stem}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _sync_modules[str(path)] = (mtime, module)
+        return module
+
+
+def _has_sync_entry(path):
+    """Whether the script defines sync() — importing one without it would run its main code."""
+    try:
+        src = path.read_text(encoding="utf-8", errors="replace")
+    except OSError:
+        return False
+    return bool(re.search(r'^def sync\s*\(', src, re.M))
+
+
+def _run_sync_inprocess(path):
+    entry = _load_sync_module(path).sync
+    params = inspect.signature(entry).parameters
+    lines = []
+    offered = {"session": get_http_session, "argv": lambda: [str(path)],
+               "log": lambda: lambda msg: lines.append(str(msg))}
+    kwargs = {k: make() for k, make in offered.items() if k in params}
+    ret = entry(**kwargs)
+    return (ret if isinstance(ret, dict) else {}), "\n".join(lines)
+
+
+def _run_sync_subprocess(path, timeout):
+    result = subprocess.run(
+        [sys.executable, str(path)],
+        capture_output=True, text=True, timeout=timeout,
+        encoding="utf-8", errors="replace",
+        env={**os.environ, "PYTHONIOENCODING": "utf-8"}
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"exit {result.returncode}: {result.stderr[-200:]}")
+    return {}, result.stdout or ""
+
+
+def run_supplier_sync(name):
+    """Run one supplier sync and return its structured result:
+    {"ok", "mode", "items", "changed" (count), "changes" (list if given), "duration", "output", "error"}."""
+    label, script, timeout = SUPPLIER_SYNCS[name]
+    path = SCRIPT_DIR / script
+    isolated = SUPPLIER_SYNC_SUBPROCESS or not _has_sync_entry(path)
+    res = {"ok": False, "mode": "subprocess" if isolated else "in-process",
+           "items": None, "changed": None, "duration": 0.0, "output": "", "error": ""}
+    t0 = time.time()
+    try:
+        if not path.exists():
+            raise FileNotFoundError(script)
+        ret, output = _run_sync_subprocess(path, timeout) if isolated else _run_sync_inprocess(path)
+        changed = ret.get("changed")
+        res.update(ok=ret.get("ok", True), output=output[-2000:],
+                   items=ret.get("items", ret.get("count")),
+                   changed=len(changed) if isinstance(changed, (list, tuple, dict)) else changed,
+                   changes=changed if isinstance(changed, (list, tuple)) else None)
+        if not res["ok"]:
+            res["error"] = str(ret.get("error") or "sync reported failure")[:300]
     except Exception as e:
-        log(f"check_scheduled_tasks error: {e}")
+        res["error"] = str(e)[:300]
+    res["duration"] = time.time() - t0
+    supplier_sync_results[name] = res
+
+    if res["error"]:
+        log(f"{label} sync error ({res['mode']}, {res['duration']:.1f}s): {res['error']}")
+    else:
+        stats = [f"{res['items']} items" if res["items"] is not None else "",
+                 f"{res['changed']} price changes" if res["changed"] is not None else ""]
+        detail = ", ".join(x for x in stats if x) or (res["output"][-300:].strip() or "no output")
+        log(f"{label} sync done ({res['mode']}, {res['duration']:.1f}s): {detail}")
+    return res
 
 
 def sync_ddfresh_prices():
     """每天 22:10 自动同步 DD Fresh 最新报价（DD Fresh 22:00 更新）"""
-    try:
-        import subprocess
-        script = str(SCRIPT_DIR / "sync_supplier_prices.py")
-        result = subprocess.run(
-            ["python", script],
-            capture_output=True, text=True, timeout=120,
-            encoding="utf-8", errors="replace",
-            env={**os.environ, "PYTHONIOENCODING": "utf-8"}
-        )
-        log(f"DD Fresh sync done: {result.stdout[-300:] if result.stdout else 'no output'}")
-        if result.returncode != 0:
-            log(f"DD Fresh sync error: {result.stderr[-200:]}")
-    except Exception as e:
-        log(f"DD Fresh sync exception: {e}")
+    run_supplier_sync("ddfresh")
 
 
 def sync_ebuy_prices():
     """每天 22:20 自动同步 eBuy 最新报价"""
-    try:
-        import subprocess
-        script = str(SCRIPT_DIR / "sync_ebuy_prices.py")
-        result = subprocess.run(
-            ["python", script],
-            capture_output=True, text=True, timeout=180,
-            encoding="utf-8", errors="replace",
-            env={**os.environ, "PYTHONIOENCODING": "utf-8"}
-        )
-        log(f"eBuy sync done: {result.stdout[-300:] if result.stdout else 'no output'}")
-        if result.returncode != 0:
-            log(f"eBuy sync error: {result.stderr[-200:]}")
-    except Exception as e:
-        log(f"eBuy sync exception: {e}")
+    run_supplier_sync("ebuy")
 
 
 # ─── Health Check System ─────────────────────────────────────────
 HEALTH_STATE_FILE = SCRIPT_DIR / "health_state.json"
+HEALTH_PROBE_TIMEOUT = DATA_CACHE_WAIT  # >= any data fetch: a slow answer is "slow", not down
+HEALTH_HISTORY_MAX = 7 * 24 * 6     # ring buffer per system: 7 days of 10-minute probes
+HEALTH_ALERT_HOURS = range(8, 24)   # flips outside these hours are reported at 08:00
+HEALTH_SLOW_RUN = 3                 # consecutive slow probes before a latency alert
+HEALTH_SLOW_FACTOR = 3.0            # slow = this many times the 7-day median latency...
+HEALTH_SLOW_FLOOR_MS = 3000         # ...and at least this slow in absolute terms
+HEALTH_BASELINE_MIN = 20            # successful samples needed before latency alerts
+
+# Apps Script sources go through the shared data cache with a forced refresh: the probe
+# always reaches upstream and everyone else gets the fresh copy.
+HEALTH_SYSTEMS = {
+    "POS System": "https://pos-system-hazel-psi.vercel.app/api/menu/categories",
+    "Booking": "booking",
+    "LDS": "lds",
+}
+
 
 def load_health_state():
-    """Load last health check status from disk."""
+    """Load health state from disk.
+    Format: {system: bool (last alerted up/down), "slow": {system: bool},
+             "samples": {system: [[ts, latency_ms, http_code, ok], ...]}}.
+    Older files hold only the {system: bool} part and load as-is."""
+    state = {}
     if HEALTH_STATE_FILE.exists():
         try:
             with open(HEALTH_STATE_FILE, 'r') as f:
-                return json.load(f)
+                state = json.load(f)
         except:
             pass
-    return {}
+    state["slow"] = state.get("slow") or {}
+    state["samples"] = {name: deque(map(tuple, rows), maxlen=HEALTH_HISTORY_MAX)
+                        for name, rows in (state.get("samples") or {}).items()}
+    return state
 
 def save_health_state(state):
-    """Save health check status to disk."""
-    with open(HEALTH_STATE_FILE, 'w') as f:
-        json.dump(state, f)
+    """Save health state to disk (atomic)."""
+    out = dict(state)
+    out["samples"] = {name: [list(r) for r in rows] for name, rows in state.get("samples", {}).items()}
+    tmp = HEALTH_STATE_FILE.with_suffix(".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(out, f)
+    tmp.replace(HEALTH_STATE_FILE)
+
+
+def _probe_system(target):
+    """Probe one system. Returns (http_code, ok); code 0 = no HTTP response."""
+    try:
+        if target in DATA_SOURCES:
+            data_cache.get(target, force=True, timeout=HEALTH_PROBE_TIMEOUT)
+            return 200, True
+        req = urllib.request.Request(target)
+        with urllib.request.urlopen(req, timeout=HEALTH_PROBE_TIMEOUT, context=SSL_CTX) as resp:
+            return resp.status, 200 <= resp.status < 400
+    except urllib.error.HTTPError as e:
+        return e.code, False
+    except Exception:
+        return 0, False
+
+
+def _percentile(values, q):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+def _latency_regressed(samples):
+    """True when the last HEALTH_SLOW_RUN probes all succeeded but were far slower than usual."""
+    ok = [r[1] for r in samples if r[3]]
+    recent = list(samples)[-HEALTH_SLOW_RUN:]
+    if len(ok) < HEALTH_BASELINE_MIN + HEALTH_SLOW_RUN or len(recent) < HEALTH_SLOW_RUN:
+        return False
+    if not all(r[3] for r in recent):
+        return False  # an outage is reported as down, not slow
+    baseline = _percentile(ok[:-HEALTH_SLOW_RUN], 50)
+    threshold = max(HEALTH_SLOW_FLOOR_MS, baseline * HEALTH_SLOW_FACTOR)
+    return all(r[1] > threshold for r in recent)
+
 
 def check_system_health():
-    """Check health of all critical systems, send alert if status changes."""
+    """Probe all critical systems concurrently, record latency history, and alert when a system
+    goes down/up or its latency regresses for several probes in a row."""
     health_state = load_health_state()
+    samples = health_state["samples"]
+    now = time.time()
 
-    # Define systems to monitor
-    systems = {
-        "POS System": "https://pos-system-hazel-psi.vercel.app/api/menu/categories",
-        "Booking": "https://script.google.com/macros/s/AKfycbyq1uhgRek_xCtOeAeWnS6mKxoYI4FMSiezAHlGHB-GXkJNGIZNTaotIT76CmKNvoY_/exec?page=api&key=zchhp2024",
-        "LDS": "https://script.google.com/macros/s/AKfycbzTxymBxmmliLWpOdg-lh-Ev6tDKyjEf91wgTaDAtxx0gtEsZZrsL9rL9AFv7-XaySlew/exec?page=api&key=zchhp2024",
-    }
+    results = fetch_sources({name: (lambda t=target: _probe_system(t), HEALTH_PROBE_TIMEOUT + 5)
+                             for name, target in HEALTH_SYSTEMS.items()})
 
     alerts = []
+    may_alert = datetime.now().hour in HEALTH_ALERT_HOURS
 
-    for system_name, url in systems.items():
-        try:
-            req = urllib.request.Request(url)
-            with urllib.request.urlopen(req, timeout=10, context=SSL_CTX) as resp:
-                is_healthy = 200 <= resp.status < 400
-        except:
-            is_healthy = False
+    for system_name, res in results.items():
+        code, is_healthy = res["data"] if res["ok"] else (0, False)
+        rows = samples.setdefault(system_name, deque(maxlen=HEALTH_HISTORY_MAX))
+        rows.append((int(now), int(res["latency"] * 1000), code, int(is_healthy)))
+        if not may_alert:
+            continue  # keep the last alerted status, so a night-time flip is reported in the morning
 
         # Check if status changed
         prev_status = health_state.get(system_name, True)  # default to healthy
@@ -2629,15 +5377,51 @@ def check_system_health():
             if is_healthy:
                 alerts.append(f"✅ {system_name} 已恢复正常")
             else:
-                alerts.append(f"⚠️ {system_name} 无法访问！")
+                alerts.append(f"⚠️ {system_name} 无法访问！（HTTP {code or '无响应'}）")
             health_state[system_name] = is_healthy
 
+        slow = _latency_regressed(rows)
+        if is_healthy and slow != health_state["slow"].get(system_name, False):
+            ok_ms = [r[1] for r in rows if r[3]]
+            recent_s = sum(r[1] for r in list(rows)[-HEALTH_SLOW_RUN:]) / HEALTH_SLOW_RUN / 1000
+            usual_s = _percentile(ok_ms, 50) / 1000
+            if slow:
+                alerts.append(f"🐢 {system_name} 响应变慢：最近 {HEALTH_SLOW_RUN} 次平均 {recent_s:.1f}s（平常 {usual_s:.1f}s）")
+            else:
+                alerts.append(f"✅ {system_name} 响应速度已恢复（{rows[-1][1] / 1000:.1f}s）")
+            health_state["slow"][system_name] = slow
+
     if alerts:
         send_msg("系统监控告警:\n" + "\n".join(alerts))
 
     save_health_state(health_state)
 
 
+def uptime_report():
+    """Availability and p95 latency per system over 24h and 7d, from the probe history."""
+    samples = load_health_state()["samples"]
+    if not samples:
+        return "📡 还没有健康检查记录"
+    now = time.time()
+    lines = ["📡 系统可用性（SLO）"]
+    for name in list(HEALTH_SYSTEMS) + [n for n in samples if n not in HEALTH_SYSTEMS]:
+        rows = samples.get(name)
+        if not rows:
+            continue
+        last = rows[-1]
+        icon = "🟢" if last[3] else "🔴"
+        lines.append(f"\n{icon} {name}（最近 {last[1] / 1000:.1f}s, HTTP {last[2] or '-'}）")
+        for label, window in (("24h", 86400), ("7d", 7 * 86400)):
+            sel = [r for r in rows if r[0] >= now - window]
+            if not sel:
+                continue
+            avail = sum(r[3] for r in sel) * 100 / len(sel)
+            ok_ms = [r[1] for r in sel if r[3]]
+            p95 = f"{_percentile(ok_ms, 95) / 1000:.1f}s" if ok_ms else "-"
+            lines.append(f"  {label}：可用 {avail:.2f}%  p95 {p95}  （{len(sel)} 次探测）")
+    return "\n".join(lines)
+
+
 def nightly_self_review(memory):
     """23:30 自我学习：让 Claude 从今天的对话里提炼关键知识，存进 knowledge_base。"""
     history = memory.get("history", [])
@@ -2646,11 +5430,11 @@ def nightly_self_review(memory):
 
     # 取最近40条对话（当天为主）
     today = time.strftime("%m/%d")
-    today_entries = [h for h in history if today in h]
+    today_entries = [h for h in history if h.day() == today]
     if len(today_entries) < 3:
         return  # 今天对话太少，不值得提炼
 
-    entries_text = "\n".join(today_entries[-40:])
+    entries_text = "\n".join(h.render() for h in today_entries[-40:])
     prompt = f"""以下是今天的对话记录：
 
 {entries_text}
@@ -2660,6 +5444,7 @@ def nightly_self_review(memory):
 请用 JSON 格式回复，只输出 JSON，不要其他文字：
 {{
   "people": {{"姓名": "关键信息，如职位/薪资结构/特殊情况"}},
+  "aliases": {{"对话里用到的昵称/简称": "对应的正式姓名或系统名"}},
   "rules": ["重要业务规则或决策"],
   "lessons": ["值得记住的教训或最佳实践"]
 }}
@@ -2667,33 +5452,35 @@ def nightly_self_review(memory):
 如果某类没有新内容，对应字段用空对象/空数组。"""
 
     try:
+        t_start = time.time()
         result = run_claude(prompt, memory, continue_session=False)
+        _track_usage(result, time.time() - t_start)
         # 从结果里提取 JSON
         json_match = re.search(r'\{[\s\S]+\}', result)
         if not json_match:
             return
         extracted = json.loads(json_match.group())
 
-        kb = memory.setdefault("knowledge_base", {
-            "people": {}, "systems": {}, "rules": [], "lessons": []
-        })
+        kb = _get_kb(memory)
 
         # 更新 people
         for name, info in extracted.get("people", {}).items():
             if name and info:
-                kb["people"][name] = info
+                add_to_knowledge_base(memory, "people", name, info)
 
-        # 追加 rules（去重）
-        for rule in extracted.get("rules", []):
-            if rule and rule not in kb["rules"]:
-                kb["rules"].append(rule)
-        kb["rules"] = kb["rules"][-30:]
+        # 别名 → 正式名（只收 KB 里已有的人/系统，名字匹配注入时会用到）
+        for alias, name in (extracted.get("aliases") or {}).items():
+            if alias and isinstance(name, str) and alias != name and (
+                    name in kb.get("people", {}) or name in kb.get("systems", {})):
+                add_to_knowledge_base(memory, "aliases", alias, name)
 
-        # 追加 lessons（去重）
+        # 追加 rules / lessons（近似去重：意思相同的合并，按频率+新近度淘汰）
+        for rule in extracted.get("rules", []):
+            if isinstance(rule, str):
+                kb_add_fact(kb, "rules", rule)
         for lesson in extracted.get("lessons", []):
-            if lesson and lesson not in kb["lessons"]:
-                kb["lessons"].append(lesson)
-        kb["lessons"] = kb["lessons"][-30:]
+            if isinstance(lesson, str):
+                kb_add_fact(kb, "lessons", lesson)
 
         save_memory(memory)
         log(f"Nightly self-review done: {len(extracted.get('people',{}))} people, "
@@ -2702,52 +5489,307 @@ def nightly_self_review(memory):
         log(f"Nightly self-review error: {e}")
 
 
-def check_pos_anomaly():
-    """检查今日 POS 销售是否异常（vs 7天均值），如有大幅偏差则告警。"""
-    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
-        return
-
-    try:
-        # 查今天和过去7天的订单数/营业额
-        today = time.strftime("%Y-%m-%d")
-        url = f"{SUPABASE_URL}/rest/v1/pos_orders?select=total,closed_at&status=eq.closed&closed_at=gte.{today}T00:00:00"
-        req = urllib.request.Request(url, headers={
-            "apikey": SUPABASE_SERVICE_KEY,
-            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-        })
-        with urllib.request.urlopen(req, timeout=15, context=SSL_CTX) as r:
-            today_orders = json.loads(r.read())
-
-        if not today_orders:
+# ─── POS Aggregates ──────────────────────────────────────────────
+# Sales figures are aggregated by Supabase where possible instead of downloading every order:
+#   totals  — PostgREST aggregate select (count(), total.sum()); falls back to streaming
+#   hourly  — optional RPC (POS_AGG_RPC, see pos_hourly), else Range-paginated streaming
+# Completed days never change, so their hourly buckets are fetched once and cached locally.
+POS_AGG_CACHE_FILE = SCRIPT_DIR / "pos_agg_cache.json"
+POS_AGG_KEEP_DAYS = 120
+POS_PAGE_SIZE = 1000
+POS_AGG_RPC = os.environ.get("POS_AGG_RPC", "")   # e.g. "pos_hourly_totals"; empty = stream rows
+_pos_agg_supported = [True]   # flips to False once PostgREST rejects aggregate functions
+_pos_agg_lock = threading.Lock()
+_POS_TS_RE = re.compile(r'(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d)(?:\.\d+)?(Z|[+-]\d\d(?::?\d\d)?)?')
+
+
+def _supabase_request(path, headers=None, body=None, timeout=15):
+    """Call Supabase REST. Returns (decoded JSON, response headers)."""
+    hdrs = {
+        "apikey": SUPABASE_SERVICE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+        **(headers or {}),
+    }
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode()
+        hdrs["Content-Type"] = "application/json"
+    req = urllib.request.Request(f"{SUPABASE_URL}/rest/v1/{path}", data=data, headers=hdrs)
+    with urllib.request.urlopen(req, timeout=timeout, context=SSL_CTX) as r:
+        return json.loads(r.read() or b"null"), r.headers
+
+
+def _pos_window_filter(start, end):
+    """PostgREST filter for closed orders in [start, end) (local datetimes, sent with offset)."""
+    q = urllib.parse.quote
+    return (f"status=eq.closed&closed_at=gte.{q(start.astimezone().isoformat())}"
+            f"&closed_at=lt.{q(end.astimezone().isoformat())}")
+
+
+def _parse_pos_ts(value):
+    """Supabase timestamptz string → naive local datetime (None if unparseable)."""
+    m = _POS_TS_RE.match(value or "")
+    if not m:
+        return None
+    base, tz = m.groups()
+    tz = {None: "+00:00", "Z": "+00:00"}.get(tz, tz)
+    if len(tz) == 3:
+        tz += ":00"
+    elif ":" not in tz:
+        tz = f"{tz[:3]}:{tz[3:]}"
+    return datetime.fromisoformat(base.replace(" ", "T") + tz).astimezone().replace(tzinfo=None)
+
+
+def _pos_stream(start, end, select):
+    """Yield closed orders in [start, end) page by page (Range header), so memory stays flat."""
+    offset = 0
+    while True:
+        rows, _ = _supabase_request(
+            f"pos_orders?select={select}&{_pos_window_filter(start, end)}&order=closed_at.asc,id.asc",
+            headers={"Range-Unit": "items", "Range": f"{offset}-{offset + POS_PAGE_SIZE - 1}"},
+        )
+        yield from rows
+        if len(rows) < POS_PAGE_SIZE:
             return
+        offset += POS_PAGE_SIZE
 
-        today_count = len(today_orders)
-        today_revenue = sum(float(o.get("total", 0) or 0) for o in today_orders)
 
-        # 查过去7天
-        from datetime import timedelta
-        week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-        url7 = f"{SUPABASE_URL}/rest/v1/pos_orders?select=total,closed_at&status=eq.closed&closed_at=gte.{week_ago}T00:00:00&closed_at=lt.{today}T00:00:00"
-        req7 = urllib.request.Request(url7, headers={
-            "apikey": SUPABASE_SERVICE_KEY,
-            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
-        })
-        with urllib.request.urlopen(req7, timeout=15, context=SSL_CTX) as r:
-            week_orders = json.loads(r.read())
+def pos_window_totals(start, end):
+    """(order count, revenue) for [start, end), aggregated server-side when PostgREST allows it."""
+    if _pos_agg_supported[0]:
+        try:
+            rows, _ = _supabase_request(f"pos_orders?select=count(),total.sum()&{_pos_window_filter(start, end)}")
+            row = rows[0] if rows else {}
+            return int(row.get("count") or 0), float(row.get("sum") or 0)
+        except urllib.error.HTTPError as e:
+            if e.code != 400:
+                raise
+            _pos_agg_supported[0] = False
+            log("POS: PostgREST aggregates disabled — falling back to streamed totals")
+    count = revenue = 0
+    for o in _pos_stream(start, end, "total"):
+        count += 1
+        revenue += float(o.get("total") or 0)
+    return count, revenue
+
+
+def pos_hourly(start, end):
+    """{hour 0-23: [count, revenue]} for closed orders in [start, end), local hours.
+    With POS_AGG_RPC set, Postgres does the grouping. Expected function:
+        create function pos_hourly_totals(start_ts timestamptz, end_ts timestamptz)
+        returns table(hour timestamptz, orders bigint, revenue numeric) language sql stable as $$
+          select date_trunc('hour', closed_at), count(*), coalesce(sum(total), 0) from pos_orders
+          where status = 'closed' and closed_at >= start_ts and closed_at < end_ts group by 1 $$;"""
+    buckets = {}
+    if POS_AGG_RPC:
+        rows, _ = _supabase_request(f"rpc/{POS_AGG_RPC}", body={
+            "start_ts": start.astimezone().isoformat(), "end_ts": end.astimezone().isoformat()})
+        for r in rows or []:
+            ts = _parse_pos_ts(r.get("hour"))
+            if ts is None:
+                continue
+            b = buckets.setdefault(ts.hour, [0, 0.0])
+            b[0] += int(r.get("orders") or 0)
+            b[1] += float(r.get("revenue") or 0)
+        return buckets
+    for o in _pos_stream(start, end, "total,closed_at"):
+        ts = _parse_pos_ts(o.get("closed_at"))
+        if ts is None:
+            continue
+        b = buckets.setdefault(ts.hour, [0, 0.0])
+        b[0] += 1
+        b[1] += float(o.get("total") or 0)
+    return buckets
+
+
+def _load_pos_agg_cache():
+    try:
+        return json.loads(POS_AGG_CACHE_FILE.read_text(encoding="utf-8"))
+    except Exception:
+        return {"days": {}}
+
+
+def _save_pos_agg_cache(cache):
+    tmp = POS_AGG_CACHE_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(cache, ensure_ascii=False), encoding="utf-8")
+    tmp.replace(POS_AGG_CACHE_FILE)
+
+
+def pos_daily_aggregates(days_back):
+    """{"YYYY-MM-DD": {"count", "revenue", "hours": {"H": [count, revenue]}}} for the last
+    days_back completed days. Only days missing from pos_agg_cache.json are fetched."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    with _pos_agg_lock:
+        cache = _load_pos_agg_cache()
+        days = cache.setdefault("days", {})
+        fetched = 0
+        for i in range(days_back, 0, -1):
+            day = today - timedelta(days=i)
+            key = day.strftime("%Y-%m-%d")
+            if key in days:
+                continue
+            hours = pos_hourly(day, day + timedelta(days=1))
+            days[key] = {
+                "count": sum(c for c, _ in hours.values()),
+                "revenue": round(sum(r for _, r in hours.values()), 2),
+                "hours": {str(h): [c, round(r, 2)] for h, (c, r) in sorted(hours.items())},
+            }
+            fetched += 1
+        if fetched:
+            cutoff = (today - timedelta(days=POS_AGG_KEEP_DAYS)).strftime("%Y-%m-%d")
+            cache["days"] = {k: v for k, v in days.items() if k >= cutoff}
+            _save_pos_agg_cache(cache)
+            log(f"POS aggregates: fetched {fetched} day(s), {len(cache['days'])} cached")
+        start_key = (today - timedelta(days=days_back)).strftime("%Y-%m-%d")
+        return {k: v for k, v in cache["days"].items() if k >= start_key}
+
+
+# ─── POS Baseline ────────────────────────────────────────────────
+# Per weekday × hour baseline from the cached daily aggregates: median and MAD of hourly
+# and cumulative order counts / revenue over the last POS_BASELINE_DAYS days. Built once per
+# day; each check then only fetches today's unsettled hours, so it can run every 15 minutes.
+POS_BASELINE_DAYS = 56
+POS_BASELINE_MIN_DAYS = 3        # fewer same-weekday days → use all weekdays for that hour
+POS_ANOMALY_K = 3.0              # alert below median - K × robust sigma
+POS_MIN_EXPECTED_ORDERS = 3      # ignore hours that are normally this quiet
+POS_LATE_GRACE_MIN = 5           # an hour is settled this many minutes after it ends
+POS_WEEKDAYS = "一二三四五六日"
+# Feature offsets in a baseline row: 24 hourly counts, 24 hourly revenue, then cumulative of each
+_F_COUNT, _F_REV, _F_CUM_COUNT, _F_CUM_REV = 0, 24, 48, 72
+_pos_baseline_cache = {}   # date -> {weekday | "all": (n_days, medians, mads)}
+
+
+def _median_mad(rows):
+    """Column-wise median and MAD of a days × features matrix."""
+    if NUMPY_ENABLED:
+        a = np.asarray(rows, dtype="f8")
+        med = np.median(a, axis=0)
+        return med.tolist(), np.median(np.abs(a - med), axis=0).tolist()
+    cols = list(zip(*rows))
+    med = [statistics.median(c) for c in cols]
+    return med, [statistics.median(abs(v - m) for v in c) for c, m in zip(cols, med)]
+
+
+def _pos_feature_row(hours):
+    """{hour: [count, revenue]} → flat feature row (see _F_* offsets)."""
+    cnt = [0] * 24
+    rev = [0.0] * 24
+    for h, (c, r) in hours.items():
+        cnt[int(h)], rev[int(h)] = c, r
+    return cnt + rev + list(accumulate(cnt)) + list(accumulate(rev))
+
+
+def pos_hour_baseline():
+    """Baseline for today, computed once per day from pos_agg_cache.json."""
+    key = datetime.now().strftime("%Y-%m-%d")
+    if key not in _pos_baseline_cache:
+        groups = {}
+        for day, agg in pos_daily_aggregates(POS_BASELINE_DAYS).items():
+            if not agg["count"]:
+                continue  # closed that day
+            row = _pos_feature_row(agg["hours"])
+            groups.setdefault(datetime.strptime(day, "%Y-%m-%d").weekday(), []).append(row)
+            groups.setdefault("all", []).append(row)
+        _pos_baseline_cache.clear()
+        _pos_baseline_cache[key] = {g: (len(rows),) + _median_mad(rows) for g, rows in groups.items()}
+    return _pos_baseline_cache[key]
+
+
+def pos_today_hours(now):
+    """Today's {hour: [count, revenue]} plus the persisted today-state (alert dedupe).
+    Settled hours are fetched once and kept in pos_agg_cache.json; unsettled ones (the current
+    hour, and the previous one for POS_LATE_GRACE_MIN) are re-read as single aggregate rows."""
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    today = midnight.strftime("%Y-%m-%d")
+    with _pos_agg_lock:
+        cache = _load_pos_agg_cache()
+        state = cache.get("today")
+        if not state or state.get("date") != today:
+            state = cache["today"] = {"date": today, "settled": 0, "hours": {}, "alerted": []}
+        # Hours before this one are final; in the grace window just after midnight that is
+        # none of today's (now - grace falls on yesterday, whose hour would read as 23)
+        settled = max(0, int((now - timedelta(minutes=POS_LATE_GRACE_MIN) - midnight).total_seconds() // 3600))
+        if settled > state["settled"]:
+            got = pos_hourly(midnight + timedelta(hours=state["settled"]), midnight + timedelta(hours=settled))
+            for h in range(state["settled"], settled):
+                c, r = got.get(h, [0, 0.0])
+                state["hours"][str(h)] = [c, round(r, 2)]
+            state["settled"] = settled
+            _save_pos_agg_cache(cache)
+    hours = {int(h): v for h, v in state["hours"].items()}
+    for h in range(state["settled"], now.hour + 1):
+        start = midnight + timedelta(hours=h)
+        hours[h] = list(pos_window_totals(start, min(now, start + timedelta(hours=1))))
+    return hours, state
+
+
+def _pos_mark_alerted(keys):
+    with _pos_agg_lock:
+        cache = _load_pos_agg_cache()
+        state = cache.get("today") or {}
+        state.setdefault("alerted", []).extend(keys)
+        _save_pos_agg_cache(cache)
+
+
+def _pos_expected(baseline, weekday, idx):
+    """(median, robust sigma, label) for feature idx, preferring same-weekday history."""
+    n, med, mad = baseline.get(weekday, (0, None, None))
+    label = f"周{POS_WEEKDAYS[weekday]}"
+    if n < POS_BASELINE_MIN_DAYS:
+        n, med, mad = baseline["all"]
+        label = "平日"
+    return med[idx], 1.4826 * mad[idx], label
 
-        if not week_orders:
-            return
 
-        avg_daily_count = len(week_orders) / 7
-        avg_daily_revenue = sum(float(o.get("total", 0) or 0) for o in week_orders) / 7
+def check_pos_anomaly():
+    """检查 POS 销售是否异常：按星期×小时的历史基线，检查上一个完整小时、当前小时和今日累计。"""
+    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+        return
 
-        alerts = []
-        if avg_daily_count > 5 and today_count < avg_daily_count * 0.5:
-            alerts.append(f"今日订单数 {today_count} 笔，比7天均值 {avg_daily_count:.0f} 少超过50%！")
-        if avg_daily_revenue > 100 and today_revenue < avg_daily_revenue * 0.5:
-            alerts.append(f"今日营业额 RM{today_revenue:.0f}，比7天均值 RM{avg_daily_revenue:.0f} 少超过50%！")
+    try:
+        now = datetime.now()
+        baseline = pos_hour_baseline()
+        if "all" not in baseline:
+            return  # no history yet
+        hours, state = pos_today_hours(now)
+        alerted = set(state.get("alerted", []))
+        wd = now.weekday()
+        alerts, keys = [], []
+
+        def low(value, idx, floor):
+            med, sigma, label = _pos_expected(baseline, wd, idx)
+            return value < med - POS_ANOMALY_K * max(sigma, floor * med, 1.0), med, label
+
+        # 1. Current hour so far (prorated), once at least half of it has passed
+        h, frac = now.hour, now.minute / 60
+        count = hours.get(h, [0, 0.0])[0]
+        med, _, label = _pos_expected(baseline, wd, _F_COUNT + h)
+        if frac >= 0.5 and med * frac >= POS_MIN_EXPECTED_ORDERS and f"cur{h}" not in alerted:
+            is_low, _, _ = low(count / frac, _F_COUNT + h, 0.25)
+            if is_low:
+                alerts.append(f"{h:02d}:00 起 {now.minute} 分钟只有 {count} 笔订单（{label}这个时段平常约 {med * frac:.0f} 笔）")
+                keys += [f"cur{h}", f"hour{h}"]
+
+        # 2. Last settled hour
+        h = state["settled"] - 1
+        if h >= 0 and f"hour{h}" not in alerted and f"hour{h}" not in keys:
+            count = hours.get(h, [0, 0.0])[0]
+            is_low, med, label = low(count, _F_COUNT + h, 0.25)
+            if is_low and med >= POS_MIN_EXPECTED_ORDERS:
+                alerts.append(f"{h:02d}:00-{h + 1:02d}:00 只有 {count} 笔订单（{label}这个时段平常约 {med:.0f} 笔）")
+                keys.append(f"hour{h}")
+
+        # 3. Cumulative revenue through the last settled hour (once a day)
+        if h >= 0 and "cum" not in alerted:
+            revenue = sum(v[1] for hh, v in hours.items() if hh <= h)
+            med_count = _pos_expected(baseline, wd, _F_CUM_COUNT + h)[0]
+            is_low, med, label = low(revenue, _F_CUM_REV + h, 0.2)
+            if is_low and med_count >= POS_MIN_EXPECTED_ORDERS:
+                alerts.append(f"今日截至 {h + 1:02d}:00 营业额 RM{revenue:.0f}（{label}此时平常约 RM{med:.0f}）")
+                keys.append("cum")
 
         if alerts:
+            _pos_mark_alerted(keys)
             send_msg("⚠️ POS 异常检测：\n" + "\n".join(alerts))
             log(f"POS anomaly alert sent: {alerts}")
 
@@ -2755,121 +5797,418 @@ def check_pos_anomaly():
         log(f"POS anomaly check error: {e}")
 
 
-def daily_reporter_thread():
-    """Background daemon thread: check time every minute, trigger scheduled tasks."""
-    sent_keys = set()   # (date_str, label) pairs already sent today
-    last_health_check = 0  # timestamp of last health check
-    last_mailbox_check = 0  # timestamp of last mailbox check
-
-    # Memory reference passed from main
-    _memory_ref = [None]
-
-    def get_mem():
-        """Get memory from global memory variable."""
+# ─── Job Executor ────────────────────────────────────────────────
+# Background jobs (scheduled and one-off) share one bounded pool. Each job name has a
+# concurrency limit — a trigger that finds the job already at its limit is skipped rather
+# than stacked — and a soft timeout: Python threads can't be killed, so an overrunning run
+# is logged and flagged, and keeps its slot until it actually returns.
+JOB_POOL_WORKERS = 4
+JOB_DEFAULT_TIMEOUT = 600
+JOB_RECENT_MAX = 30
+
+
+class JobExecutor:
+    """Bounded executor for background jobs with per-job limits and run metrics."""
+
+    def __init__(self, max_workers):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._queued = {}     # name -> runs waiting for a worker
+        self._active = {}     # name -> runs executing
+        self._skip_logged = set()   # names whose current run has already logged a skipped trigger
+        self._running = {}    # run id -> {"name", "queued", "started", "timeout", "timed_out"}
+        self._stats = {}      # name -> counters
+        self._recent = deque(maxlen=JOB_RECENT_MAX)
+
+    def _stat(self, name):
+        return self._stats.setdefault(name, {"runs": 0, "ok": 0, "errors": 0, "timeouts": 0,
+                                             "skipped": 0, "total_sec": 0.0, "last_sec": 0.0})
+
+    def submit(self, name, func, *args, max_concurrent=1, timeout=JOB_DEFAULT_TIMEOUT):
+        """Queue func(*args) under `name`. Returns a Future, or None if skipped (limit reached).
+        Queued and running runs both count towards max_concurrent; the timeout starts when
+        the run gets a worker."""
+        with self._lock:
+            queued, active = self._queued.get(name, 0), self._active.get(name, 0)
+            if queued + active >= max_concurrent:
+                self._stat(name)["skipped"] += 1
+                if name not in self._skip_logged:
+                    self._skip_logged.add(name)
+                    log(f"Job {name} still {'running' if active else 'queued'} — "
+                        f"further triggers skipped until it finishes")
+                return None
+            self._queued[name] = queued + 1
+            self._seq += 1
+            run_id = self._seq
+            self._running[run_id] = {"name": name, "queued": time.time(), "started": None,
+                                     "timeout": timeout, "timed_out": False}
+        return self._pool.submit(self._run, run_id, name, func, args)
+
+    def _on_timeout(self, run_id, timeout):
+        with self._lock:
+            run = self._running.get(run_id)
+            if not run or run["timed_out"]:
+                return
+            run["timed_out"] = True
+            self._stat(run["name"])["timeouts"] += 1
+        log(f"⏱️ Job {run['name']} exceeded {timeout}s and is still running")
+
+    def _run(self, run_id, name, func, args):
+        with self._lock:
+            run = self._running[run_id]
+            run["started"] = time.time()
+            self._queued[name] -= 1
+            self._active[name] = self._active.get(name, 0) + 1
+        timer = None
+        if run["timeout"]:
+            timer = threading.Timer(run["timeout"], self._on_timeout, (run_id, run["timeout"]))
+            timer.daemon = True
+            timer.start()
+        outcome, error = "ok", ""
         try:
-            import __main__
-            return getattr(__main__, '_global_memory', None)
+            func(*args)
+        except Exception as e:
+            outcome, error = "error", str(e)[:100]
+            log(f"Job {name} error: {e}")
+        finally:
+            if timer:
+                timer.cancel()
+            with self._lock:
+                run = self._running.pop(run_id)
+                self._active[name] -= 1
+                self._skip_logged.discard(name)
+                if run["timed_out"] and outcome == "ok":
+                    outcome = "timeout"
+                elapsed = time.time() - run["started"]
+                st = self._stat(name)
+                st["runs"] += 1
+                if outcome == "ok":
+                    st["ok"] += 1
+                elif outcome == "error":
+                    st["errors"] += 1   # timeouts were counted when they happened
+                st["total_sec"] += elapsed
+                st["last_sec"] = elapsed
+                self._recent.append({"name": name, "started": run["started"], "sec": elapsed,
+                                     "wait": run["started"] - run["queued"], "outcome": outcome, "error": error})
+
+    def report(self):
+        """Text for /jobs: running jobs, recent runs and per-job totals."""
+        now = time.time()
+        with self._lock:
+            running = sorted(self._running.values(), key=lambda r: r["queued"])
+            recent = list(self._recent)[-10:]
+            stats = {n: dict(st) for n, st in self._stats.items()}
+        lines = ["⚙️ 后台任务"]
+        if running:
+            lines.append("\n▶️ 运行中")
+            for r in running:
+                if r["started"] is None:
+                    lines.append(f"  {r['name']}  排队 {now - r['queued']:.0f}s")
+                else:
+                    flag = "  ⏱️超时" if r["timed_out"] else ""
+                    lines.append(f"  {r['name']}  已运行 {now - r['started']:.0f}s{flag}")
+        else:
+            lines.append("\n▶️ 当前没有运行中的任务")
+        if recent:
+            icons = {"ok": "✅", "error": "❌", "timeout": "⏱️"}
+            lines.append("\n🕘 最近运行")
+            for r in reversed(recent):
+                err = f"  {r['error'][:40]}" if r["error"] else ""
+                lines.append(f"  {icons[r['outcome']]} {datetime.fromtimestamp(r['started']).strftime('%H:%M')} "
+                             f"{r['name']}  {r['sec']:.1f}s{err}")
+        if stats:
+            lines.append("\n📊 累计（本次启动以来）")
+            for name, st in sorted(stats.items()):
+                avg = st["total_sec"] / st["runs"] if st["runs"] else 0
+                extra = "".join(f" {label}{st[k]}" for k, label in
+                                (("errors", "失败"), ("timeouts", "超时"), ("skipped", "跳过")) if st[k])
+                lines.append(f"  {name}: {st['runs']} 次 均{avg:.1f}s{extra}")
+        return "\n".join(lines)
+
+
+job_executor = JobExecutor(JOB_POOL_WORKERS)
+
+
+# ─── Scheduler ───────────────────────────────────────────────────
+# Jobs are declared in SCHEDULED_JOBS. The scheduler keeps a min-heap of next fire
+# times and sleeps exactly until the earliest one. A run that fires late (tick
+# overran, PC asleep, bot restarted) still starts if it is within the job's
+# catch_up window; several missed occurrences collapse into the most recent one.
+SCHEDULER_STATE_FILE = SCRIPT_DIR / "scheduler_state.json"
+SCHEDULER_DEFAULT_CATCH_UP = 300  # seconds a run may start late
+
+
+class CronExpr:
+    """5-field cron expression: minute hour day-of-month month day-of-week.
+    Supports *, lists (1,2), ranges (8-23) and steps (*/15, 8-22/2). Sunday = 0 or 7."""
+
+    _RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron needs 5 fields: {expr!r}")
+        self.expr = expr
+        parsed = [self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self._RANGES)]
+        self.minutes, self.hours, self.days, self.months, dows = parsed
+        self.dows = {d % 7 for d in dows}
+        self._dom_any = fields[2] == "*"
+        self._dow_any = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+            if part == "*":
+                start, stop = lo, hi
+            elif "-" in part:
+                start, stop = (int(x) for x in part.split("-"))
+            else:
+                start = stop = int(part)
+            if start < lo or stop > hi or start > stop or step < 1:
+                raise ValueError(f"cron field out of range: {field!r}")
+            values.update(range(start, stop + 1, step))
+        return values
+
+    def _day_ok(self, dt):
+        dom_ok = dt.day in self.days
+        dow_ok = (dt.weekday() + 1) % 7 in self.dows
+        if self._dom_any or self._dow_any:
+            return dom_ok and dow_ok
+        return dom_ok or dow_ok  # cron semantics: both restricted → either matches
+
+    def next_after(self, dt):
+        """First matching minute strictly after dt."""
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_ok(t):
+                t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+            elif t.hour not in self.hours:
+                t = (t + timedelta(hours=1)).replace(minute=0)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"cron never fires: {self.expr!r}")
+
+
+class ScheduledJob:
+    """A named job: schedule (anything with next_after(datetime)), target and catch-up policy.
+    quiet jobs (high-frequency ticks) are neither logged per run nor persisted for catch-up.
+    max_concurrent / timeout are passed to job_executor."""
+
+    def __init__(self, name, schedule, func, args=(), catch_up=SCHEDULER_DEFAULT_CATCH_UP,
+                 run_at_start=False, quiet=False, max_concurrent=1, timeout=JOB_DEFAULT_TIMEOUT):
+        self.name = name
+        self.schedule = CronExpr(schedule) if isinstance(schedule, str) else schedule
+        self.func = func
+        self.args = args
+        self.catch_up = catch_up
+        self.run_at_start = run_at_start
+        self.quiet = quiet
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+
+
+class Scheduler:
+    """Min-heap scheduler running declared jobs on a single background thread."""
+
+    def __init__(self, state_file):
+        self._state_file = state_file
+        self._heap = []           # (fire_ts, seq, job)
+        self._seq = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._state = self._load_state()
+
+    def _load_state(self):
+        try:
+            return json.loads(self._state_file.read_text(encoding="utf-8"))
         except Exception:
-            return None
+            return {}
 
-    while True:
+    def _save_state(self):
         try:
+            tmp = self._state_file.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(self._state, indent=2), encoding="utf-8")
+            tmp.replace(self._state_file)
+        except Exception as e:
+            log(f"Scheduler state save error: {e}")
+
+    def _push(self, job, fire_dt):
+        with self._lock:
+            self._seq += 1
+            heapq.heappush(self._heap, (fire_dt.timestamp(), self._seq, job))
+
+    @staticmethod
+    def _latest_due(job, fire_dt, now):
+        """The last occurrence at or before `now`, starting from a missed fire time — so the
+        catch-up window is judged against the most recent missed run, not the oldest."""
+        if not isinstance(job.schedule, CronExpr):
+            return fire_dt
+        while True:
+            nxt = job.schedule.next_after(fire_dt)
+            if nxt > now:
+                return fire_dt
+            fire_dt = nxt
+
+    def register(self, job):
+        """Add a job. Runs missed while the bot was down are caught up once."""
+        self._jobs[job.name] = job
+        now = datetime.now()
+        last = self._state.get(job.name)
+        if job.run_at_start:
+            self._push(job, now)
+        elif last:
+            # May be in the past — the run loop then applies the catch-up window
+            first = job.schedule.next_after(datetime.fromtimestamp(last))
+            self._push(job, self._latest_due(job, first, now) if first <= now else first)
+        else:
+            self._push(job, job.schedule.next_after(now))
+        self.wake()
+
+    def wake(self):
+        """Re-evaluate the heap now (call after a schedule source changes)."""
+        self._wakeup.set()
+
+    def reschedule(self, name):
+        """Recompute a job's next fire time (for dynamic schedules)."""
+        job = self._jobs.get(name)
+        if not job:
+            return
+        with self._lock:
+            self._heap = [e for e in self._heap if e[2] is not job]
+            heapq.heapify(self._heap)
+        self._push(job, job.schedule.next_after(datetime.now() - timedelta(minutes=1)))
+        self.wake()
+
+    def upcoming(self):
+        """[(datetime, job name)] sorted by fire time."""
+        with self._lock:
+            return [(datetime.fromtimestamp(ts), job.name) for ts, _, job in sorted(self._heap)]
+
+    def _dispatch(self, job):
+        job_executor.submit(job.name, job.func, *job.args,
+                            max_concurrent=job.max_concurrent, timeout=job.timeout)
+
+    def run_forever(self):
+        while True:
+            with self._lock:
+                next_ts = self._heap[0][0] if self._heap else None
+            delay = 3600 if next_ts is None else next_ts - time.time()
+            if delay > 0:
+                # Capped so wall-clock jumps (sleep/hibernate) are noticed within a minute
+                self._wakeup.wait(min(delay, 60))
+                self._wakeup.clear()
+                continue
+            with self._lock:
+                fire_ts, _, job = heapq.heappop(self._heap)
             now = datetime.now()
+            fire_ts = self._latest_due(job, datetime.fromtimestamp(fire_ts), now).timestamp()
+            late = now.timestamp() - fire_ts
+            if late <= max(job.catch_up, 0) or job.run_at_start:
+                if late > 60:
+                    log(f"⏰ Job {job.name} running {late / 60:.0f} min late (catch-up)")
+                elif not job.quiet:
+                    log(f"⏰ Job {job.name} triggered")
+                self._dispatch(job)
+            else:
+                log(f"⏭️ Job {job.name} missed by {late / 60:.0f} min (catch-up window "
+                    f"{job.catch_up // 60} min) — skipped")
+            job.run_at_start = False
+            if not job.quiet:
+                self._state[job.name] = fire_ts
+                self._save_state()
+            # Missed occurrences collapse: the next fire time is always in the future
+            self._push(job, job.schedule.next_after(max(now, datetime.fromtimestamp(fire_ts))))
+
+
+def _get_global_memory():
+    """Memory dict shared by main() (see __main__._global_memory)."""
+    try:
+        import __main__
+        return getattr(__main__, "_global_memory", None)
+    except Exception:
+        return None
 
-            # 每日定时汇报：10:00 & 22:00
-            if now.hour in REPORT_HOURS and now.minute == 0:
-                key = (now.strftime("%Y-%m-%d"), now.hour)
-                if key not in sent_keys:
-                    sent_keys.add(key)
-                    t = threading.Thread(target=send_daily_report, daemon=True)
-                    t.start()
-
-            # PM2 状态检查：每天 9:00
-            if now.hour == 9 and now.minute == 0:
-                key = (now.strftime("%Y-%m-%d"), "pm2_check")
-                if key not in sent_keys:
-                    sent_keys.add(key)
-                    t = threading.Thread(target=send_pm2_report, daemon=True)
-                    t.start()
-                    log("PM2 status check triggered at 09:00")
-
-            # POS 异常检测：每天 14:00（午餐后检查午市数据）
-            if now.hour == 14 and now.minute == 0:
-                key = (now.strftime("%Y-%m-%d"), "pos_anomaly")
-                if key not in sent_keys:
-                    sent_keys.add(key)
-                    t = threading.Thread(target=check_pos_anomaly, daemon=True)
-                    t.start()
-                    log("POS anomaly check triggered at 14:00")
-
-            # 预约汇报：每天 17:00
-            if now.hour == 17 and now.minute == 0:
-                key = (now.strftime("%Y-%m-%d"), "booking_5pm")
-                if key not in sent_keys:
-                    sent_keys.add(key)
-                    t = threading.Thread(target=send_booking_report_5pm, daemon=True)
-                    t.start()
-                    log("Booking report 17:00 triggered")
-
-            # DD Fresh 价格同步：每天 22:10
-            if now.hour == 22 and now.minute == 10:
-                key = (now.strftime("%Y-%m-%d"), "ddfresh")
-                if key not in sent_keys:
-                    sent_keys.add(key)
-                    t = threading.Thread(target=sync_ddfresh_prices, daemon=True)
-                    t.start()
-                    log("DD Fresh price sync started")
-
-            # eBuy 价格同步：每天 22:20
-            if now.hour == 22 and now.minute == 20:
-                key = (now.strftime("%Y-%m-%d"), "ebuy")
-                if key not in sent_keys:
-                    sent_keys.add(key)
-                    t = threading.Thread(target=sync_ebuy_prices, daemon=True)
-                    t.start()
-                    log("eBuy price sync started")
-
-            # 夜间自我学习：每天 23:30（提炼今天对话关键知识）
-            if now.hour == 23 and now.minute == 30:
-                key = (now.strftime("%Y-%m-%d"), "self_review")
-                if key not in sent_keys:
-                    sent_keys.add(key)
-                    mem = get_mem()
-                    if mem is not None:
-                        t = threading.Thread(
-                            target=nightly_self_review, args=(mem,), daemon=True
-                        )
-                        t.start()
-                        log("Nightly self-review triggered at 23:30")
-
-            # Check scheduled one-off tasks
-            check_scheduled_tasks(now)
-
-            # 系统健康检查：每小时一次（整点），跳过 00:00-08:00 休息时段
-            current_time = time.time()
-            if now.minute == 0 and now.hour >= 8 and current_time - last_health_check >= 3600:
-                try:
-                    check_system_health()
-                except Exception as e:
-                    log(f"Health check error: {e}")
-                last_health_check = current_time
 
-            # 小虾留言检查：每小时一次
-            if current_time - last_mailbox_check >= 3600:
-                try:
-                    check_xiaoxia_mailbox()
-                except Exception as e:
-                    log(f"Mailbox check error: {e}")
-                last_mailbox_check = current_time
+def run_nightly_self_review():
+    mem = _get_global_memory()
+    if mem is not None:
+        nightly_self_review(mem)
 
-            # Clean up keys from previous days
-            today = now.strftime("%Y-%m-%d")
-            sent_keys = {k for k in sent_keys if k[0] == today}
 
-        except Exception as e:
-            log(f"Daily reporter loop error: {e}")
+def run_system_health_check():
+    try:
+        check_system_health()
+    except Exception as e:
+        log(f"Health check error: {e}")
+
+
+def run_mailbox_check():
+    try:
+        check_xiaoxia_mailbox()
+    except Exception as e:
+        log(f"Mailbox check error: {e}")
+
+
+# Declarative job table — add new background jobs here
+SCHEDULED_JOBS = [
+    # 每日定时汇报：10:00 & 22:00
+    ScheduledJob("daily_report", f"0 {','.join(str(h) for h in sorted(REPORT_HOURS))} * * *",
+                 send_daily_report, catch_up=1800, timeout=300),
+    # PM2 状态检查：每天 9:00
+    ScheduledJob("pm2_check", "0 9 * * *", send_pm2_report, catch_up=1800, timeout=120),
+    # PM2 重启监控：每 5 分钟（捕捉崩溃循环，不用等第二天 9:00）
+    ScheduledJob("pm2_poll", "*/5 * * * *", check_pm2_restarts, quiet=True, timeout=60),
+    # POS 异常检测：营业时间每 15 分钟（按星期×小时基线）
+    ScheduledJob("pos_anomaly", "*/15 10-22 * * *", check_pos_anomaly, quiet=True, timeout=300),
+    # 预约汇报：每天 17:00
+    ScheduledJob("booking_5pm", "0 17 * * *", send_booking_report_5pm, catch_up=1800, timeout=120),
+    # DD Fresh 价格同步：每天 22:10（DD Fresh 22:00 更新）
+    ScheduledJob("ddfresh", "10 22 * * *", sync_ddfresh_prices, catch_up=3 * 3600,
+                 timeout=SUPPLIER_SYNCS["ddfresh"][2] + 30),
+    # eBuy 价格同步：每天 22:20
+    ScheduledJob("ebuy", "20 22 * * *", sync_ebuy_prices, catch_up=3 * 3600,
+                 timeout=SUPPLIER_SYNCS["ebuy"][2] + 30),
+    # 夜间自我学习：每天 23:30（提炼今天对话关键知识）
+    ScheduledJob("self_review", "30 23 * * *", run_nightly_self_review, catch_up=1800),
+    # 系统健康检查：每 10 分钟探测一次（记录延迟历史），告警只在 08:00-24:00 发出
+    ScheduledJob("health_check", "*/10 * * * *", run_system_health_check, quiet=True, timeout=120),
+    # 小虾留言检查：启动时一次，之后每小时
+    ScheduledJob("mailbox", "0 * * * *", run_mailbox_check, run_at_start=True, timeout=120),
+    # received_files 清理：每 30 分钟（过期 + 超出容量上限的先清最久没用的）
+    ScheduledJob("received_gc", "*/30 * * * *", _clean_received_files, quiet=True, timeout=300),
+    # 一次性定时任务（scheduled_tasks.json）
+    ScheduledJob("scheduled_tasks", _OneOffSchedule(scheduled_task_store),
+                 lambda: check_scheduled_tasks(datetime.now()), catch_up=7 * 86400, quiet=True),
+]
+
+_scheduler = Scheduler(SCHEDULER_STATE_FILE)
 
-        time.sleep(60)
+
+def daily_reporter_thread():
+    """Background daemon thread: run SCHEDULED_JOBS via the heap scheduler."""
+    for job in SCHEDULED_JOBS:
+        try:
+            _scheduler.register(job)
+        except Exception as e:
+            log(f"Scheduler: failed to register {job.name}: {e}")
+    while True:
+        try:
+            _scheduler.run_forever()
+        except Exception as e:
+            log(f"Scheduler loop error: {e}")
+            time.sleep(5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+"""Long voice notes: chunk planning and stitching on synthetic audio with a stub transcriber.
+
+Run with `python -m unittest discover tests` (needs pydub; ffmpeg is not, encoding is stubbed)."""
+import random
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import telegram_secretary as ts  # noqa: E402
+
+ts.LOG_FILE = Path(tempfile.gettempdir()) / "telegram_secretary_test.log"
+
+try:
+    from pydub import AudioSegment
+except ImportError:
+    AudioSegment = None
+
+RATE = 8000
+WORD_MS = 400
+
+
+def _noise(ms, rng):
+    return AudioSegment(data=rng.randbytes(RATE * ms // 1000 * 2), sample_width=2,
+                        frame_rate=RATE, channels=1)
+
+
+def build_note(sentences, word_gap_ms, pause_ms, seed=1):
+    """Synthetic note: each sentence is a run of WORD_MS noise "words" separated by
+    word_gap_ms of digital silence, sentences separated by pause_ms. Returns the segment
+    and [(start_ms, end_ms, word)]."""
+    rng = random.Random(seed)
+    segment, words, t = AudioSegment.empty(), [], 0
+    for s, count in enumerate(sentences):
+        for w in range(count):
+            segment += _noise(WORD_MS, rng)
+            words.append((t, t + WORD_MS, f"s{s}w{w}"))
+            t += WORD_MS
+            gap = word_gap_ms if w < count - 1 else pause_ms
+            if gap:
+                segment += AudioSegment.silent(gap, frame_rate=RATE)
+                t += gap
+    return segment, words
+
+
+class StubTranscriber:
+    """Hears the words whose midpoint falls inside the chunk it is given."""
+
+    def __init__(self, words):
+        self.words = words
+        self.plan = []
+
+    def __call__(self, blob, timings=None):
+        # blob is the chunk index (see LongVoiceTest.transcribe's encode stub)
+        a, b = self.plan[int(blob)]
+        if timings is not None:
+            timings["groq"] = 0.1 * (int(blob) + 1)
+        return " ".join(w for s, e, w in self.words if a <= (s + e) / 2 < b)
+
+
+@unittest.skipIf(AudioSegment is None, "pydub not installed")
+class LongVoiceTest(unittest.TestCase):
+
+    def transcribe(self, segment, words):
+        stub = StubTranscriber(words)
+        real_plan, real_encode = ts.plan_voice_chunks, ts.encode_voice
+        encoded = []
+
+        def plan(*args, **kwargs):
+            stub.plan = real_plan(*args, **kwargs)
+            return stub.plan
+
+        def encode(chunk):
+            encoded.append(len(chunk))
+            return str(len(encoded) - 1).encode()
+
+        ts.plan_voice_chunks, ts.encode_voice = plan, encode
+        try:
+            timings = {}
+            text = ts.transcribe_long_voice(segment, stub, timings)
+        finally:
+            ts.plan_voice_chunks, ts.encode_voice = real_plan, real_encode
+        return text, stub.plan, timings, encoded
+
+    def test_cuts_fall_in_pauses(self):
+        segment, words = build_note([22] * 8, word_gap_ms=100, pause_ms=1500)
+        text, plan, timings, _ = self.transcribe(segment, words)
+        self.assertGreater(len(plan), 1)
+        self.assertEqual(plan[0][0], 0)
+        self.assertEqual(plan[-1][1], len(segment))
+        pauses = [(e, e + 1500) for (_, e, w), nxt in zip(words, words[1:]) if nxt[0] - e == 1500]
+        for (_, end), (start, _) in zip(plan, plan[1:]):
+            cut = start + ts.VOICE_CHUNK_OVERLAP_MS
+            self.assertEqual(end - ts.VOICE_CHUNK_OVERLAP_MS, cut)
+            self.assertTrue(any(a <= cut <= b for a, b in pauses), f"cut at {cut}ms is not in a pause")
+        for a, b in plan:
+            self.assertLessEqual(b - a, ts.VOICE_CHUNK_MAX_MS + 2 * ts.VOICE_CHUNK_OVERLAP_MS)
+        self.assertEqual(text, " ".join(w for _, _, w in words))
+        self.assertEqual(timings["chunks"], len(plan))
+        self.assertAlmostEqual(timings["groq"], 0.1 * len(plan))
+
+    def test_hard_cut_overlap_is_stitched_once(self):
+        # Continuous speech: no silence to cut at, so words straddle the cuts and are heard twice
+        segment, words = build_note([300], word_gap_ms=0, pause_ms=0)
+        text, plan, _, _ = self.transcribe(segment, words)
+        self.assertGreater(len(plan), 1)
+        self.assertEqual(text, " ".join(w for _, _, w in words))
+
+
+class StitchTest(unittest.TestCase):
+
+    def test_trims_repeat_across_boundary(self):
+        self.assertEqual(ts.stitch_transcripts(["我们明天去开会", "去开会然后吃饭"]), "我们明天去开会然后吃饭")
+        self.assertEqual(ts.stitch_transcripts(["see you at the", "at the office"]), "see you at the office")
+
+    def test_keeps_a_chunk_equal_to_the_previous_tail(self):
+        self.assertEqual(ts.stitch_transcripts(["好的", "好的"]), "好的好的")
+
+    def test_repeat_longer_than_the_overlap_is_kept(self):
+        # 30s chunks share 1.2s of audio: an 8-token repeat can't all be in it
+        parts = ["a b c d e f g h i j k l m n o p q r s t one two three four five six seven eight",
+                 "one two three four five six seven eight u v w x y z a b c d e f g h i j k l m n"]
+        text = ts.stitch_transcripts(parts, durations=[30_000, 30_000])
+        self.assertEqual(text.count("one two three"), 2)
+
+    def test_failed_chunk_is_marked(self):
+        self.assertEqual(ts.stitch_transcripts(["hello there", None, "bye"]), "hello there … bye")
+
+
+if __name__ == "__main__":
+    unittest.main()